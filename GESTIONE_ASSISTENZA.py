@@ -10,14 +10,24 @@
 # ===============================================
 
 import os
+import re
+import csv
 import json
+import queue
 import sqlite3
-from datetime import datetime, date
+import pickle
+import weakref
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from datetime import datetime, date, timedelta
+import numpy as np
 import pandas as pd
 import streamlit as st
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
-from io import BytesIO
+from io import BytesIO, StringIO
 from streamlit_pdf_viewer import pdf_viewer
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.units import cm
@@ -28,7 +38,14 @@ from streamlit_folium import st_folium
 from geopy.geocoders import Nominatim
 from geopy.distance import geodesic
 from geopy.extra.rate_limiter import RateLimiter
-import time
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+try:
+    import orjson  # opzionale: serializzazione extra_json più veloce
+except ImportError:
+    orjson = None
 
 
 def check_login():
@@ -79,187 +96,1049 @@ st.set_page_config(page_title="Gestione Assistenza", layout="wide", initial_side
 
 DB_FILE="assistenza.db"
 
+# -------------------------------
+# Accesso DB condiviso (pool connessioni)
+# -------------------------------
+# Pool unico per processo. Streamlit esegue ogni rerun in un thread nuovo: il
+# thread prende in prestito una connessione (lettura/scrittura e/o sola lettura)
+# alla prima query e la restituisce quando termina, così il rerun successivo
+# riusa una connessione già aperta e già configurata con i PRAGMA.
+# Il DB lavora in WAL: i lettori non bloccano lo scrittore e viceversa.
+
+DB_BUSY_TIMEOUT_MS = 30000           # attesa massima sul lock prima di "database is locked"
+DB_CACHE_SIZE_KIB = 20000            # ~20 MB di page cache per connessione
+DB_MMAP_SIZE = 256 * 1024 * 1024     # 256 MB letti via memory-map
+DB_POOL_MAX_LIBERE = 8               # connessioni inattive tenute aperte per tipo
+
+
+class _Prestito:
+    """Connessione in uso da un thread: torna al pool quando il thread termina."""
+
+    def __init__(self, pool, nome, con):
+        self.con = con
+        weakref.finalize(self, pool._restituisci, nome, con)
+
+
+class PoolConnessioni:
+    """
+    Pool di connessioni SQLite (check_same_thread=False) condiviso dal processo:
+    code limitate di connessioni libere, una per lettura/scrittura e una per sola lettura.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = os.path.abspath(db_file)
+        self._locale = threading.local()
+        self._libere = {nome: queue.LifoQueue(DB_POOL_MAX_LIBERE) for nome in ("rw", "ro")}
+
+    def _apri(self, sola_lettura, tra_thread=False):
+        timeout = DB_BUSY_TIMEOUT_MS / 1000
+        con = None
+        if sola_lettura:
+            try:
+                uri = Path(self.db_file).as_uri() + "?mode=ro"
+                con = sqlite3.connect(uri, uri=True, timeout=timeout, check_same_thread=not tra_thread)
+            except sqlite3.OperationalError:
+                con = None  # DB non ancora creato: ripiego su una connessione normale
+        if con is None:
+            con = sqlite3.connect(self.db_file, timeout=timeout, check_same_thread=not tra_thread)
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute("PRAGMA synchronous = NORMAL")
+        con.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        con.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KIB}")
+        con.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        con.execute("PRAGMA temp_store = MEMORY")
+        con.execute("PRAGMA foreign_keys = ON")
+        if sola_lettura:
+            con.execute("PRAGMA query_only = ON")
+        return con
+
+    def nuova_connessione(self, sola_lettura=True, tra_thread=False):
+        """
+        Connessione fuori pool (diagnostica, thread dedicati): la chiude il chiamante.
+        tra_thread=True disattiva solo check_same_thread: se più thread la usano,
+        serializzare gli accessi (threading.Lock) spetta al chiamante, come in SnapshotTicketAperti.
+        """
+        return self._apri(sola_lettura, tra_thread)
+
+    def _prendi(self, nome):
+        """Connessione libera dal pool, o una nuova se il pool è vuoto."""
+        while True:
+            try:
+                con = self._libere[nome].get_nowait()
+            except queue.Empty:
+                return self._apri(nome == "ro", tra_thread=True)
+            try:
+                con.total_changes  # solleva ProgrammingError se qualcuno l'ha chiusa
+                return con
+            except sqlite3.ProgrammingError:
+                continue
+
+    def _restituisci(self, nome, con):
+        """Rimette la connessione nel pool ripulita; la chiude se è rotta o il pool è pieno."""
+        try:
+            if con.in_transaction:
+                con.rollback()
+            self._libere[nome].put_nowait(con)
+        except (sqlite3.Error, queue.Full):
+            con.close()
+
+    def connessione(self, sola_lettura=False):
+        nome = "ro" if sola_lettura else "rw"
+        prestito = getattr(self._locale, nome, None)
+        if prestito is not None:
+            try:
+                prestito.con.total_changes
+            except sqlite3.ProgrammingError:
+                prestito = None
+        if prestito is None:
+            prestito = _Prestito(self, nome, self._prendi(nome))
+            setattr(self._locale, nome, prestito)
+        return prestito.con
+
+    def ripristina(self):
+        """
+        Annulla transazioni rimaste aperte nel thread corrente da un rerun
+        interrotto (st.stop/st.rerun); le connessioni restituite al pool
+        vengono già ripulite da _restituisci.
+        """
+        for nome in ("rw", "ro"):
+            prestito = getattr(self._locale, nome, None)
+            if prestito is not None and prestito.con.in_transaction:
+                prestito.con.rollback()
+
+
+@st.cache_resource
+def get_pool(db_file=DB_FILE):
+    return PoolConnessioni(db_file)
+
+
+def get_connessione(sola_lettura=False, db_file=DB_FILE):
+    """Connessione in prestito al thread corrente (rerun). Non va chiusa dal chiamante."""
+    return get_pool(db_file).connessione(sola_lettura)
+
+
+@contextmanager
+def transazione(db_file=DB_FILE):
+    """
+    Blocco di scrittura atomico (BEGIN IMMEDIATE ... COMMIT/ROLLBACK).
+    Se la connessione è già in transazione il blocco vi si accoda.
+    """
+    con = get_connessione(db_file=db_file)
+    if con.in_transaction:
+        yield con
+        return
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con
+    except BaseException:
+        con.rollback()
+        raise
+    else:
+        con.commit()
+
+
+get_pool(DB_FILE).ripristina()
+
     
 def get_table_columns(conn, table):
     cur = conn.execute(f'PRAGMA table_info("{table}")')
     return {row[1] for row in cur.fetchall()}  # set di nomi colonna
 
 def ensure_columns(conn, table, columns_types: dict):
+    """Aggiunge le colonne mancanti (il commit resta al chiamante)."""
     existing = get_table_columns(conn, table)
     for col, coltype in columns_types.items():
         if col not in existing:
             conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{col}" {coltype}')
-    conn.commit()
-
-def setup_db():
-    conn = sqlite3.connect(DB_FILE)
-
-    # Crea le tabelle se non esistono (solo PK)
-    conn.execute('CREATE TABLE IF NOT EXISTS clienti (id INTEGER PRIMARY KEY AUTOINCREMENT)')
-    conn.execute('CREATE TABLE IF NOT EXISTS tecnici (id INTEGER PRIMARY KEY AUTOINCREMENT)')
-    conn.execute('CREATE TABLE IF NOT EXISTS ticket  (id INTEGER PRIMARY KEY AUTOINCREMENT)')
-
-    # Porta le tabelle allo schema che l’app si aspetta (aggiunge solo se mancano)
-    ensure_columns(conn, "clienti", {
-        "matricola": "TEXT",
-        "codice": "TEXT",
-        "azienda": "TEXT",
-        "indirizzo": "TEXT",
-        "citta": "TEXT",
-        "provincia": "TEXT",
-    })
-
-    ensure_columns(conn, "tecnici", {
-        "nome": "TEXT",
-        "cognome": "TEXT",
-        "citta": "TEXT",
-        "provincia": "TEXT",
-        "regione": "TEXT",
-        "esperienza": "TEXT",
-    })
-
-    ensure_columns(conn, "ticket", {
-        "cliente_id": "INTEGER",
-        "tecnico_id": "INTEGER",
-        "matricola_manual": "TEXT",     # <- mancava nel tuo DB
-        "tecnico_manual": "TEXT",       # <- mancava nel tuo DB
-        "descrizione": "TEXT",
-        "fattura": "REAL",
-        "note": "TEXT",
-        "data_intervento": "TEXT",
-        "intervento_svolto": "TEXT",
-        "allegato": "TEXT",
-        "stato": "TEXT",
-    })
-
-    conn.commit()
-    conn.close()
-# CHIAMA SUBITO QUESTA FUNZIONE A INIZIO APP
-setup_db()
-def import_excel_dynamic(conn, table: str, file):
-    # leggi excel
-    df = pd.read_excel(file)
-
-    # Normalizza i nomi colonna in modo coerente (stessi nomi che userà il DB)
-    def normalize(name: str) -> str:
-        return (
-            str(name)
-            .strip()
-            .replace("\n", " ")
-            .replace("\r", " ")
+
+# -------------------------------
+# Migrazioni schema (PRAGMA user_version)
+# -------------------------------
+# Ogni passo è numerato e gira una sola volta per database: la versione
+# applicata è scritta in PRAGMA user_version nella stessa transazione del
+# passo. A ogni rerun resta solo la lettura di quell'intero.
+
+# Colonne che l'app si aspetta (usate per portare avanti DB creati con
+# versioni precedenti dello script).
+COLONNE_CLIENTI = {
+    "matricola": "TEXT", "matint": "TEXT", "modello": "TEXT", "proprieta": "TEXT",
+    "codice": "TEXT", "azienda": "TEXT", "ubicazione": "TEXT", "indirizzo": "TEXT",
+    "citta": "TEXT", "provincia": "TEXT", "contatto": "TEXT", "vestizione": "TEXT",
+    "note": "TEXT", "ddt": "TEXT", "extra_json": "TEXT DEFAULT '{}'", "regione": "TEXT",
+    "lat": "REAL", "lon": "REAL",
+}
+
+COLONNE_TECNICI = {
+    "nome": "TEXT", "cognome": "TEXT", "citta": "TEXT", "provincia": "TEXT",
+    "regione": "TEXT", "esperienza": "TEXT", "extra_json": "TEXT DEFAULT '{}'",
+    "note": "TEXT", "telefono": "TEXT", "referente": "TEXT", "cellulare": "TEXT",
+    "email": "TEXT", "lat": "REAL", "lon": "REAL",
+}
+
+COLONNE_TICKET = {
+    "numero_ticket": "TEXT", "matricola": "TEXT", "modello": "TEXT", "cliente_id": "INTEGER",
+    "codice": "TEXT", "azienda": "TEXT", "indirizzo_cliente": "TEXT", "citta_cliente": "TEXT",
+    "provincia_cliente": "TEXT", "regione": "TEXT", "contatto": "TEXT", "tecnico_id": "INTEGER",
+    "tecnico_nome": "TEXT", "citta_tecnico": "TEXT", "provincia_tecnico": "TEXT",
+    "regione_tecnico": "TEXT", "descrizione": "TEXT", "intervento_svolto": "TEXT", "note": "TEXT",
+    "fattura": "REAL", "data_intervento": "TEXT", "stato": "TEXT", "guasto": "TEXT",
+    "data_creazione": "TEXT", "allegato_path": "TEXT", "allegato_nome": "TEXT",
+    "allegato_percorso": "TEXT", "matricola_manual": "TEXT", "tecnico_manual": "TEXT",
+    "allegato": "TEXT", "extra_json": "TEXT DEFAULT '{}'",
+}
+
+
+def _crea_tabella(con, table, colonne, vincoli=()):
+    """CREATE TABLE IF NOT EXISTS con PK autoincrement + colonne + vincoli extra."""
+    righe = ["id INTEGER PRIMARY KEY AUTOINCREMENT"]
+    righe += [f'"{col}" {tipo}' for col, tipo in colonne.items()]
+    righe += list(vincoli)
+    con.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (\n    ' + ",\n    ".join(righe) + "\n)")
+
+
+def _migrazione_001_schema_base(con):
+    """Tabelle principali con lo schema reale dell'app (clienti/tecnici/ticket + anagrafiche)."""
+    _crea_tabella(con, "clienti", COLONNE_CLIENTI, ["UNIQUE (matricola)"])
+    _crea_tabella(con, "tecnici", COLONNE_TECNICI)
+    _crea_tabella(con, "ticket", COLONNE_TICKET, ["UNIQUE (numero_ticket)"])
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS critical (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codice_guasto TEXT NOT NULL,
+            guasto TEXT NOT NULL,
+            descrizione TEXT
+        )
+    """)
+    con.execute('CREATE TABLE IF NOT EXISTS province ("provincia" TEXT, "regione" TEXT)')
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS codici_clienti (
+            "codice" TEXT, "ragione_sociale" TEXT, "codice_IRI" TEXT, "indirizzo" TEXT,
+            "citta" TEXT, "provincia" TEXT, "gruppo_commerciale" TEXT,
+            "sub_insegna" TEXT, "insegna" TEXT
         )
-    df.columns = [normalize(c) for c in df.columns]
+    """)
 
-    # Aggiungi le colonne mancanti nella tabella come TEXT
-    existing = get_table_columns(conn, table)
-    for col in df.columns:
-        if col not in existing:
-            conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{col}" TEXT')
-    conn.commit()
+    # DB creati da versioni precedenti: aggiunge solo le colonne mancanti
+    ensure_columns(con, "clienti", COLONNE_CLIENTI)
+    ensure_columns(con, "tecnici", COLONNE_TECNICI)
+    ensure_columns(con, "ticket", COLONNE_TICKET)
+
+
+# Indici secondari gestiti dall'app (nome → definizione). Le query "calde"
+# elencate in QUERY_CANONICHE devono poterli usare: vedi verifica_piani_query().
+INDICI = {
+    # solo i ticket pendenti: la lista aperti resta piccola anche con anni di storico
+    "idx_ticket_aperti":
+        "ticket (data_creazione, id) WHERE stato IN ('Aperto','In lavorazione')",
+    "idx_ticket_matricola_data": "ticket (matricola, data_creazione)",
+    "idx_ticket_tecnico_stato": "ticket (tecnico_id, stato)",
+    "idx_clienti_provincia_citta_codice": "clienti (provincia, citta, codice)",
+    "idx_clienti_regione": "clienti (regione)",
+    "idx_tecnici_regione_provincia": "tecnici (regione, provincia)",
+    "idx_ticket_data_creazione": "ticket (data_creazione)",
+    "idx_ticket_stato_id": "ticket (stato, id)",
+    "idx_ticket_data_intervento": "ticket (data_intervento)",
+}
+
+
+def assicura_indici(con):
+    """Crea gli indici di INDICI che mancano (idempotente)."""
+    for nome, definizione in INDICI.items():
+        con.execute(f"CREATE INDEX IF NOT EXISTS {nome} ON {definizione}")
+
+
+def _migrazione_002_indici(con):
+    assicura_indici(con)
+
+
+# Campi snapshot del ticket indicizzati full-text (ordine = ordine dei pesi bm25)
+COLONNE_FTS_TICKET = [
+    "numero_ticket", "matricola", "azienda", "indirizzo_cliente",
+    "citta_cliente", "tecnico_nome", "guasto", "descrizione",
+]
+PESI_FTS_TICKET = [10.0, 10.0, 3.0, 1.0, 2.0, 2.0, 2.0, 1.0]
+
+# Punti vendita: colonne cercate per sottostringa (trigram) + campi solo restituiti
+COLONNE_FTS_CODICI = ["codice", "indirizzo", "citta", "insegna", "gruppo_commerciale"]
+COLONNE_FTS_CODICI_EXTRA = ["provincia", "sub_insegna", "label"]
+
+# Anagrafica clienti: colonne cercate per sottostringa (trigram)
+COLONNE_FTS_CLIENTI = ["matricola", "proprieta", "codice", "azienda", "indirizzo"]
+
+
+def _migrazione_003_ticket_fts(con):
+    """Indice FTS5 (external content su ticket) tenuto allineato da trigger."""
+    colonne = ", ".join(COLONNE_FTS_TICKET)
+    nuovi = ", ".join(f"new.{c}" for c in COLONNE_FTS_TICKET)
+    vecchi = ", ".join(f"old.{c}" for c in COLONNE_FTS_TICKET)
+    con.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS ticket_fts USING fts5(
+            {colonne},
+            content='ticket', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS ticket_fts_ai AFTER INSERT ON ticket BEGIN
+            INSERT INTO ticket_fts(rowid, {colonne}) VALUES (new.id, {nuovi});
+        END
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS ticket_fts_ad AFTER DELETE ON ticket BEGIN
+            INSERT INTO ticket_fts(ticket_fts, rowid, {colonne}) VALUES ('delete', old.id, {vecchi});
+        END
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS ticket_fts_au AFTER UPDATE OF {colonne} ON ticket BEGIN
+            INSERT INTO ticket_fts(ticket_fts, rowid, {colonne}) VALUES ('delete', old.id, {vecchi});
+            INSERT INTO ticket_fts(rowid, {colonne}) VALUES (new.id, {nuovi});
+        END
+    """)
+    con.execute("INSERT INTO ticket_fts(ticket_fts) VALUES ('rebuild')")
+    assicura_indici(con)
 
-    # Converte eventuali datetime in stringa ISO (SQLite non ha un tipo datetime nativo)
-    for col in df.columns:
-        if pd.api.types.is_datetime64_any_dtype(df[col]):
-            df[col] = df[col].dt.strftime("%Y-%m-%d")
 
-    # Sostituisci NaN con stringa vuota
-    df = df.fillna("")
+def ricostruisci_codici_fts(con):
+    """
+    Ricarica codici_clienti_fts da codici_clienti (etichetta già composta,
+    righe identiche del file codici indicizzate una volta sola).
+    Va richiamata dopo ogni import, nella stessa transazione: la tabella
+    viene sostituita per intero e non si possono usare trigger come per ticket_fts.
+    """
+    colonne = COLONNE_FTS_CODICI + COLONNE_FTS_CODICI_EXTRA
+    valori = ", ".join(f"COALESCE({c}, '')" for c in colonne[:-1])
+    label = " || ".join([
+        "COALESCE(codice, '')", "' | '", "COALESCE(indirizzo, '')", "' | '",
+        "COALESCE(citta, '')", "' ('", "COALESCE(provincia, '')", "') | '",
+        "COALESCE(insegna, '')", "' | '", "COALESCE(sub_insegna, '')", "' | '",
+        "COALESCE(gruppo_commerciale, '')",
+    ])
+    con.execute("DELETE FROM codici_clienti_fts")
+    con.execute(f"""
+        INSERT INTO codici_clienti_fts ({", ".join(colonne)})
+        SELECT DISTINCT {valori}, {label} FROM codici_clienti
+    """)
 
-    # Inserisci (ora le colonne esistono tutte)
-    df.to_sql(table, conn, if_exists="append", index=False)
-    
-# -------------------------------
-# Utility DB
-# -------------------------------
 
-def connetti_db():
-    """Connessione SQLite con foreign_keys attive e Row factory."""
-    con = sqlite3.connect(DB_FILE)
-    con.row_factory = sqlite3.Row
-    con.execute("PRAGMA foreign_keys = ON")
-    return con
-
-def crea_o_migra_db():
-    """Crea le tabelle se non esistono e aggiunge le colonne mancanti (migrazioni leggere)."""
-    con = connetti_db()
-    cur = con.cursor()
-
-    # CLIENTI: colonne base + extra_json
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS clienti (
-        id INTEGER PRIMARY KEY,
-        matricola TEXT NOT NULL UNIQUE,
-        azienda TEXT NOT NULL,
-        indirizzo TEXT,
-        contatto TEXT,
-        extra_json TEXT DEFAULT '{}'
-    )
+def _migrazione_004_codici_fts(con):
+    """Indice trigram (sottostringhe, case-insensitive) sui punti vendita."""
+    extra = ", ".join(f"{c} UNINDEXED" for c in COLONNE_FTS_CODICI_EXTRA)
+    con.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS codici_clienti_fts USING fts5(
+            {", ".join(COLONNE_FTS_CODICI)}, {extra},
+            tokenize='trigram'
+        )
+    """)
+    ricostruisci_codici_fts(con)
+
+
+# Ultimo progressivo assegnato per (sigla azienda, giorno YYMMDD) dei numeri ticket
+# nel formato SSYYMMDDNNN. I numeri importati da Excel si riallineano con MAX().
+SQL_ALLINEA_SEQUENZA_TICKET = """
+    INSERT INTO ticket_sequenza (sigla, giorno, ultimo)
+    SELECT substr(numero_ticket, 1, 2), substr(numero_ticket, 3, 6),
+           MAX(CAST(substr(numero_ticket, 9) AS INTEGER))
+    FROM ticket
+    WHERE numero_ticket GLOB '[A-Z][A-Z][0-9][0-9][0-9][0-9][0-9][0-9][0-9]*'
+    GROUP BY 1, 2
+    ON CONFLICT (sigla, giorno) DO UPDATE SET ultimo = MAX(ultimo, excluded.ultimo)
+"""
+
+
+def allinea_sequenza_ticket(con):
+    """Porta ticket_sequenza almeno al massimo progressivo presente in ticket."""
+    con.execute(SQL_ALLINEA_SEQUENZA_TICKET)
+
+
+def _migrazione_005_sequenza_ticket(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS ticket_sequenza (
+            sigla TEXT NOT NULL,
+            giorno TEXT NOT NULL,
+            ultimo INTEGER NOT NULL,
+            PRIMARY KEY (sigla, giorno)
+        ) WITHOUT ROWID
     """)
+    allinea_sequenza_ticket(con)
 
-    # TECNICI: colonne base + extra_json
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS tecnici (
-        id INTEGER PRIMARY KEY,
-        nome TEXT NOT NULL,
-        codice TEXT UNIQUE,
-        regione TEXT,
-        contatto TEXT,
-        extra_json TEXT DEFAULT '{}'
+
+# Tabelle i cui dati alimentano le cache condivise (vedi carica_riferimento)
+TABELLE_VERSIONATE = ["clienti", "tecnici", "ticket", "critical", "codici_clienti", "province"]
+
+
+def _migrazione_006_versioni_tabelle(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS versioni_tabelle (
+            tabella TEXT PRIMARY KEY,
+            versione INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    con.executemany(
+        "INSERT OR IGNORE INTO versioni_tabelle (tabella) VALUES (?)",
+        [(t,) for t in TABELLE_VERSIONATE]
     )
+
+
+# Colonne per cui si tengono i conteggi dei valori distinti (tendine di filtro)
+DIMENSIONI_FACCETTE = {
+    "ticket": ["azienda", "provincia_cliente", "regione", "tecnico_nome", "guasto"],
+    "clienti": ["regione", "citta", "proprieta"],
+    "tecnici": ["regione", "citta"],
+}
+
+
+def _sql_faccetta_piu(tabella, colonna, riga="new"):
+    return f"""
+            INSERT INTO faccette (dimensione, valore, conteggio)
+            SELECT '{tabella}.{colonna}', {riga}.{colonna}, 1
+            WHERE {riga}.{colonna} IS NOT NULL AND {riga}.{colonna} <> ''
+            ON CONFLICT (dimensione, valore) DO UPDATE SET conteggio = conteggio + 1;"""
+
+
+def _sql_faccetta_meno(tabella, colonna, riga="old"):
+    return f"""
+            UPDATE faccette SET conteggio = conteggio - 1
+            WHERE dimensione = '{tabella}.{colonna}' AND valore = {riga}.{colonna};
+            DELETE FROM faccette
+            WHERE dimensione = '{tabella}.{colonna}' AND valore = {riga}.{colonna} AND conteggio <= 0;"""
+
+
+def ricostruisci_faccette(con):
+    """Ricalcola da zero i conteggi (i trigger poi li tengono allineati riga per riga)."""
+    con.execute("DELETE FROM faccette")
+    for tabella, colonne in DIMENSIONI_FACCETTE.items():
+        for colonna in colonne:
+            con.execute(f"""
+                INSERT INTO faccette (dimensione, valore, conteggio)
+                SELECT '{tabella}.{colonna}', {colonna}, COUNT(*)
+                FROM {tabella}
+                WHERE {colonna} IS NOT NULL AND {colonna} <> ''
+                GROUP BY {colonna}
+            """)
+
+
+def _migrazione_009_faccette(con):
+    """Tabella (dimensione, valore, conteggio) tenuta aggiornata da trigger generati."""
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS faccette (
+            dimensione TEXT NOT NULL,
+            valore TEXT NOT NULL,
+            conteggio INTEGER NOT NULL,
+            PRIMARY KEY (dimensione, valore)
+        ) WITHOUT ROWID
     """)
+    for tabella, colonne in DIMENSIONI_FACCETTE.items():
+        piu = "".join(_sql_faccetta_piu(tabella, c) for c in colonne)
+        meno = "".join(_sql_faccetta_meno(tabella, c) for c in colonne)
+        con.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS faccette_{tabella}_ai AFTER INSERT ON {tabella} BEGIN{piu}
+            END
+        """)
+        con.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS faccette_{tabella}_ad AFTER DELETE ON {tabella} BEGIN{meno}
+            END
+        """)
+        for colonna in colonne:
+            con.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS faccette_{tabella}_au_{colonna}
+                AFTER UPDATE OF {colonna} ON {tabella}
+                WHEN old.{colonna} IS NOT new.{colonna} BEGIN{_sql_faccetta_meno(tabella, colonna)}{_sql_faccetta_piu(tabella, colonna)}
+                END
+            """)
+    ricostruisci_faccette(con)
+
+
+# Cubo ticket: chiavi (colonne di ticket, NULL → '' / 0) e misure pre-aggregate
+CHIAVI_CUBO = ["mese", "regione", "provincia_cliente", "tecnico_id", "tecnico_nome", "guasto", "azienda"]
+
+
+def _chiavi_cubo_riga(riga):
+    return [
+        f"COALESCE(substr({riga}.data_intervento, 1, 7), '')",
+        f"COALESCE({riga}.regione, '')",
+        f"COALESCE({riga}.provincia_cliente, '')",
+        f"COALESCE({riga}.tecnico_id, 0)",
+        f"COALESCE({riga}.tecnico_nome, '')",
+        f"COALESCE({riga}.guasto, '')",
+        f"COALESCE({riga}.azienda, '')",
+    ]
 
-    # TICKET
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS ticket (
-        id INTEGER PRIMARY KEY,
-        id_cliente INTEGER NOT NULL,
-        id_tecnico INTEGER,
-        id_prodotto INTEGER,                -- opzionale in futuro
-        problema TEXT NOT NULL,
-        stato TEXT NOT NULL DEFAULT 'Aperto',
-        referente TEXT,
-        data_creazione TEXT NOT NULL,
-        criticita TEXT DEFAULT 'Media',
-        data_intervento TEXT,               -- può rimanere NULL, si autoimposta su "in lavorazione" o "chiuso"
-        intervento_svolto TEXT,
-        allegato_nome TEXT,
-        allegato_percorso TEXT,
-        importo REAL,
-        extra_json TEXT DEFAULT '{}',
-        FOREIGN KEY (id_cliente) REFERENCES clienti (id) ON DELETE CASCADE,
-        FOREIGN KEY (id_tecnico) REFERENCES tecnici (id) ON DELETE SET NULL
+
+def _sql_cubo(riga, segno):
+    """UPSERT che somma (segno=+1) o toglie (segno=-1) la riga 'new'/'old' dal cubo."""
+    chiavi = ", ".join(CHIAVI_CUBO)
+    valori = ", ".join(_chiavi_cubo_riga(riga))
+    uguali = " AND ".join(f"{k} = {v}" for k, v in zip(CHIAVI_CUBO, _chiavi_cubo_riga(riga)))
+    sql = f"""
+            INSERT INTO ticket_cubo ({chiavi}, n, fatturato, aperti, chiusi)
+            SELECT {valori}, {segno}, {segno} * COALESCE(CAST({riga}.fattura AS REAL), 0),
+                   {segno} * ({riga}.stato IN ('Aperto', 'In lavorazione')), {segno} * ({riga}.stato = 'Chiuso')
+            WHERE 1
+            ON CONFLICT ({chiavi}) DO UPDATE SET
+                n = n + excluded.n,
+                fatturato = fatturato + excluded.fatturato,
+                aperti = aperti + excluded.aperti,
+                chiusi = chiusi + excluded.chiusi;"""
+    if segno < 0:
+        sql += f"""
+            DELETE FROM ticket_cubo WHERE {uguali} AND n <= 0;"""
+    return sql
+
+
+def ricostruisci_cubo_ticket(con):
+    con.execute("DELETE FROM ticket_cubo")
+    valori = ", ".join(_chiavi_cubo_riga("t"))
+    con.execute(f"""
+        INSERT INTO ticket_cubo ({", ".join(CHIAVI_CUBO)}, n, fatturato, aperti, chiusi)
+        SELECT {valori}, COUNT(*), SUM(COALESCE(CAST(t.fattura AS REAL), 0)),
+               SUM(t.stato IN ('Aperto', 'In lavorazione')), SUM(t.stato = 'Chiuso')
+        FROM ticket t
+        GROUP BY {valori}
+    """)
+
+
+def _migrazione_010_cubo_ticket(con):
+    """Riepilogo mese × regione × provincia × tecnico × guasto × azienda, tenuto da trigger."""
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS ticket_cubo (
+            mese TEXT NOT NULL,
+            regione TEXT NOT NULL,
+            provincia_cliente TEXT NOT NULL,
+            tecnico_id INTEGER NOT NULL,
+            tecnico_nome TEXT NOT NULL,
+            guasto TEXT NOT NULL,
+            azienda TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            fatturato REAL NOT NULL,
+            aperti INTEGER NOT NULL,
+            chiusi INTEGER NOT NULL,
+            PRIMARY KEY ({", ".join(CHIAVI_CUBO)})
+        ) WITHOUT ROWID
+    """)
+    colonne_aggiornate = "data_intervento, regione, provincia_cliente, tecnico_id, tecnico_nome, guasto, azienda, fattura, stato"
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS ticket_cubo_ai AFTER INSERT ON ticket BEGIN{_sql_cubo("new", 1)}
+        END
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS ticket_cubo_ad AFTER DELETE ON ticket BEGIN{_sql_cubo("old", -1)}
+        END
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS ticket_cubo_au AFTER UPDATE OF {colonne_aggiornate} ON ticket BEGIN{_sql_cubo("old", -1)}{_sql_cubo("new", 1)}
+        END
+    """)
+    ricostruisci_cubo_ticket(con)
+
+
+def _migrazione_011_clienti_fts(con):
+    """Indice trigram (external content su clienti) tenuto allineato da trigger."""
+    colonne = ", ".join(COLONNE_FTS_CLIENTI)
+    nuovi = ", ".join(f"new.{c}" for c in COLONNE_FTS_CLIENTI)
+    vecchi = ", ".join(f"old.{c}" for c in COLONNE_FTS_CLIENTI)
+    con.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS clienti_fts USING fts5(
+            {colonne},
+            content='clienti', content_rowid='id',
+            tokenize='trigram'
+        )
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS clienti_fts_ai AFTER INSERT ON clienti BEGIN
+            INSERT INTO clienti_fts(rowid, {colonne}) VALUES (new.id, {nuovi});
+        END
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS clienti_fts_ad AFTER DELETE ON clienti BEGIN
+            INSERT INTO clienti_fts(clienti_fts, rowid, {colonne}) VALUES ('delete', old.id, {vecchi});
+        END
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS clienti_fts_au AFTER UPDATE OF {colonne} ON clienti BEGIN
+            INSERT INTO clienti_fts(clienti_fts, rowid, {colonne}) VALUES ('delete', old.id, {vecchi});
+            INSERT INTO clienti_fts(rowid, {colonne}) VALUES (new.id, {nuovi});
+        END
+    """)
+    con.execute("INSERT INTO clienti_fts(clienti_fts) VALUES ('rebuild')")
+
+
+# Tabelle con attributi dinamici (intestazioni Excel sconosciute) in extra_json
+TABELLE_EXTRA = ("clienti", "tecnici", "ticket")
+
+
+def _migrazione_012_chiavi_extra(con):
+    """Registro delle chiavi extra_json promosse a colonne generate; extra_json sempre JSON valido."""
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS chiavi_extra (
+            tabella TEXT NOT NULL,
+            chiave TEXT NOT NULL,
+            colonna TEXT,                          -- colonna generata, NULL se non promossa
+            utilizzi INTEGER NOT NULL DEFAULT 0,   -- filtri fatti su questa chiave
+            PRIMARY KEY (tabella, chiave)
+        ) WITHOUT ROWID
+    """)
+    for tabella in TABELLE_EXTRA:
+        con.execute(f"""
+            UPDATE {tabella} SET extra_json = '{{}}'
+            WHERE extra_json IS NULL OR NOT json_valid(extra_json)
+        """)
+
+
+# Tabelle di riferimento ricaricate per intero da Excel: colonne dichiarate e
+# indici. Il nome indice porta la generazione (= versione tabella dopo l'import)
+# perché l'indice nuovo nasce sulla tabella ombra mentre quello vecchio esiste ancora.
+TABELLE_RIFERIMENTO = {
+    "codici_clienti": {
+        "colonne": ["codice", "ragione_sociale", "codice_IRI", "indirizzo", "citta",
+                    "provincia", "gruppo_commerciale", "sub_insegna", "insegna"],
+        "indici": {"codice": "(codice)"},
+    },
+    "province": {
+        "colonne": ["provincia", "regione"],
+        "indici": {"provincia": "(provincia)"},
+    },
+}
+
+
+def crea_indici_riferimento(con, tabella, su=None, generazione=0):
+    """Indici di TABELLE_RIFERIMENTO[tabella] sulla tabella 'su' (di default la stessa)."""
+    for nome, colonne in TABELLE_RIFERIMENTO[tabella]["indici"].items():
+        con.execute(
+            f'CREATE INDEX IF NOT EXISTS "idx_{tabella}_{nome}_{generazione}" ON "{su or tabella}" {colonne}'
+        )
+
+
+def _migrazione_013_indici_riferimento(con):
+    for tabella in TABELLE_RIFERIMENTO:
+        crea_indici_riferimento(con, tabella)
+
+
+def chiave_luogo(citta, provincia=None):
+    """Chiave di geocode_cache: 'CITTA|PROVINCIA' in maiuscolo, spazi compattati."""
+    return "|".join(
+        "" if v is None or pd.isna(v) else " ".join(str(v).split()).upper()
+        for v in (citta, provincia)
     )
+
+
+def _migrazione_014_geocode_cache(con):
+    """Cache persistente della geocodifica, inizializzata con le coordinate già in archivio."""
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            luogo TEXT PRIMARY KEY,        -- chiave_luogo(citta, provincia)
+            lat REAL,                      -- NULL: luogo non trovato
+            lon REAL,
+            fonte TEXT NOT NULL,           -- 'nominatim' o 'archivio'
+            aggiornato TEXT NOT NULL DEFAULT (datetime('now'))
+        ) WITHOUT ROWID
     """)
+    righe = {}
+    for tabella in ("clienti", "tecnici"):
+        for citta, provincia, lat, lon in con.execute(f"""
+            SELECT citta, provincia, lat, lon FROM {tabella}
+            WHERE TRIM(COALESCE(citta, '')) <> '' AND TRIM(COALESCE(provincia, '')) <> ''
+              AND lat IS NOT NULL AND lon IS NOT NULL
+              AND lat NOT IN ('', '0') AND lon NOT IN ('', '0')
+        """):
+            try:
+                righe.setdefault(chiave_luogo(citta, provincia), (float(lat), float(lon)))
+            except (TypeError, ValueError):
+                continue
+    con.executemany(
+        "INSERT OR IGNORE INTO geocode_cache (luogo, lat, lon, fonte) VALUES (?, ?, ?, 'archivio')",
+        [(luogo, lat, lon) for luogo, (lat, lon) in righe.items()]
+    )
+
+
+MIGRAZIONI = [
+    (1, "Schema base clienti/tecnici/ticket", _migrazione_001_schema_base),
+    (2, "Indici secondari ticket/clienti/tecnici", _migrazione_002_indici),
+    (3, "Ricerca full-text ticket (FTS5)", _migrazione_003_ticket_fts),
+    (4, "Ricerca trigram punti vendita", _migrazione_004_codici_fts),
+    (5, "Sequenza numeri ticket", _migrazione_005_sequenza_ticket),
+    (6, "Versioni tabelle per le cache", _migrazione_006_versioni_tabelle),
+    (7, "Indice lista ticket per stato", assicura_indici),
+    (8, "Indice ticket per data intervento", assicura_indici),
+    (9, "Faccette per le tendine di filtro", _migrazione_009_faccette),
+    (10, "Cubo riepilogo ticket", _migrazione_010_cubo_ticket),
+    (11, "Ricerca trigram anagrafica clienti", _migrazione_011_clienti_fts),
+    (12, "Registro campi extra (extra_json)", _migrazione_012_chiavi_extra),
+    (13, "Indici codici punti vendita e province", _migrazione_013_indici_riferimento),
+    (14, "Cache geocodifica città/provincia", _migrazione_014_geocode_cache),
+]
+SCHEMA_VERSIONE = MIGRAZIONI[-1][0]
+
+
+def migra_db(db_file=DB_FILE):
+    """Applica i passi di MIGRAZIONI non ancora registrati in PRAGMA user_version."""
+    con = get_connessione(db_file=db_file)
+    if con.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSIONE:
+        return
+    with transazione(db_file) as con:
+        # riletto sotto lock: un'altra sessione potrebbe aver già migrato
+        versione = con.execute("PRAGMA user_version").fetchone()[0]
+        for numero, descrizione, passo in MIGRAZIONI:
+            if numero > versione:
+                print(f"Migrazione DB {numero}: {descrizione}")
+                passo(con)
+                con.execute(f"PRAGMA user_version = {numero}")
+
+
+# Query che devono restare servite da un indice
+# (nome, SQL, parametri d'esempio, indice che il piano deve usare)
+QUERY_CANONICHE = [
+    ("Ticket aperti (sidebar/popup)", """
+        SELECT t.id, t.matricola, t.stato, t.data_creazione
+        FROM ticket t INDEXED BY idx_ticket_aperti
+        LEFT JOIN clienti c ON c.id = t.cliente_id
+        WHERE t.stato IN ('Aperto','In lavorazione')
+        ORDER BY t.data_creazione ASC, t.id ASC
+    """, (), "idx_ticket_aperti"),
+    ("Storico ticket per matricola", """
+        SELECT id FROM ticket WHERE matricola = ? ORDER BY data_creazione DESC
+    """, ("X",), "idx_ticket_matricola_data"),
+    ("Ticket per tecnico e stato", """
+        SELECT id FROM ticket WHERE tecnico_id = ? AND stato = ?
+    """, (1, "Aperto"), "idx_ticket_tecnico_stato"),
+    ("Lista ticket per stato (pagina)", """
+        SELECT id FROM ticket WHERE stato = ? AND id < ? ORDER BY id DESC LIMIT 51
+    """, ("Chiuso", 1000), "idx_ticket_stato_id"),
+    ("Conteggio ticket per stato", """
+        SELECT COUNT(*) FROM ticket WHERE stato = ?
+    """, ("Chiuso",), "idx_ticket_stato_id"),
+    ("Analisi ticket per periodo", """
+        SELECT COUNT(*), SUM(fattura) FROM ticket
+        WHERE data_intervento >= ? AND data_intervento < ?
+    """, ("2025-01-01", "2026-01-01"), "idx_ticket_data_intervento"),
+    ("Periodo interventi (min/max)", """
+        SELECT MIN(data_intervento) FROM ticket WHERE data_intervento > ''
+    """, (), "idx_ticket_data_intervento"),
+    ("Ultimi ticket (ricerca vuota)", """
+        SELECT id FROM ticket ORDER BY data_creazione DESC LIMIT 50
+    """, (), "idx_ticket_data_creazione"),
+    ("Clienti per provincia/città", """
+        SELECT id, codice FROM clienti WHERE provincia = ? AND citta = ?
+    """, ("MI", "Milano"), "idx_clienti_provincia_citta_codice"),
+    ("Clienti per regione", """
+        SELECT id FROM clienti WHERE regione = ?
+    """, ("Lombardia",), "idx_clienti_regione"),
+    ("Tecnici per regione", """
+        SELECT id, nome FROM tecnici WHERE regione = ? ORDER BY provincia
+    """, ("Lombardia",), "idx_tecnici_regione_provincia"),
+]
+
+
+def verifica_piani_query(db_file=DB_FILE):
+    """
+    EXPLAIN QUERY PLAN su QUERY_CANONICHE.
+    Ritorna la lista (nome query, problema) dei full scan di tabella, dei piani
+    che non usano l'indice atteso e delle query che non si preparano (indice
+    di un INDEXED BY mancante): lista vuota = nessuna regressione.
+    """
+    # connessione nuova: quelle del pool tengono in cache i piani già preparati
+    con = get_pool(db_file).nuova_connessione()
+    regressioni = []
+    try:
+        for nome, sql, params, indice in QUERY_CANONICHE:
+            try:
+                piano = [riga[-1] for riga in con.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+            except sqlite3.OperationalError as e:
+                regressioni.append((nome, str(e)))
+                continue
+            for dettaglio in piano:
+                if dettaglio.startswith("SCAN") and "USING" not in dettaglio:
+                    regressioni.append((nome, dettaglio))
+            if not any(f"INDEX {indice}" in dettaglio for dettaglio in piano):
+                regressioni.append((nome, f"indice {indice} non usato: {' / '.join(piano)}"))
+    finally:
+        con.close()
+    return regressioni
+
+
+# ==========================
+# CACHE DATI DI RIFERIMENTO
+# ==========================
+# Clienti, tecnici, guasti, ticket aperti... letti a ogni rerun da ogni sessione.
+# Una sola cache per processo, chiave = (nome, versioni delle tabelle lette):
+# ogni scrittura chiama incrementa_versione() nella sua transazione e le
+# letture successive non trovano più la chiave vecchia.
+CACHE_RIFERIMENTI_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _dimensione_bytes(valore):
+    if isinstance(valore, pd.DataFrame):
+        return int(valore.memory_usage(index=True, deep=True).sum())
+    if hasattr(valore, "nbytes"):
+        return int(valore.nbytes)
+    return len(pickle.dumps(valore, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class CacheRiferimenti:
+    """LRU thread-safe con tetto in byte e contatori hit/miss."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._voci = OrderedDict()  # chiave -> (valore, bytes)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hit = 0
+        self.miss = 0
+        self.evizioni = 0
+
+    def _rimuovi(self, chiave):
+        _, dimensione = self._voci.pop(chiave)
+        self.bytes -= dimensione
+
+    def get_or_build(self, nome, versioni, costruttore):
+        chiave = (nome, versioni)
+        with self._lock:
+            if chiave in self._voci:
+                self._voci.move_to_end(chiave)
+                self.hit += 1
+                return self._voci[chiave][0]
+            self.miss += 1
+
+        valore = costruttore()
+        dimensione = _dimensione_bytes(valore)
+
+        with self._lock:
+            # le versioni precedenti dello stesso dato non servono più
+            for vecchia in [k for k in self._voci if k[0] == nome and k != chiave]:
+                self._rimuovi(vecchia)
+            if dimensione > self.max_bytes:
+                return valore  # troppo grande: servito ma non tenuto
+            if chiave in self._voci:
+                self._rimuovi(chiave)
+            self._voci[chiave] = (valore, dimensione)
+            self.bytes += dimensione
+            while self.bytes > self.max_bytes:
+                self._rimuovi(next(iter(self._voci)))
+                self.evizioni += 1
+        return valore
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+            self.bytes = 0
+
+    def statistiche(self):
+        with self._lock:
+            totale = self.hit + self.miss
+            return {
+                "voci": len(self._voci),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hit": self.hit,
+                "miss": self.miss,
+                "hit_ratio": self.hit / totale if totale else 0.0,
+                "evizioni": self.evizioni,
+                "dettaglio": [(k[0], dict(k[1]), b) for k, (_, b) in self._voci.items()],
+            }
+
+
+@st.cache_resource
+def get_cache_riferimenti():
+    return CacheRiferimenti(CACHE_RIFERIMENTI_MAX_BYTES)
+
+
+def incrementa_versione(con, *tabelle):
+    """Da chiamare nella stessa transazione della scrittura sulle tabelle."""
+    con.executemany("""
+        INSERT INTO versioni_tabelle (tabella, versione) VALUES (?, 1)
+        ON CONFLICT (tabella) DO UPDATE SET versione = versione + 1
+    """, [(t,) for t in tabelle])
+
+
+def versioni_tabelle(*tabelle):
+    """Tupla ((tabella, versione), ...) nell'ordine richiesto; 0 se mai scritta."""
+    conn = get_connessione(sola_lettura=True)
+    segnaposti = ", ".join("?" * len(tabelle))
+    trovate = dict(conn.execute(
+        f"SELECT tabella, versione FROM versioni_tabelle WHERE tabella IN ({segnaposti})",
+        tabelle
+    ).fetchall())
+    return tuple((t, trovate.get(t, 0)) for t in tabelle)
+
+
+def carica_riferimento(nome, sql, tabelle, params=()):
+    """
+    DataFrame di 'sql' servito dalla cache condivisa finché nessuna delle
+    'tabelle' cambia versione. Ritorna una copia: il chiamante può modificarla.
+    """
+    def costruisci():
+        conn = get_connessione(sola_lettura=True)
+        return pd.read_sql_query(sql, conn, params=params)
+
+    chiave = (nome, tuple(params))
+    df = get_cache_riferimenti().get_or_build(chiave, versioni_tabelle(*tabelle), costruisci)
+    return df.copy()
+
+
+def faccetta(tabella, colonna):
+    """[(valore, conteggio), ...] ordinati per valore: costo pari ai soli valori distinti."""
+    conn = get_connessione(sola_lettura=True)
+    return conn.execute(
+        "SELECT valore, conteggio FROM faccette WHERE dimensione = ? ORDER BY valore",
+        (f"{tabella}.{colonna}",)
+    ).fetchall()
+
+
+def opzioni_faccetta(tabella, colonna, tutti=None):
+    """
+    (opzioni, format_func) per selectbox/multiselect: le opzioni restano i valori
+    veri, l'etichetta mostra anche quante righe li hanno.
+    """
+    righe = faccetta(tabella, colonna)
+    conteggi = dict(righe)
+    opzioni = ([tutti] if tutti else []) + [valore for valore, _ in righe]
+    return opzioni, lambda v: f"{v} ({conteggi[v]})" if v in conteggi else v
+
+
+def carica_guasti():
+    return carica_riferimento(
+        "critical",
+        "SELECT id, codice_guasto, guasto FROM critical ORDER BY codice_guasto ASC",
+        ("critical",)
+    )
+
+
+# --------------------------------
+# Campi extra (extra_json)
+# --------------------------------
+# Le intestazioni Excel che non sono colonne della tabella finiscono in
+# extra_json e si leggono con json_extract. Le chiavi filtrate spesso
+# diventano colonne generate VIRTUAL con indice (registro chiavi_extra):
+# le righe non si allargano a ogni import.
+SOGLIA_PROMOZIONE_EXTRA = 20   # filtri sulla stessa chiave prima di indicizzarla
+PREFISSO_EXTRA = "extra."      # nome delle colonne extra nei DataFrame degli editor
+
+
+def _sql_testo(testo):
+    return "'" + str(testo).replace("'", "''") + "'"
+
+
+def percorso_json(chiave):
+    return '$."' + chiave + '"'
+
+
+def sql_json_extra(chiave):
+    """json_extract della chiave; NULL anche se extra_json non è JSON valido."""
+    return (
+        "json_extract(CASE WHEN json_valid(extra_json) THEN extra_json END, "
+        f"{_sql_testo(percorso_json(chiave))})"
+    )
+
+
+def chiavi_promosse(tabella):
+    """{chiave: colonna generata} dal registro, in cache finché lo schema non cambia."""
+    conn = get_connessione(sola_lettura=True)
+    versione = conn.execute("PRAGMA schema_version").fetchone()[0]
+
+    def costruisci():
+        return dict(conn.execute(
+            "SELECT chiave, colonna FROM chiavi_extra WHERE tabella = ? AND colonna IS NOT NULL",
+            (tabella,)
+        ).fetchall())
+
+    return get_cache_riferimenti().get_or_build(
+        ("chiavi_promosse", tabella), (("schema", versione),), costruisci
+    )
+
+
+def espressione_extra(tabella, chiave):
+    """SQL che legge 'chiave': la colonna generata se promossa, altrimenti json_extract."""
+    colonna = chiavi_promosse(tabella).get(chiave)
+    return f'"{colonna}"' if colonna else sql_json_extra(chiave)
+
+
+def chiavi_extra(tabella):
+    """Chiavi presenti in extra_json di 'tabella' con il numero di righe che le hanno."""
+    return carica_riferimento(f"chiavi_extra_{tabella}", f"""
+        SELECT j.key AS chiave, COUNT(*) AS righe
+        FROM {tabella}, json_each(
+            CASE WHEN json_valid({tabella}.extra_json) THEN {tabella}.extra_json ELSE '{{}}' END
+        ) AS j
+        WHERE instr(j.key, '"') = 0
+        GROUP BY j.key
+        ORDER BY j.key
+    """, (tabella,))
+
+
+def colonne_extra_sql(tabella, chiavi, prefisso=PREFISSO_EXTRA):
+    """Voci di SELECT per le chiavi extra, con alias '<prefisso><chiave>'."""
+    return [f'{espressione_extra(tabella, k)} AS "{prefisso}{k}"' for k in chiavi]
+
+
+def promuovi_chiave_extra(con, tabella, chiave):
+    """Colonna generata VIRTUAL + indice per 'chiave', nella transazione del chiamante."""
+    esistenti = {r[1] for r in con.execute(f'PRAGMA table_xinfo("{tabella}")')}
+    base = "x_" + (re.sub(r"\W+", "_", chiave).strip("_").lower() or "campo")
+    colonna, n = base, 1
+    while colonna in esistenti:
+        n += 1
+        colonna = f"{base}_{n}"
+    con.execute(
+        f'ALTER TABLE "{tabella}" ADD COLUMN "{colonna}" '
+        f"GENERATED ALWAYS AS ({sql_json_extra(chiave)}) VIRTUAL"
+    )
+    con.execute(f'CREATE INDEX IF NOT EXISTS "idx_{tabella}_{colonna}" ON "{tabella}" ("{colonna}")')
+    con.execute("""
+        INSERT INTO chiavi_extra (tabella, chiave, colonna) VALUES (?, ?, ?)
+        ON CONFLICT (tabella, chiave) DO UPDATE SET colonna = excluded.colonna
+    """, (tabella, chiave, colonna))
+    return colonna
+
+
+def registra_uso_extra(tabella, chiave):
+    """Conta un filtro su 'chiave'; a SOGLIA_PROMOZIONE_EXTRA la chiave viene promossa."""
+    if chiave in chiavi_promosse(tabella):
+        return
+    with transazione() as con:
+        utilizzi, colonna = con.execute("""
+            INSERT INTO chiavi_extra (tabella, chiave, utilizzi) VALUES (?, ?, 1)
+            ON CONFLICT (tabella, chiave) DO UPDATE SET utilizzi = utilizzi + 1
+            RETURNING utilizzi, colonna
+        """, (tabella, chiave)).fetchone()
+        if colonna is None and utilizzi >= SOGLIA_PROMOZIONE_EXTRA:
+            promuovi_chiave_extra(con, tabella, chiave)
+
+
+def colonne_editor(tabella):
+    """Colonne scrivibili di 'tabella' (PRAGMA table_info: niente colonne generate) senza extra_json."""
+    return [c for c in tipi_colonne(get_connessione(sola_lettura=True), tabella) if c != "extra_json"]
+
+
+def carica_tabella_editor(tabella, extra=()):
+    """Righe per st.data_editor: colonne scrivibili + le chiavi extra scelte come 'extra.<chiave>'."""
+    voci = [f'"{c}"' for c in colonne_editor(tabella)] + colonne_extra_sql(tabella, extra)
+    return carica_riferimento(
+        f"editor_{tabella}:{','.join(extra)}",
+        f'SELECT {", ".join(voci)} FROM "{tabella}"',
+        (tabella,)
+    )
+
 
-    # Migrazioni leggere: aggiungi colonne se mancano
-    def ensure_column(table, col_def):
-        # col_def: "nome_colonna TIPO DEFAULT '...'"
-        col_name = col_def.split()[0]
-        info = cur.execute(f"PRAGMA table_info({table})").fetchall()
-        existing = {r['name'] for r in info}
-        if col_name not in existing:
-            cur.execute(f"ALTER TABLE {table} ADD COLUMN {col_def}")
-
-    # Clienti
-    ensure_column("clienti", "extra_json TEXT DEFAULT '{}'")
-    # Tecnici
-    ensure_column("tecnici", "extra_json TEXT DEFAULT '{}'")
-
-    # Ticket (in caso di DB vecchio)
-    ensure_column("ticket", "data_intervento TEXT")
-    ensure_column("ticket", "intervento_svolto TEXT")
-    ensure_column("ticket", "allegato_nome TEXT")
-    ensure_column("ticket", "allegato_percorso TEXT")
-    ensure_column("ticket", "extra_json TEXT DEFAULT '{}'")
-
-    con.commit()
-    con.close()
+def sql_export_tabella(tabella, ordine="id DESC"):
+    """SELECT per l'export: colonne vere e una colonna per ogni chiave extra (al posto di extra_json)."""
+    vere = colonne_editor(tabella)
+    extra = [k for k in chiavi_extra(tabella)["chiave"] if k not in vere]
+    voci = [f'"{c}"' for c in vere] + colonne_extra_sql(tabella, extra, prefisso="")
+    return f'SELECT {", ".join(voci)} FROM "{tabella}" ORDER BY {ordine}'
+
+# CHIAMA SUBITO QUESTA FUNZIONE A INIZIO APP
+migra_db()
+# -------------------------------
+# Utility DB
+# -------------------------------
+
+def connetti_db():
+    """Connessione condivisa (pool) con foreign_keys attive."""
+    return get_connessione()
 
 def get_all(table, order_by="id DESC"):
-    con = connetti_db()
-    rows = con.execute(f"SELECT * FROM {table} ORDER BY {order_by}").fetchall()
-    con.close()
-    return rows
+    cur = get_connessione(sola_lettura=True).cursor()
+    cur.row_factory = sqlite3.Row
+    return cur.execute(f"SELECT * FROM {table} ORDER BY {order_by}").fetchall()
 
 def to_safe_date_str(d):
     """Converte in 'YYYY-MM-DD' se possibile, altrimenti None."""
@@ -291,6 +1170,54 @@ def ensure_json(obj):
     except Exception:
         return {}
     
+# --------------------------------
+# Import tabelle di riferimento (codici punti vendita, province)
+# --------------------------------
+def normalizza_codici(df):
+    """'codice' come testo senza spazi; i codici solo numerici a 8 cifre con zeri iniziali."""
+    if "codice" in df.columns:
+        codice = df["codice"].astype("string").str.strip()
+        df["codice"] = codice.mask(codice.str.isdigit().fillna(False), codice.str.zfill(8))
+    return df
+
+
+def sostituisci_tabella_riferimento(tabella, df, db_file=DB_FILE):
+    """
+    Sostituisce per intero una tabella di TABELLE_RIFERIMENTO con le righe di 'df'.
+    Righe e indici vanno prima in una tabella ombra, poi DROP + RENAME nella
+    stessa transazione: chi legge vede la tabella vecchia o quella nuova già
+    indicizzata, mai vuota o a metà. Le intestazioni si confrontano senza
+    badare a maiuscole; colonne del file non dichiarate restano come TEXT.
+    """
+    dichiarate = TABELLE_RIFERIMENTO[tabella]["colonne"]
+    per_nome = {c.lower(): c for c in dichiarate}
+    df = df.rename(columns=lambda c: per_nome.get(str(c).strip().lower(), str(c).strip()))
+    df = df.loc[:, ~df.columns.str.lower().duplicated()]
+    colonne = dichiarate + [c for c in df.columns if c.lower() not in per_nome]
+    df = df.reindex(columns=colonne).astype(object)
+    righe = df.where(df.notna(), None).itertuples(index=False, name=None)
+
+    ombra = f"{tabella}__nuova"
+    elenco = ", ".join(f'"{c}"' for c in colonne)
+    definizione = ", ".join(f'"{c}" TEXT' for c in colonne)
+    with transazione(db_file) as con:
+        generazione = con.execute(
+            "SELECT COALESCE(MAX(versione), 0) + 1 FROM versioni_tabelle WHERE tabella = ?", (tabella,)
+        ).fetchone()[0]
+        con.execute(f'DROP TABLE IF EXISTS "{ombra}"')
+        con.execute(f'CREATE TABLE "{ombra}" ({definizione})')
+        con.executemany(
+            f'INSERT INTO "{ombra}" ({elenco}) VALUES ({", ".join("?" * len(colonne))})', righe
+        )
+        crea_indici_riferimento(con, tabella, su=ombra, generazione=generazione)
+        con.execute(f'DROP TABLE "{tabella}"')
+        con.execute(f'ALTER TABLE "{ombra}" RENAME TO "{tabella}"')
+        if tabella == "codici_clienti":
+            ricostruisci_codici_fts(con)
+        incrementa_versione(con, tabella)
+    return len(df)
+
+
 def importa_codici_excel(db_path="C:/assistenza-app/assistenza.db", excel_name="codici.xlsx"):
     """
     Importa i codici dal file Excel 'codici.xlsx' presente
@@ -307,17 +1234,126 @@ def importa_codici_excel(db_path="C:/assistenza-app/assistenza.db", excel_name="
         raise FileNotFoundError(f"❌ File Excel non trovato: {excel_path}")
 
     # leggo l'excel
-    df = pd.read_excel(excel_path, dtype={"codice": str})
+    df = normalizza_codici(pd.read_excel(excel_path, dtype=str))
 
     # scrivo su DB
-    conn = sqlite3.connect(db_path)
-    try:
-        df.to_sql("codici_clienti", conn, if_exists="replace", index=False)
-    finally:
-        conn.close()
+    sostituisci_tabella_riferimento("codici_clienti", df, db_file=db_path)
 
     print(f"✅ Importati {len(df)} record da {excel_path} in tabella 'codici_clienti'")
 
+# --------------------------------
+# Export in streaming (Excel write-only / CSV)
+# --------------------------------
+# Le righe passano dal cursore SQL al file un blocco alla volta: niente
+# DataFrame intermedio e nessun file nella cartella di lavoro.
+EXPORT_BLOCCO_RIGHE = 1000
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+FORMATI_EXCEL = {
+    "euro": '#,##0.00 "€"',
+    "data": "DD/MM/YYYY",
+    "data_ora": "DD/MM/YYYY HH:MM",
+}
+
+FORMATI_TICKET = {
+    "fattura": "euro",
+    "data_intervento": "data",
+    "data_creazione": "data_ora",
+}
+
+
+def _valore_excel(valore, formato):
+    """Converte il testo del DB nel tipo nativo Excel previsto dal formato."""
+    if valore is None or valore == "":
+        return None
+    try:
+        if formato == "euro":
+            return float(valore)
+        if formato == "data":
+            return date.fromisoformat(str(valore)[:10])
+        if formato == "data_ora":
+            return datetime.fromisoformat(str(valore)[:19])
+    except ValueError:
+        pass
+    return valore
+
+
+def cursore_export(sql, params=()):
+    """(colonne, righe) con le righe lette a blocchi da un cursore in sola lettura."""
+    conn = get_connessione(sola_lettura=True)
+    cur = conn.execute(sql, params)
+    colonne = [d[0] for d in cur.description]
+
+    def righe():
+        while True:
+            blocco = cur.fetchmany(EXPORT_BLOCCO_RIGHE)
+            if not blocco:
+                return
+            yield from blocco
+
+    return colonne, righe()
+
+
+def excel_da_righe(colonne, righe, formati=None, foglio="Dati"):
+    """Scrive le righe in un workbook openpyxl write-only e restituisce i byte .xlsx."""
+    formati = formati or {}
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(foglio)
+    ws.freeze_panes = "A2"
+
+    intestazione = []
+    for nome in colonne:
+        cella = WriteOnlyCell(ws, value=nome)
+        cella.font = Font(bold=True)
+        intestazione.append(cella)
+    ws.append(intestazione)
+
+    # posizione → formato, solo per le colonne che ne hanno uno
+    da_formattare = [(i, formati[c]) for i, c in enumerate(colonne) if c in formati]
+    for riga in righe:
+        if da_formattare:
+            riga = list(riga)
+            for i, formato in da_formattare:
+                cella = WriteOnlyCell(ws, value=_valore_excel(riga[i], formato))
+                cella.number_format = FORMATI_EXCEL[formato]
+                riga[i] = cella
+        ws.append(riga)
+
+    buffer = BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def blocchi_csv(colonne, righe, separatore=","):
+    """Generatore di blocchi CSV già codificati in UTF-8, intestazione inclusa."""
+    testo = StringIO()
+    writer = csv.writer(testo, delimiter=separatore, lineterminator="\n")
+    writer.writerow(colonne)
+    for n, riga in enumerate(righe, 1):
+        writer.writerow(riga)
+        if n % EXPORT_BLOCCO_RIGHE == 0:
+            yield testo.getvalue().encode("utf-8")
+            testo.seek(0)
+            testo.truncate()
+    yield testo.getvalue().encode("utf-8")
+
+
+def csv_da_righe(colonne, righe, separatore=","):
+    buffer = BytesIO()
+    for blocco in blocchi_csv(colonne, righe, separatore):
+        buffer.write(blocco)
+    return buffer.getvalue()
+
+
+def esporta_excel(sql, params=(), formati=None, foglio="Dati"):
+    colonne, righe = cursore_export(sql, params)
+    return excel_da_righe(colonne, righe, formati, foglio)
+
+
+def esporta_csv(sql, params=(), separatore=","):
+    colonne, righe = cursore_export(sql, params)
+    return csv_da_righe(colonne, righe, separatore)
+
 # --------------------------------
 # Import/Export helpers
 # --------------------------------
@@ -343,24 +1379,55 @@ def normalize_headers(cols):
         norm.append(base)
     return norm
 
+def json_compatto(obj):
+    """JSON senza spazi, UTF-8 leggibile; orjson se installato. Tipi ignoti → str."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def colonne_date_iso(df):
+    """Colonne data → 'YYYY-MM-DD' una colonna alla volta (come to_safe_date_str)."""
+    df = df.copy()
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            df[col] = serie.dt.strftime("%Y-%m-%d").astype(object).where(serie.notna(), None)
+        elif serie.dtype == object:
+            date_ = serie.map(lambda v: isinstance(v, (datetime, date)))
+            if date_.any():
+                df[col] = serie.mask(date_, serie[date_].map(lambda v: v.strftime("%Y-%m-%d")))
+    return df
+
+
+def impacchetta_extra(df):
+    """extra_json per ogni riga di 'df' (colonne = chiavi): solo le celle non vuote."""
+    if df.shape[1] == 0:
+        return ["{}"] * len(df)
+    df = colonne_date_iso(df)
+    df = df.astype(object).where(df.notna(), None)
+    return [
+        json_compatto({k: v for k, v in record.items() if v is not None})
+        for record in df.to_dict("records")
+    ]
+
+
 def split_known_and_extra(df, known_cols):
-    """Divide DF in (known_dict, extra_dict) per riga, restituendo lista di dict per INSERT."""
+    """
+    Divide DF in colonne note e extra_json, per colonne. Ritorna (colonne, righe):
+    'colonne' sono le note presenti nel file + "extra_json", 'righe' le tuple
+    pronte per executemany. In extra_json finiscono solo le celle non vuote.
+    """
     df = df.copy()
     df.columns = normalize_headers(df.columns)
-    records = []
-    for _, row in df.iterrows():
-        row_dict = {k: row.get(k, None) for k in df.columns}
-        known = {k: row_dict.get(k) for k in known_cols if k in row_dict}
-        extra_items = {k: row_dict[k] for k in row_dict.keys() if k not in known_cols}
-        # serializza eventuali Timestamp in stringa
-        for k, v in list(known.items()):
-            if isinstance(v, (pd.Timestamp, datetime, date)):
-                known[k] = to_safe_date_str(v)
-        for k, v in list(extra_items.items()):
-            if isinstance(v, (pd.Timestamp, datetime, date)):
-                extra_items[k] = to_safe_date_str(v)
-        records.append((known, extra_items))
-    return records
+
+    known = [c for c in df.columns if c in known_cols and c != "extra_json"]
+    extra = [c for c in df.columns if c not in known_cols]
+
+    note = colonne_date_iso(df[known])
+    note = note.astype(object).where(note.notna(), None)
+    righe = list(zip(*(note[c] for c in known), impacchetta_extra(df[extra])))
+    return known + ["extra_json"], righe
              ## NOTICE TICKET APERTI# 
 # Assicura che DB_PATH esista (adatta il valore se il tuo nome è diverso)
 #try:
@@ -368,40 +1435,82 @@ def split_known_and_extra(df, known_cols):
 #except NameError:
 DB_PATH = "assistenza.db"
     
+# Ogni quanti secondi il badge in sidebar ricontrolla i ticket aperti
+BADGE_TICKET_SECONDI = 30
+
+SQL_TICKET_APERTI = """
+    SELECT
+        t.id,
+        COALESCE(t.matricola, c.matricola, '') AS matricola,
+        COALESCE(t.azienda, c.azienda, '') AS azienda,
+        t.indirizzo_cliente,
+        t.citta_cliente,
+        t.provincia_cliente,
+        COALESCE(t.tecnico_nome, '') AS tecnico_nome,
+        t.descrizione,
+        t.stato,
+        t.data_creazione
+    FROM ticket t INDEXED BY idx_ticket_aperti
+    LEFT JOIN clienti c ON c.id = t.cliente_id
+    WHERE t.stato IN ('Aperto','In lavorazione')
+    ORDER BY t.data_creazione ASC, t.id ASC  -- FIFO
+"""
+# INDEXED BY: senza, il planner sceglie idx_ticket_stato_id + sort in una
+# B-tree temporanea; l'indice parziale dà solo i pendenti, già in ordine FIFO.
+
+
+class SnapshotTicketAperti:
+    """
+    Elenco dei ticket aperti/in lavorazione condiviso da tutte le sessioni.
+    Su una connessione dedicata PRAGMA data_version cambia solo quando un'altra
+    connessione (di questo o di un altro processo) fa commit: finché resta uguale
+    la rilettura costa una PRAGMA. Se è cambiato, si rilegge la query solo se
+    sono cambiate le versioni di ticket/clienti (vedi incrementa_versione).
+    """
+
+    def __init__(self, db_file):
+        self._con = get_pool(db_file).nuova_connessione(sola_lettura=True, tra_thread=True)
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._versioni = None
+        self._df = None
+
+    def _aggiorna(self):
+        data_version = self._con.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        versioni = tuple(self._con.execute(
+            "SELECT tabella, versione FROM versioni_tabelle WHERE tabella IN ('ticket', 'clienti') ORDER BY tabella"
+        ).fetchall())
+        if versioni != self._versioni or self._df is None:
+            self._df = pd.read_sql_query(SQL_TICKET_APERTI, self._con)
+            self._versioni = versioni
+        self._data_version = data_version
+
+    def dati(self):
+        """DataFrame FIFO (più vecchio in cima): condiviso, non modificarlo."""
+        with self._lock:
+            self._aggiorna()
+            return self._df
+
+    def conteggio(self):
+        return len(self.dati())
+
+
+@st.cache_resource
+def get_snapshot_ticket_aperti(db_file=DB_FILE):
+    return SnapshotTicketAperti(db_file)
+
+
 def get_ticket_aperti(limit=200):
     """
-    Recupera i ticket con stato 'Aperto' o 'In lavorazione'.
+    Ticket con stato 'Aperto' o 'In lavorazione', più recenti in cima.
     Ritorna un DataFrame (puoi usare limit per non caricare troppi record).
     """
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        df = pd.read_sql_query(
-            """
-            SELECT
-                t.id,
-                t.matricola,
-                COALESCE(t.azienda, c.azienda, '') AS azienda,
-                COALESCE(t.tecnico_nome, '') AS tecnico_nome,
-                t.descrizione,
-                t.stato,
-                t.data_creazione
-            FROM ticket t
-            LEFT JOIN clienti c ON c.id = t.cliente_id
-            WHERE t.stato IN ('Aperto','In lavorazione')
-            ORDER BY datetime(t.data_creazione) DESC
-            LIMIT ?
-            """,
-            conn,
-            params=(limit,)
-        )
-    finally:
-        conn.close()
-
-    # sicurezza: assicurati che le colonne esistano anche se vuote
-    for col in ["id","matricola","azienda","tecnico_nome","descrizione","stato","data_creazione"]:
-        if col not in df.columns:
-            df[col] = ""
-    return df
+    df = get_snapshot_ticket_aperti().dati()
+    return df.iloc[::-1].head(limit)[
+        ["id", "matricola", "azienda", "tecnico_nome", "descrizione", "stato", "data_creazione"]
+    ].reset_index(drop=True)
 
 def mostra_popup_ticket_aperti(df_open):
     """
@@ -465,30 +1574,37 @@ with st.sidebar:
     menu = st.radio("Scegli la sezione:", menu_options, index=0)
 
 
-    # Ticket aperti
-    try:
-        df_open = get_ticket_aperti(limit=300)
-        if not df_open.empty:
-            if st.button("🔔 Ticket aperti"):
+    # Ticket aperti: il badge si aggiorna da solo senza rieseguire la pagina
+    def badge_ticket_aperti():
+        try:
+            n_aperti = get_snapshot_ticket_aperti().conteggio()
+        except Exception as e:
+            st.error(f"Errore nel recupero ticket aperti: {e}")
+            return
+        if n_aperti:
+            if st.button(f"🔔 Ticket aperti ({n_aperti})"):
                 st.session_state["open_tickets_seen"] = False  # forza riapertura
-    except Exception as e:
-        st.error(f"Errore nel recupero ticket aperti: {e}")
-        df_open = pd.DataFrame()  # fallback vuoto
+                st.rerun()  # dentro un fragment: riesegue tutta l'app per il popup
+
+    if hasattr(st, "fragment"):
+        st.fragment(run_every=BADGE_TICKET_SECONDI)(badge_ticket_aperti)()
+    else:
+        badge_ticket_aperti()
 
 
 # ==========================
 # MOSTRA POPUP UNA SOLA VOLTA
 # ==========================
-if not df_open.empty:
-    if not st.session_state.get("open_tickets_seen", False):
+if not st.session_state.get("open_tickets_seen", False):
+    try:
+        df_open = get_ticket_aperti(limit=300)
+    except Exception:
+        df_open = pd.DataFrame()  # errore già segnalato dal badge
+    if not df_open.empty:
         mostra_popup_ticket_aperti(df_open)
         st.session_state["open_tickets_seen"] = True
 
 
-# --------------------------------
-# Avvio: crea/migra DB
-# --------------------------------
-crea_o_migra_db()
 # 📄 Pagina CLIENTI 
 
 DB_FILE = "assistenza.db"  # 🔹 modifica con il tuo path al DB
@@ -496,68 +1612,252 @@ DB_FILE = "assistenza.db"  # 🔹 modifica con il tuo path al DB
 # -------------------------
 # Funzione di importazione dinamica
 # -------------------------
+IMPORT_BLOCCO_RIGHE = 5000
+
+
+def blocchi_excel(file, blocco=IMPORT_BLOCCO_RIGHE):
+    """
+    (intestazione, generatore di DataFrame da 'blocco' righe) del primo foglio,
+    letto con openpyxl in sola lettura: il file non viene mai caricato tutto.
+    Le righe completamente vuote sono saltate.
+    """
+    wb = load_workbook(file, read_only=True, data_only=True)
+    righe = wb.worksheets[0].iter_rows(values_only=True)
+    intestazione = [str(c).strip() if c is not None else "" for c in next(righe, ())]
+
+    def blocchi():
+        try:
+            buffer = []
+            for riga in righe:
+                if any(v is not None for v in riga):
+                    buffer.append(riga[:len(intestazione)])
+                if len(buffer) == blocco:
+                    yield pd.DataFrame(buffer, columns=intestazione)
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame(buffer, columns=intestazione)
+        finally:
+            wb.close()
+
+    return intestazione, blocchi()
+
+
+def _colonna_sql(serie, tipo):
+    """Valori pronti per sqlite3 secondo l'affinità della colonna (vuoti → None)."""
+    valori = serie.astype(object)
+    if "INT" in tipo or "REAL" in tipo or "FLOA" in tipo or "DOUB" in tipo:
+        numeri = pd.to_numeric(serie, errors="coerce")
+        ok = numeri.notna()
+        if "INT" in tipo:
+            ok &= numeri % 1 == 0
+            numeri = numeri[ok].astype("int64")
+        # il testo non numerico resta com'è (SQLite lo salva come TEXT)
+        valori = valori.mask(ok, numeri.astype(object))
+    elif pd.api.types.is_datetime64_any_dtype(serie):
+        valori = serie.dt.strftime("%Y-%m-%d %H:%M:%S").astype(object)
+    else:
+        date_excel = valori.map(lambda v: isinstance(v, (datetime, date)))
+        if date_excel.any():
+            valori = valori.mask(date_excel, valori[date_excel].map(lambda v: v.isoformat(" ")))
+    return valori.where(serie.notna(), None)
+
+
+def _chiave_conflitto(cur, table_name, table_info):
+    """Colonne del primo indice UNIQUE della tabella, altrimenti la PRIMARY KEY."""
+    cur.execute(f"PRAGMA index_list({table_name})")
+    for idx in cur.fetchall():
+        if idx[2]:  # se è UNIQUE
+            cur.execute(f"PRAGMA index_info({idx[1]})")
+            return [r[2] for r in cur.fetchall()]
+    return [row[1] for row in table_info if row[5] == 1]  # row[5] = PK flag
+
+
 def import_excel_dynamic(conn, table_name, file):
     """
     Importa un file Excel dentro la tabella SQLite.
     Se trova un vincolo UNIQUE/PRIMARY KEY, aggiorna invece di dare errore.
+    Le intestazioni che non sono colonne della tabella vanno in extra_json
+    (unite a quelle già presenti in caso di update), senza ALTER TABLE.
+    Il foglio è letto e scritto a blocchi (executemany) nella transazione del
+    chiamante. Ritorna (inseriti, aggiornati): le righe finite in DO NOTHING
+    non contano, una chiave ripetuta nel file conta per ogni update eseguito.
     """
-
-    # Carica Excel in DataFrame
-    df = pd.read_excel(file)
-
-    # Rimuove eventuali spazi nei nomi colonne
-    df.columns = [c.strip() for c in df.columns]
+    intestazione, blocchi = blocchi_excel(file)
 
     cur = conn.cursor()
 
-    # Otteniamo le colonne della tabella
+    # Otteniamo le colonne della tabella (e i tipi, dalla cache)
     cur.execute(f"PRAGMA table_info({table_name})")
     table_info = cur.fetchall()
-    table_cols = [row[1] for row in table_info]
+    tipi = tipi_colonne(conn, table_name)
+
+    # Colonne comuni (per nome esatto o normalizzato, la prima se ripetuta),
+    # il resto diventa chiave di extra_json; si lavora per posizione nel foglio
+    colonne, pos_colonne, extra, pos_extra = [], [], [], []
+    for i, (grezza, norm) in enumerate(zip(intestazione, normalize_headers(intestazione))):
+        col = grezza if grezza in tipi else norm if norm in tipi else None
+        if col == "extra_json" or (col is None and not grezza):
+            continue
+        if col is None:
+            extra.append(norm)
+            pos_extra.append(i)
+        elif col not in colonne:
+            colonne.append(col)
+            pos_colonne.append(i)
+
+    if not colonne:
+        blocchi.close()
+        raise ValueError("⚠️ Nessuna colonna del file corrisponde alla tabella.")
 
-    # Filtriamo solo le colonne comuni
-    df = df[[c for c in df.columns if c in table_cols]]
+    unique_cols = _chiave_conflitto(cur, table_name, table_info)
+    if not unique_cols:
+        blocchi.close()
+        raise ValueError(f"⚠️ La tabella {table_name} non ha UNIQUE o PRIMARY KEY.")
 
-    if df.empty:
-        raise ValueError("⚠️ Nessuna colonna del file corrisponde alla tabella.")
+    # Costruiamo query dinamica
+    aggiornamenti = [f"{col}=excluded.{col}" for col in colonne if col not in unique_cols]
+    colonne_insert = colonne + (["extra_json"] if extra else [])
+    if extra:
+        aggiornamenti.append(
+            "extra_json=json_patch(CASE WHEN json_valid(extra_json) THEN extra_json ELSE '{}' END, excluded.extra_json)"
+        )
+    update_clause = ", ".join(aggiornamenti)
+    sql = f"""
+    INSERT INTO {table_name} ({", ".join(colonne_insert)})
+    VALUES ({", ".join(["?"] * len(colonne_insert))})
+    ON CONFLICT({", ".join(unique_cols)}) DO {"UPDATE SET " + update_clause if update_clause else "NOTHING"}
+    """
 
-    # Troviamo chiavi uniche o primary key
-    cur.execute(f"PRAGMA index_list({table_name})")
-    indexes = cur.fetchall()
+    # rowcount dell'UPSERT = insert + update eseguiti (DO NOTHING e trigger esclusi);
+    # inseriti = righe in più a fine import
+    prima = cur.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    scritte = 0
+    for df in blocchi:
+        valori = [_colonna_sql(df.iloc[:, i], tipi[c]) for i, c in zip(pos_colonne, colonne)]
+        if extra:
+            df_extra = df.iloc[:, pos_extra]
+            df_extra.columns = extra
+            valori.append(impacchetta_extra(df_extra))
+        cur.executemany(sql, zip(*valori))
+        scritte += max(cur.rowcount, 0)
+    inseriti = cur.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0] - prima
+    return inseriti, scritte - inseriti
 
-    unique_cols = []
-    for idx in indexes:
-        if idx[2]:  # se è UNIQUE
-            cur.execute(f"PRAGMA index_info({idx[1]})")
-            unique_cols = [r[2] for r in cur.fetchall()]
-            break
 
-    # Se non esiste UNIQUE, usiamo la primary key
-    if not unique_cols:
-        pk_cols = [row[1] for row in table_info if row[5] == 1]  # row[5] = PK flag
-        unique_cols = pk_cols
+# -------------------------
+# Upload ticket da Excel
+# -------------------------
+# Colonne testo copiate dal file così come sono (vuoto se mancanti)
+COLONNE_UPLOAD_TICKET_TESTO = [
+    "modello", "note", "intervento_svolto", "allegato", "contatto", "regione", "guasto",
+    "tecnico_nome", "citta_tecnico", "provincia_tecnico", "numero_ticket",
+    "azienda", "indirizzo_cliente", "citta_cliente", "provincia_cliente",
+]
+COLONNE_UPLOAD_TICKET = [
+    "matricola", "modello", "cliente_id", "descrizione", "fattura", "note", "data_intervento",
+    "intervento_svolto", "stato", "allegato", "contatto", "regione", "guasto",
+    "tecnico_nome", "citta_tecnico", "provincia_tecnico", "numero_ticket",
+    "azienda", "indirizzo_cliente", "citta_cliente", "provincia_cliente",
+    "data_creazione", "extra_json",
+]
+
+
+def testo_excel(serie):
+    """Colonna Excel → testo: vuoti → "", numeri interi senza ".0"."""
+    testo = serie.astype(str)
+    if pd.api.types.is_float_dtype(serie):
+        numeri = serie
+    else:
+        # colonne miste: solo le celle numeriche (non il testo "12.0")
+        numeri = pd.to_numeric(serie.where(serie.map(type) == float), errors="coerce")
+    interi = numeri.notna() & (numeri % 1 == 0)
+    testo = testo.mask(interi, numeri[interi].astype("int64").astype(str))
+    return testo.where(serie.notna(), "")
 
-    if not unique_cols:
-        raise ValueError(f"⚠️ La tabella {table_name} non ha UNIQUE o PRIMARY KEY.")
 
-    # Costruiamo query dinamica
-    cols = ", ".join(df.columns)
-    placeholders = ", ".join(["?"] * len(df.columns))
-    update_clause = ", ".join([f"{col}=excluded.{col}" for col in df.columns if col not in unique_cols])
-    conflict_cols = ", ".join(unique_cols)
+def date_iso_excel(serie):
+    """
+    Versione vettoriale di to_safe_date_str per una colonna Excel: datetime,
+    seriali Excel (numeri) e testo → 'YYYY-MM-DD', None se vuota/non valida.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        date_ = serie
+    elif pd.api.types.is_numeric_dtype(serie):
+        date_ = pd.to_datetime(serie, origin="1899-12-30", unit="D", errors="coerce")
+    else:
+        numeri = serie.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool))
+        date_ = pd.to_datetime(serie.where(~numeri), errors="coerce", format="mixed")
+        if numeri.any():
+            seriali = pd.to_datetime(
+                pd.to_numeric(serie.where(numeri), errors="coerce"),
+                origin="1899-12-30", unit="D", errors="coerce"
+            )
+            date_ = date_.fillna(seriali)
+    return date_.dt.strftime("%Y-%m-%d").astype(object).where(date_.notna(), None)
 
-    sql = f"""
-    INSERT INTO {table_name} ({cols})
-    VALUES ({placeholders})
-    ON CONFLICT({conflict_cols}) DO UPDATE SET
-    {update_clause};
+
+def prepara_ticket_excel(df, numeri_esistenti):
     """
+    Normalizza il foglio ticket (intestazioni già normalizzate) colonna per colonna.
+    Ritorna (righe da inserire con COLONNE_UPLOAD_TICKET, scarti con 'riga_excel'
+    e 'motivo'). Un numero_ticket già in 'numeri_esistenti' o ripetuto nel
+    file (dopo la prima volta) è un duplicato. Le colonne che ticket non ha
+    vanno in extra_json.
+    """
+    vuota = pd.Series("", index=df.index)
+
+    def colonna(nome):
+        return df[nome] if nome in df.columns else pd.Series(None, index=df.index, dtype=object)
+
+    out = pd.DataFrame(index=df.index)
+    out["matricola"] = testo_excel(colonna("matricola")).str.strip()
+    out["descrizione"] = testo_excel(colonna("descrizione")).str.strip()
+    for nome in COLONNE_UPLOAD_TICKET_TESTO:
+        out[nome] = testo_excel(df[nome]) if nome in df.columns else vuota
+    out["stato"] = testo_excel(colonna("stato")).replace("", "Aperto")
+    out["fattura"] = pd.to_numeric(colonna("fattura"), errors="coerce").fillna(0)
+    id_cliente = pd.to_numeric(colonna("cliente_id"), errors="coerce")
+    out["cliente_id"] = id_cliente.astype("Int64").astype(object).where(id_cliente.notna(), None)
+    out["data_intervento"] = date_iso_excel(colonna("data_intervento"))
+    # Data creazione: se presente nel file la usiamo, altrimenti ora
+    out["data_creazione"] = date_iso_excel(colonna("data_creazione")).fillna(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+    sconosciute = [c for c in df.columns if c not in COLONNE_TICKET and c != "id"]
+    out["extra_json"] = impacchetta_extra(df[sconosciute])
+
+    mancanti = (out["matricola"] == "") | (out["descrizione"] == "")
+    valide = ~mancanti
+    gia_presenti = valide & out["numero_ticket"].isin(numeri_esistenti)
+    ripetuti = valide & ~gia_presenti & out["numero_ticket"].where(valide).duplicated()
+
+    motivo = pd.Series(None, index=df.index, dtype=object)
+    motivo[mancanti] = "matricola o descrizione mancante"
+    motivo[gia_presenti] = "numero_ticket già presente"
+    motivo[ripetuti] = "numero_ticket ripetuto nel file"
 
-    # Inseriamo/aggiorniamo riga per riga
-    for _, row in df.iterrows():
-        cur.execute(sql, tuple(row))
+    scarti = df[motivo.notna()].copy()
+    scarti.insert(0, "riga_excel", scarti.index + 2)  # +1 intestazione, +1 base 1
+    scarti.insert(1, "motivo", motivo[motivo.notna()])
+    return out.loc[motivo.isna(), COLONNE_UPLOAD_TICKET], scarti
 
-    conn.commit()
+
+def inserisci_ticket_excel(con, righe, avanzamento=None, blocco=IMPORT_BLOCCO_RIGHE):
+    """executemany a blocchi nella transazione del chiamante; avanzamento(frazione) opzionale."""
+    sql = f"""
+        INSERT INTO ticket ({", ".join(COLONNE_UPLOAD_TICKET)})
+        VALUES ({", ".join(["?"] * len(COLONNE_UPLOAD_TICKET))})
+    """
+    valori = righe.astype(object).where(righe.notna(), None).itertuples(index=False, name=None)
+    totale = len(righe)
+    fatte = 0
+    while fatte < totale:
+        pezzo = [next(valori) for _ in range(min(blocco, totale - fatte))]
+        con.executemany(sql, pezzo)
+        fatte += len(pezzo)
+        if avanzamento:
+            avanzamento(fatte / totale)
+    return fatte
 
 
 # -------------------------
@@ -566,30 +1866,26 @@ def import_excel_dynamic(conn, table_name, file):
 def pagina_upload_clienti():
     st.header("⬆️🏠 Up_load Clienti")
 
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("PRAGMA foreign_keys = ON")
-
     # 📥 Importazione da Excel
     st.subheader("📥 Importa Clienti da Excel")
     file_clienti = st.file_uploader("Carica file Excel Clienti", type=["xlsx"])
     if file_clienti:
         try:
-            import_excel_dynamic(conn, "clienti", file_clienti)
-            st.success("✅ Clienti importati correttamente!")
+            with transazione() as conn:
+                inseriti, aggiornati = import_excel_dynamic(conn, "clienti", file_clienti)
+                incrementa_versione(conn, "clienti")
+            st.success(f"✅ Clienti importati correttamente: {inseriti} nuovi, {aggiornati} aggiornati")
         except Exception as e:
             st.error(f"Errore import clienti: {e}")
-        finally:
-            conn.close()
 
     # 📋 Lista clienti
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_connessione(sola_lettura=True)
         clienti_df = pd.read_sql_query(
             "SELECT id, matricola, codice, azienda, indirizzo, citta, provincia FROM clienti ORDER BY azienda ASC, matricola ASC",
             conn
         )
         st.dataframe(clienti_df, use_container_width=True)
-        conn.close()
     except Exception as e:
         st.warning(f"Nessun cliente trovato o errore: {e}")
 
@@ -600,34 +1896,28 @@ def pagina_upload_clienti():
 def pagina_upload_tecnici():
     st.header("⬆️👷 Up_load Tecnici")
 
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("PRAGMA foreign_keys = ON")
-
     # 📥 Importazione da Excel
     st.subheader("📥 Importa Tecnici da Excel")
     file_tecnici = st.file_uploader("Carica file Excel Tecnici", type=["xlsx"])
     if file_tecnici:
         try:
-            import_excel_dynamic(conn, "tecnici", file_tecnici)
-            st.success("✅ Tecnici importati correttamente!")
+            with transazione() as conn:
+                inseriti, aggiornati = import_excel_dynamic(conn, "tecnici", file_tecnici)
+                incrementa_versione(conn, "tecnici")
+            st.success(f"✅ Tecnici importati correttamente: {inseriti} nuovi, {aggiornati} aggiornati")
         except Exception as e:
             st.error(f"Errore import tecnici: {e}")
-        finally:
-            conn.close()
 
     # 📋 Lista tecnici
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_connessione(sola_lettura=True)
         tecnici_df = pd.read_sql_query(
             "SELECT id, nome, citta, provincia, regione FROM tecnici ORDER BY nome ASC",
             conn
         )
         st.dataframe(tecnici_df, use_container_width=True)
-        conn.close()
     except Exception as e:
         st.warning(f"Nessun tecnico trovato o errore: {e}")
-    finally:
-        conn.close()
 
 
 # -------------------------
@@ -659,6 +1949,13 @@ if not os.path.exists(ALLEGATI_DIR):
     os.makedirs(ALLEGATI_DIR)
 
 
+# Quante voci al massimo mostrano i selectbox cliente/tecnico
+PICKER_MAX_RISULTATI = 50
+
+# Righe per pagina proposte nella lista "Visualizza Ticket"
+TICKET_DIMENSIONI_PAGINA = [25, 50, 100, 200]
+
+
 # === Funzioni helper ===
 def format_cliente(row):
     parts = [row.get("matricola"), row.get("azienda"), row.get("indirizzo"), row.get("citta")]
@@ -677,35 +1974,252 @@ def format_tecnico(row):
     parts.append(row.get("regione"))
     return " - ".join([p for p in parts if p and str(p).strip() != ""])
 
-def ensure_ticket_regione_column(db_path):
-    import sqlite3
-    conn = sqlite3.connect(db_path)
+
+# --- Etichette vettoriali: stesso risultato di format_cliente/format_tecnico su tutto il DataFrame ---
+def _colonna_testo(df, col):
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    return df[col].fillna("").astype(str)
+
+
+def _unisci_parti(parti, sep=" - "):
+    """Concatena le Series saltando i valori vuoti (come " - ".join sui soli non vuoti)."""
+    etichetta = pd.Series("", index=parti[0].index)
+    for parte in parti:
+        piena = parte.str.strip() != ""
+        serve_sep = piena & (etichetta != "")
+        etichetta = etichetta + np.where(serve_sep, sep, "") + parte.where(piena, "")
+    return etichetta
+
+
+def _citta_provincia(df):
+    citta = _colonna_testo(df, "citta")
+    provincia = _colonna_testo(df, "provincia")
+    con_prov = np.where(citta != "", citta + " (" + provincia + ")", provincia)
+    return pd.Series(np.where(provincia != "", con_prov, citta), index=df.index)
+
+
+def etichette_clienti(df):
+    return _unisci_parti([
+        _colonna_testo(df, "matricola"), _colonna_testo(df, "azienda"),
+        _colonna_testo(df, "indirizzo"), _citta_provincia(df),
+    ])
+
+
+def etichette_tecnici(df):
+    return _unisci_parti([
+        _colonna_testo(df, "esperienza"), _colonna_testo(df, "nome"),
+        _colonna_testo(df, "telefono"), _colonna_testo(df, "cellulare"),
+        _colonna_testo(df, "referente"), _citta_provincia(df),
+        _colonna_testo(df, "regione"),
+    ])
+
+
+class IndicePicker:
+    """
+    Ricerca per sottostringa sulle etichette di un picker.
+    Indice a trigrammi (trigramma → posizioni) sulle etichette in minuscolo:
+    la query interseca le liste dei suoi trigrammi e verifica solo i candidati.
+    Tiene solo id ed etichette, non le righe.
+    """
+
+    def __init__(self, ids, etichette):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.etichette = list(etichette)
+        self._minuscole = [e.lower() for e in self.etichette]
+        per_trigramma = {}
+        for pos, testo in enumerate(self._minuscole):
+            for tri in {testo[i:i + 3] for i in range(len(testo) - 2)}:
+                per_trigramma.setdefault(tri, []).append(pos)
+        self._trigrammi = {t: np.array(p, dtype=np.int32) for t, p in per_trigramma.items()}
+        self._etichetta_per_id = dict(zip(self.ids.tolist(), self.etichette))
+        self.nbytes = (
+            self.ids.nbytes
+            + sum(len(e) for e in self.etichette) * 2
+            + sum(p.nbytes + 64 for p in self._trigrammi.values())
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def cerca(self, testo, k=50):
+        """Id delle prime k etichette che contengono 'testo' (ordine originale)."""
+        q = (testo or "").strip().lower()
+        if not q:
+            return self.ids[:k].tolist()
+        if len(q) < 3:
+            posizioni = [i for i, e in enumerate(self._minuscole) if q in e]
+        else:
+            liste = []
+            for tri in {q[i:i + 3] for i in range(len(q) - 2)}:
+                if tri not in self._trigrammi:
+                    return []
+                liste.append(self._trigrammi[tri])
+            liste.sort(key=len)
+            candidati = liste[0]
+            for altra in liste[1:]:
+                candidati = np.intersect1d(candidati, altra, assume_unique=True)
+            posizioni = [i for i in candidati.tolist() if q in self._minuscole[i]]
+        return self.ids[posizioni[:k]].tolist()
+
+    def etichetta(self, id_):
+        return self._etichetta_per_id.get(id_, "")
+
+
+def indice_picker(nome, sql, tabelle, etichette_fn):
+    """IndicePicker costruito una volta per versione delle tabelle (cache condivisa)."""
+    def costruisci():
+        conn = get_connessione(sola_lettura=True)
+        df = pd.read_sql_query(sql, conn)
+        return IndicePicker(df["id"], etichette_fn(df))
+
+    return get_cache_riferimenti().get_or_build(
+        (nome, ()), versioni_tabelle(*tabelle), costruisci
+    )
+
+
+def riga_per_id(tabella, id_):
+    """Singola riga come dict (None se non esiste)."""
+    conn = get_connessione(sola_lettura=True)
     cur = conn.cursor()
-    cur.execute("PRAGMA table_info(ticket)")
-    cols = [r[1] for r in cur.fetchall()]
-    if "regione" not in cols:
-        cur.execute("ALTER TABLE ticket ADD COLUMN regione TEXT")
-        conn.commit()
-    conn.close()
+    cur.row_factory = sqlite3.Row
+    riga = cur.execute(f"SELECT * FROM {tabella} WHERE id = ?", (id_,)).fetchone()
+    return dict(riga) if riga else None
 
-def genera_numero_ticket(azienda):
-    from datetime import datetime
 
+def _match_fts(testo, colonne=None):
+    """Testo libero → espressione MATCH FTS5: ogni parola è un prefisso ("abc"*), tutte in AND."""
+    parole = re.findall(r"\w+", testo or "")
+    if not parole:
+        return None
+    espressione = " ".join(f'"{p}"*' for p in parole)
+    if colonne:
+        espressione = "{" + " ".join(colonne) + "} : (" + espressione + ")"
+    return espressione
+
+
+def cerca_ticket(testo, colonne=None, limit=50):
+    """
+    Ricerca full-text sui campi snapshot del ticket (ticket_fts), ordinata per bm25.
+    Ogni risultato è il dict della riga ticket + 'snippet' con il testo trovato tra [ ].
+    Senza testo ritorna gli ultimi ticket creati.
+    """
+    conn = get_connessione(sola_lettura=True)
+    match = _match_fts(testo, colonne)
+    if match is None:
+        cur = conn.execute("""
+            SELECT t.*, '' AS snippet
+            FROM ticket t
+            ORDER BY t.data_creazione DESC
+            LIMIT ?
+        """, (limit,))
+    else:
+        pesi = ", ".join(str(p) for p in PESI_FTS_TICKET)
+        cur = conn.execute(f"""
+            SELECT t.*, snippet(ticket_fts, -1, '[', ']', '…', 12) AS snippet
+            FROM ticket_fts
+            JOIN ticket t ON t.id = ticket_fts.rowid
+            WHERE ticket_fts MATCH ?
+            ORDER BY bm25(ticket_fts, {pesi})
+            LIMIT ?
+        """, (match, limit))
+    cols = [d[0] for d in cur.description]
+    return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+
+def cerca_codici(testo, limit=50):
+    """
+    Punti vendita che contengono ogni parola (>= 3 caratteri) di 'testo' in
+    codice/indirizzo/città/insegna/gruppo, ordinati per bm25.
+    Ritorna dict con codice, indirizzo, citta, provincia, ... e 'label' pronta.
+    """
+    # il trigram non trova sottostringhe più corte di 3 caratteri
+    parole = [p for p in re.findall(r"\w+", testo or "") if len(p) >= 3]
+    if not parole:
+        return []
+    match = " ".join('"' + p + '"' for p in parole)
+    conn = get_connessione(sola_lettura=True)
+    colonne = COLONNE_FTS_CODICI + COLONNE_FTS_CODICI_EXTRA
+    cur = conn.execute(f"""
+        SELECT {", ".join(colonne)}
+        FROM codici_clienti_fts
+        WHERE codici_clienti_fts MATCH ?
+        ORDER BY rank
+        LIMIT ?
+    """, (match, limit))
+    return [dict(zip(colonne, row)) for row in cur.fetchall()]
+
+
+# Colonne mostrate in "Visualizza Ticket" (snapshot salvati in ticket, niente JOIN)
+COLONNE_LISTA_TICKET = [
+    "id", "numero_ticket", "matricola", "modello", "azienda", "indirizzo_cliente",
+    "citta_cliente", "provincia_cliente", "regione", "contatto", "tecnico_nome",
+    "citta_tecnico", "provincia_tecnico", "descrizione", "fattura", "note",
+    "data_intervento", "intervento_svolto", "stato", "guasto", "allegato", "data_creazione",
+]
+
+
+def _like_contiene(testo):
+    """Pattern LIKE "contiene testo" (con ESCAPE '\\' per % e _ digitati dall'utente)."""
+    return "%" + re.sub(r"([\\%_])", r"\\\1", testo) + "%"
+
+
+def _where_ticket(matricole=(), stato=None):
+    """WHERE per la lista ticket: ogni testo in 'matricole' deve essere contenuto nella matricola."""
+    condizioni, params = [], []
+    if stato:
+        condizioni.append("stato = ?")  # idx_ticket_stato_id
+        params.append(stato)
+    for testo in matricole:
+        if testo:
+            condizioni.append("matricola LIKE ? ESCAPE '\\'")
+            params.append(_like_contiene(testo))
+    return (" AND ".join(condizioni) or "1"), params
+
+
+def conta_ticket(matricole=(), stato=None):
+    where, params = _where_ticket(matricole, stato)
+    conn = get_connessione(sola_lettura=True)
+    return conn.execute(f"SELECT COUNT(*) FROM ticket WHERE {where}", params).fetchone()[0]
+
+
+def pagina_lista_ticket(matricole=(), stato=None, prima_di_id=None, n=50):
+    """
+    Una pagina della lista ticket, id decrescente, paginata per chiave (id < prima_di_id):
+    il costo dipende da n, non da quanti ticket ci sono prima.
+    Ritorna (DataFrame, c'è una pagina successiva).
+    """
+    where, params = _where_ticket(matricole, stato)
+    if prima_di_id is not None:
+        where += " AND id < ?"
+        params.append(prima_di_id)
+    conn = get_connessione(sola_lettura=True)
+    df = pd.read_sql_query(f"""
+        SELECT {", ".join(COLONNE_LISTA_TICKET)}
+        FROM ticket
+        WHERE {where}
+        ORDER BY id DESC
+        LIMIT ?
+    """, conn, params=params + [n + 1])
+    return df.head(n), len(df) > n
+
+
+def genera_numero_ticket(con, azienda):
+    """
+    Prossimo numero ticket SSYYMMDDNNN per l'azienda nel giorno corrente.
+    Va chiamata dentro transazione(): l'incremento è una sola UPSERT su
+    ticket_sequenza, serializzata dal BEGIN IMMEDIATE insieme all'INSERT.
+    """
     sigla = azienda[:2].upper()
     oggi = datetime.now().strftime("%y%m%d")
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT COUNT(*) FROM ticket
-        WHERE substr(numero_ticket, 1, 2) = ?
-        AND substr(numero_ticket, 3, 6) = ?
-    """, (sigla, oggi))
-    count = cursor.fetchone()[0]
-    conn.close()
+    progressivo = con.execute("""
+        INSERT INTO ticket_sequenza (sigla, giorno, ultimo) VALUES (?, ?, 1)
+        ON CONFLICT (sigla, giorno) DO UPDATE SET ultimo = ultimo + 1
+        RETURNING ultimo
+    """, (sigla, oggi)).fetchone()[0]
 
-    progressivo = f"{count+1:03d}"
-    return f"{sigla}{oggi}{progressivo}"
+    return f"{sigla}{oggi}{progressivo:03d}"
 
 
 def salva_ticket(
@@ -719,6 +2233,8 @@ def salva_ticket(
     """
     Inserisce un ticket nello schema esistente + snapshot 'regione' del tecnico (se presente).
     I nomi colonna sono allineati alla tua tabella 'ticket'.
+    Con numero_ticket=None il numero è generato nella stessa transazione.
+    Ritorna il numero ticket salvato.
     """
 
     # Normalizza data_intervento in stringa YYYY-MM-DD o None
@@ -737,23 +2253,22 @@ def salva_ticket(
 
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-
-    cur.execute("""
-        INSERT INTO ticket (
+    with transazione() as conn:
+        if numero_ticket is None:
+            numero_ticket = genera_numero_ticket(conn, azienda)
+        conn.execute("""
+            INSERT INTO ticket (
+                numero_ticket, matricola, modello, cliente_id, codice, azienda, indirizzo_cliente, citta_cliente, provincia_cliente,
+                contatto, tecnico_id, tecnico_nome, citta_tecnico, provincia_tecnico, regione,  
+                descrizione, intervento_svolto, note, fattura, data_intervento, stato, guasto, allegato, data_creazione
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
             numero_ticket, matricola, modello, cliente_id, codice, azienda, indirizzo_cliente, citta_cliente, provincia_cliente,
-            contatto, tecnico_id, tecnico_nome, citta_tecnico, provincia_tecnico, regione,  
-            descrizione, intervento_svolto, note, fattura, data_intervento, stato, guasto, allegato, data_creazione
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        numero_ticket, matricola, modello, cliente_id, codice, azienda, indirizzo_cliente, citta_cliente, provincia_cliente,
-        contatto, tecnico_id, tecnico_nome, citta_tecnico, provincia_tecnico, regione,
-        descrizione, intervento_svolto, note, fattura_val, data_intervento_str, stato, guasto, allegato_path, now_str
-    ))
-
-    conn.commit()
-    conn.close()
+            contatto, tecnico_id, tecnico_nome, citta_tecnico, provincia_tecnico, regione,
+            descrizione, intervento_svolto, note, fattura_val, data_intervento_str, stato, guasto, allegato_path, now_str
+        ))
+        incrementa_versione(conn, "ticket")
+    return numero_ticket
 
 
 def mostra_popup_ticket_aperti(df):
@@ -782,25 +2297,8 @@ def mostra_popup_ticket_aperti(df):
 def pagina_ticket():
     st.header("🎫 GESTIONE TICKET")
     
-    # carica ticket aperti / in lavorazione
-    con = sqlite3.connect(DB_FILE)
-    df_open = pd.read_sql_query("""
-        SELECT t.id,
-               c.matricola,
-               c.azienda,
-               t.indirizzo_cliente,
-               t.citta_cliente,
-               t.provincia_cliente,
-               t.tecnico_nome,
-               t.descrizione,
-               t.stato,
-               t.data_creazione
-        FROM ticket t
-        LEFT JOIN clienti c ON c.id = t.cliente_id
-        WHERE t.stato IN ('Aperto','In lavorazione')
-        ORDER BY datetime(t.data_creazione) ASC, t.id ASC
-    """, con)
-    con.close()
+    # ticket aperti / in lavorazione: stesso snapshot del badge in sidebar
+    df_open = get_snapshot_ticket_aperti().dati()
 
      
     # mostra il popup solo se:
@@ -821,44 +2319,41 @@ def pagina_ticket():
     
     st.subheader("➕ Nuovo Ticket ")
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # --- Caricamento clienti e tecnici ---
-    clienti_df = pd.read_sql_query("""
-        SELECT id, matricola, modello, codice, azienda, indirizzo, citta, provincia, regione, contatto
+    # --- Indici di ricerca clienti e tecnici (ricostruiti solo quando cambiano i dati) ---
+    indice_clienti = indice_picker("picker_clienti", """
+        SELECT id, matricola, azienda, indirizzo, citta, provincia
         FROM clienti
         ORDER BY matricola ASC
-    """, conn)
+    """, ("clienti",), etichette_clienti)
 
-    tecnici_df = pd.read_sql_query("""
+    indice_tecnici = indice_picker("picker_tecnici", """
         SELECT id, nome, citta, provincia, regione, esperienza, telefono, cellulare, referente
         FROM tecnici
         ORDER BY nome ASC
-    """, conn)
+    """, ("tecnici",), etichette_tecnici)
 
     # --- Ricerca cliente ---
     search_cliente = st.text_input("🔍 Cerca cliente per matricola, azienda, città...")
-    if search_cliente:
-        clienti_df = clienti_df[
-            clienti_df.apply(lambda row: search_cliente.lower() in format_cliente(row).lower(), axis=1)
-        ]
-    cliente_map = {format_cliente(row): row for _, row in clienti_df.iterrows()}
-    cliente_sel = st.selectbox("📌 Seleziona Cliente", list(cliente_map.keys())) if not clienti_df.empty else None
+    ids_clienti = indice_clienti.cerca(search_cliente, k=PICKER_MAX_RISULTATI)
+    id_cliente = st.selectbox(
+        "📌 Seleziona Cliente", ids_clienti, format_func=indice_clienti.etichetta
+    ) if ids_clienti else None
+    cliente_sel = indice_clienti.etichetta(id_cliente) if id_cliente is not None else None
 
     # --- Ricerca tecnico ---
     search_tecnico = st.text_input("🔍 Cerca tecnico per nome, città, regione, x provincia (??)")
-    if search_tecnico:
-        tecnici_df = tecnici_df[
-            tecnici_df.apply(lambda row: search_tecnico.lower() in format_tecnico(row).lower(), axis=1)
-        ]
-    tecnico_map = {format_tecnico(row): row for _, row in tecnici_df.iterrows()}
-    tecnico_sel = st.selectbox("🛠️ Seleziona Tecnico", list(tecnico_map.keys())) if not tecnici_df.empty else None
+    ids_tecnici = indice_tecnici.cerca(search_tecnico, k=PICKER_MAX_RISULTATI)
+    id_tecnico = st.selectbox(
+        "🛠️ Seleziona Tecnico", ids_tecnici, format_func=indice_tecnici.etichetta
+    ) if ids_tecnici else None
+    tecnico_sel = indice_tecnici.etichetta(id_tecnico) if id_tecnico is not None else None
+
+    # righe complete solo per gli elementi scelti
+    cliente = riga_per_id("clienti", id_cliente) if id_cliente is not None else None
+    tecnico = riga_per_id("tecnici", id_tecnico) if id_tecnico is not None else None
     
     # --- Bottone Calcolo distanza ---
-    if cliente_sel and tecnico_sel:
-        cliente = cliente_map[cliente_sel]
-        tecnico = tecnico_map[tecnico_sel]
+    if cliente and tecnico:
 
         indirizzo_cliente = f"{cliente['indirizzo']} {cliente['citta']} {cliente['provincia']}"
         indirizzo_tecnico = f"{tecnico['citta']} {tecnico['provincia']}"
@@ -880,7 +2375,7 @@ def pagina_ticket():
         if tecnico_sel:
             st.caption(f"🛠️ Tecnico selezionato: {tecnico_sel}")
 
-        cliente_obj = cliente_map[cliente_sel] if cliente_sel else None
+        cliente_obj = cliente
         matricola_default = cliente_obj["matricola"] if cliente_obj is not None else ""
         modello_default = cliente_obj["modello"] if cliente_obj is not None else ""
         contatto_default = cliente_obj["contatto"] if cliente_obj is not None else ""
@@ -896,7 +2391,7 @@ def pagina_ticket():
         stato = st.selectbox("Stato", ["Aperto", "In lavorazione", "Chiuso"])
         allegato = st.file_uploader("Carica Allegato (opzionale)", type=["pdf", "jpg", "png"])
 
-        critical_df = pd.read_sql_query("SELECT codice_guasto, guasto FROM critical ORDER BY codice_guasto ASC", conn)
+        critical_df = carica_guasti()
         if not critical_df.empty:
             guasto_map = { 
                 f"{row['codice_guasto']} - {row['guasto']}": f"{row['codice_guasto']} - {row['guasto']}"
@@ -910,12 +2405,9 @@ def pagina_ticket():
         submitted = st.form_submit_button("💾 Salva Ticket")
 
         if submitted:
-            if not cliente_sel or not tecnico_sel:
+            if not cliente or not tecnico:
                 st.error("❌ Devi selezionare sia un cliente che un tecnico.")
             else:
-                cliente = cliente_map[cliente_sel]
-                tecnico = tecnico_map[tecnico_sel]
-
                 # Salvataggio allegato
                 allegato_path = None
                 if allegato:
@@ -923,14 +2415,9 @@ def pagina_ticket():
                     with open(allegato_path, "wb") as f:
                         f.write(allegato.getbuffer())
 
-                cliente = cliente_map[cliente_sel]
-                tecnico = tecnico_map[tecnico_sel]
-
-                # Genera numero ticket (azienda viene dal cliente)
-                numero_ticket = genera_numero_ticket(cliente["azienda"])
-                
-                salva_ticket(
-                    numero_ticket, matricola, modello, cliente["id"], cliente["codice"], cliente["azienda"],
+                # Numero ticket generato da salva_ticket (azienda viene dal cliente)
+                numero_ticket = salva_ticket(
+                    None, matricola, modello, cliente["id"], cliente["codice"], cliente["azienda"],
                     cliente["indirizzo"], cliente["citta"], cliente["provincia"], cliente["regione"],contatto,
                     tecnico["id"], tecnico["nome"], tecnico["citta"], tecnico["provincia"],
                     descrizione, intervento_svolto, note, fattura,
@@ -938,7 +2425,7 @@ def pagina_ticket():
                     allegato_path
                     
                 )
-                st.success("✅ Ticket creato con successo!")
+                st.success(f"✅ Ticket {numero_ticket} creato con successo!")
                 st.rerun()
     # ===============================
     st.subheader("📋 Visualizza Ticket")
@@ -949,51 +2436,39 @@ def pagina_ticket():
     with col2:
         stato_filter = st.selectbox("📌 Filtra per stato", ["Tutti", "Aperto", "In lavorazione", "Chiuso"], key="filtro_stato")
 
-    # 🔎 Query SENZA JOIN → uso solo snapshot salvati in ticket
-    df_tickets = pd.read_sql_query("""
-        SELECT 
-            id,
-            numero_ticket,
-            matricola,
-            modello,
-            azienda,
-            indirizzo_cliente,
-            citta_cliente,
-            provincia_cliente,
-            regione,
-            contatto,
-            tecnico_nome,
-            citta_tecnico,
-            provincia_tecnico,
-            descrizione,
-            fattura,
-            note,
-            data_intervento,
-            intervento_svolto,
-            stato,
-            guasto,
-            allegato,
-            data_creazione
-        FROM ticket
-        ORDER BY id DESC
-    """, conn)
+    # 🔎 Query SENZA JOIN → uso solo snapshot salvati in ticket, filtri e paginazione in SQL
+    with col2:
+        dim_pagina = st.selectbox("Righe per pagina", TICKET_DIMENSIONI_PAGINA, index=1, key="ticket_dim_pagina")
+
+    matricole_filtro = [matricola_search] if matricola_search else []
+    stato_sql = stato_filter if stato_filter != "Tutti" else None
 
-    # --- Filtro matricola ---
-    if matricola_search:
-        df_tickets = df_tickets[df_tickets["matricola"].str.contains(matricola_search, case=False, na=False)]
+    # pila degli id da cui partono le pagine già viste; si azzera se cambiano i filtri
+    chiave_filtri = (matricola_search, stato_filter, dim_pagina)
+    if st.session_state.get("ticket_lista_filtri") != chiave_filtri:
+        st.session_state["ticket_lista_filtri"] = chiave_filtri
+        st.session_state["ticket_lista_cursori"] = [None]
+    cursori = st.session_state["ticket_lista_cursori"]
 
-    # --- Filtro stato ---
-    if stato_filter != "Tutti":
-        df_tickets = df_tickets[df_tickets["stato"] == stato_filter]
+    totale = conta_ticket(matricole_filtro, stato_sql)
+    df_tickets, ha_successiva = pagina_lista_ticket(matricole_filtro, stato_sql, cursori[-1], dim_pagina)
 
     if not df_tickets.empty:
         st.dataframe(df_tickets)
 
-        # Creiamo un dizionario "ticket_map" utile per selezionare i record
-        ticket_map = {
-            f"ID {row['id']} - {row['matricola']} - {row['azienda']} - {row['tecnico_nome']} - {row['stato']}": row 
-            for _, row in df_tickets.iterrows()
-        }
+    n_pagina = len(cursori)
+    n_pagine = max(1, -(-totale // dim_pagina))
+    c_prec, c_info, c_succ = st.columns([1, 2, 1])
+    with c_prec:
+        if st.button("◀️ Precedente", disabled=n_pagina == 1, key="ticket_pag_prec"):
+            cursori.pop()
+            st.rerun()
+    with c_info:
+        st.caption(f"Pagina {n_pagina} di {n_pagine} · {totale} ticket")
+    with c_succ:
+        if st.button("Successiva ▶️", disabled=not ha_successiva, key="ticket_pag_succ"):
+            cursori.append(int(df_tickets["id"].iloc[-1]))
+            st.rerun()
 
     # --- Modifica Ticket ---
     st.subheader("✏️ Modifica Ticket")
@@ -1001,27 +2476,10 @@ def pagina_ticket():
     # 🔍 Ricerca Ticket (ora solo in campi snapshot)
     search_ticket = st.text_input("🔍 Cerca ticket per matricola, azienda, indirizzo, citta, tecnico, descrizione o guasto...")
 
-    query = """
-        SELECT *
-        FROM ticket
-        WHERE matricola LIKE ? 
-        OR azienda LIKE ?
-        OR indirizzo_cliente LIKE ? 
-        OR citta_cliente LIKE ? 
-        OR tecnico_nome LIKE ?
-        OR guasto LIKE ?
-        OR descrizione LIKE ?
-        ORDER BY data_creazione DESC
-        LIMIT 50
-    """
-    cursor.execute(query, (
-        f"%{search_ticket}%", f"%{search_ticket}%", f"%{search_ticket}%",
-        f"%{search_ticket}%", f"%{search_ticket}%", f"%{search_ticket}%", f"%{search_ticket}%"
-    ))
-    rows = cursor.fetchall()
-    cols = [d[0] for d in cursor.description]
-
-    tickets = [dict(zip(cols, row)) for row in rows]
+    tickets = cerca_ticket(search_ticket, colonne=[
+        "matricola", "azienda", "indirizzo_cliente", "citta_cliente",
+        "tecnico_nome", "guasto", "descrizione",
+    ])
 
     if tickets:
         ticket_map = {
@@ -1036,6 +2494,8 @@ def pagina_ticket():
     if ticket_sel:
         ticket_data = ticket_map[ticket_sel]
         ticket_id = ticket_data["id"]
+        if ticket_data.get("snippet"):
+            st.caption(f"🔎 {ticket_data['snippet']}")
 
         # --- Mostra allegato esistente ---
         if ticket_data["allegato"]:
@@ -1055,7 +2515,7 @@ def pagina_ticket():
                 st.warning(f"⚠️ Impossibile caricare l'anteprima: {e}")
 
         # --- Recupero lista guasti ---
-        critical_df = pd.read_sql_query("SELECT codice_guasto, guasto FROM critical ORDER BY codice_guasto ASC", conn)
+        critical_df = carica_guasti()
         guasto_map = { 
             f"{row['codice_guasto']} - {row['guasto']}": f"{row['codice_guasto']} - {row['guasto']}"
             for _, row in critical_df.iterrows()
@@ -1112,31 +2572,36 @@ def pagina_ticket():
                 with open(allegato_path, "wb") as f:
                     f.write(nuovo_allegato.getbuffer())
 
-            cursor.execute("""
-                UPDATE ticket SET
-                    descrizione=?, intervento_svolto=?, note=?, fattura=?, data_intervento=?, stato=?, guasto=?, allegato=?
-                WHERE id=?
-            """, (
-                descrizione, intervento_svolto, note, fattura,
-                data_intervento.strftime("%Y-%m-%d") if data_intervento else None,
-                stato, guasto_map[guasto_sel], allegato_path, ticket_id
-            ))
-            conn.commit()
+            with transazione() as conn:
+                conn.execute("""
+                    UPDATE ticket SET
+                        descrizione=?, intervento_svolto=?, note=?, fattura=?, data_intervento=?, stato=?, guasto=?, allegato=?
+                    WHERE id=?
+                """, (
+                    descrizione, intervento_svolto, note, fattura,
+                    data_intervento.strftime("%Y-%m-%d") if data_intervento else None,
+                    stato, guasto_map[guasto_sel], allegato_path, ticket_id
+                ))
+                incrementa_versione(conn, "ticket")
             st.success("✅ Ticket aggiornato con successo!")
             st.rerun()
 
 # --- Cancella Ticket ---
     st.subheader("🗑️ Cancella Ticket")
     search_del = st.text_input("🔍 Inserisci matricola per cercare ticket da cancellare", key="search_cancella")
-    df_del = df_tickets[df_tickets["matricola"].str.contains(search_del, case=False, na=False)] if search_del else df_tickets
+    if search_del:
+        df_del, _ = pagina_lista_ticket(matricole_filtro + [search_del], stato_sql, None, dim_pagina)
+    else:
+        df_del = df_tickets
 
     if not df_del.empty:
         ticket_del_map = {f"ID {row['id']} - {row['matricola']} - {row['azienda']} - {row['indirizzo_cliente']} - {row['citta_cliente']} - {row['provincia_cliente']} - {row['tecnico_nome']}": row for _, row in df_del.iterrows()}
         ticket_del = st.selectbox("Seleziona un ticket da eliminare", list(ticket_del_map.keys()), key="delete_ticket")
         if st.button("❌ Elimina Ticket", key="confirm_delete_ticket"):
             ticket_id = ticket_del_map[ticket_del]["id"]
-            cursor.execute("DELETE FROM ticket WHERE id = ?", (ticket_id,))
-            conn.commit()
+            with transazione() as conn:
+                conn.execute("DELETE FROM ticket WHERE id = ?", (ticket_id,))
+                incrementa_versione(conn, "ticket")
             st.success(f"✅ Ticket {ticket_id} eliminato con successo!")
             st.rerun()
             
@@ -1156,9 +2621,9 @@ def pagina_ticket():
 DB_PATH = "assistenza.db"  # aggiorna se serve
 
 def carica_ticket():
-    conn = sqlite3.connect("assistenza.db")
-    conn.row_factory = sqlite3.Row
+    conn = get_connessione(sola_lettura=True)
     cur = conn.cursor()
+    cur.row_factory = sqlite3.Row
     cur.execute("""
         SELECT 
             t.id, t.data_creazione, t.descrizione, t.stato, t.guasto,
@@ -1168,300 +2633,641 @@ def carica_ticket():
         ORDER BY datetime(t.data_creazione) DESC
     """)
     rows = cur.fetchall()
-    conn.close()
     return pd.DataFrame(rows)
 
-def pagina_analisi_ticket():
-    st.title("📊 Analisi Ticket")
+# Filtri a tendina dell'analisi: chiave → colonna di ticket (uguaglianza)
+FILTRI_ANALISI = {
+    "azienda": "azienda",
+    "provincia": "provincia_cliente",
+    "regione": "regione",
+    "tecnico": "tecnico_nome",
+    "guasto": "guasto",
+}
 
-    conn = sqlite3.connect("assistenza.db")
-    df = pd.read_sql_query("SELECT * FROM ticket", conn)
-    conn.close()
+# Colonne lette per la tabella/esportazione dell'analisi
+COLONNE_ANALISI = [
+    "id", "numero_ticket", "data_intervento", "matricola", "azienda",
+    "indirizzo_cliente", "citta_cliente", "provincia_cliente", "regione",
+    "tecnico_nome", "guasto", "descrizione", "intervento_svolto", "stato", "fattura",
+]
 
-    if df.empty:
-        st.warning("⚠️ Nessun ticket disponibile.")
-        return
-    # --- Conversioni data e fattura ---
+# Righe mostrate a video: conteggio e fatturato restano calcolati su tutta la selezione
+ANALISI_MAX_RIGHE = 2000
+
+
+def where_analisi_ticket(filtri):
+    """
+    Filtri scelti → (WHERE, parametri). 'filtri' ha 'matricola' (contiene),
+    le chiavi di FILTRI_ANALISI (uguaglianza), 'extra' {chiave extra_json: valore}
+    e 'data_da'/'data_a' (date incluse).
+    """
+    condizioni, params = [], []
+    if filtri.get("matricola"):
+        condizioni.append("matricola LIKE ? ESCAPE '\\'")
+        params.append(_like_contiene(filtri["matricola"]))
+    for chiave, colonna in FILTRI_ANALISI.items():
+        if filtri.get(chiave):
+            condizioni.append(f"{colonna} = ?")
+            params.append(filtri[chiave])
+    for chiave, valore in (filtri.get("extra") or {}).items():
+        # in extra_json i numeri restano numeri: si confrontano testo e numero
+        numero = pd.to_numeric(valore, errors="coerce")
+        condizioni.append(f"{espressione_extra('ticket', chiave)} IN (?, ?)")
+        params += [valore, valore if pd.isna(numero) else float(numero)]
+    # date ISO come testo: range semiaperto sull'indice idx_ticket_data_intervento
+    if filtri.get("data_da"):
+        condizioni.append("data_intervento >= ?")
+        params.append(filtri["data_da"].strftime("%Y-%m-%d"))
+    if filtri.get("data_a"):
+        condizioni.append("data_intervento < ?")
+        params.append((filtri["data_a"] + timedelta(days=1)).strftime("%Y-%m-%d"))
+    return (" AND ".join(condizioni) or "1"), params
+
+
+MISURE_TICKET = """
+    COUNT(*) AS n, COALESCE(SUM(CAST(fattura AS REAL)), 0) AS fatturato,
+    COALESCE(SUM(stato IN ('Aperto', 'In lavorazione')), 0) AS aperti,
+    COALESCE(SUM(stato = 'Chiuso'), 0) AS chiusi
+"""
+MISURE_CUBO = """
+    COALESCE(SUM(n), 0) AS n, COALESCE(SUM(fatturato), 0) AS fatturato,
+    COALESCE(SUM(aperti), 0) AS aperti, COALESCE(SUM(chiusi), 0) AS chiusi
+"""
+
+
+def _aggrega_righe(filtri, per=None):
+    """Aggregati calcolati sulle righe di ticket (per=None, 'mese' o una colonna di FILTRI_ANALISI)."""
+    where, params = where_analisi_ticket(filtri)
+    gruppo = "substr(data_intervento, 1, 7)" if per == "mese" else per
+    sql = f"SELECT {gruppo + ' AS ' + per + ', ' if per else ''}{MISURE_TICKET} FROM ticket WHERE {where}"
+    if per:
+        sql += f" GROUP BY {gruppo}"
+    return pd.read_sql_query(sql, get_connessione(sola_lettura=True), params=params)
+
+
+def _aggrega_cubo(filtri, mese_da, mese_a, per=None):
+    """Aggregati letti da ticket_cubo per i mesi interi [mese_da, mese_a]."""
+    condizioni, params = ["mese BETWEEN ? AND ?"], [mese_da, mese_a]
+    for chiave, colonna in FILTRI_ANALISI.items():
+        if filtri.get(chiave):
+            condizioni.append(f"{colonna} = ?")
+            params.append(filtri[chiave])
+    sql = f"SELECT {per + ', ' if per else ''}{MISURE_CUBO} FROM ticket_cubo WHERE {' AND '.join(condizioni)}"
+    if per:
+        sql += f" GROUP BY {per}"
+    return pd.read_sql_query(sql, get_connessione(sola_lettura=True), params=params)
+
+
+def aggrega_ticket(filtri, per=None):
+    """
+    Conteggio, fatturato e aperti/chiusi della selezione, totali o per 'per'.
+    I mesi interi del periodo si leggono dal cubo; i giorni dei mesi a cavallo
+    (e i filtri per matricola o campo extra, che il cubo non ha) dalle righe via indice su data_intervento.
+    """
+    data_da, data_a = filtri.get("data_da"), filtri.get("data_a")
+    if filtri.get("matricola") or filtri.get("extra") or not data_da or not data_a:
+        parti = [_aggrega_righe(filtri, per)]
+    else:
+        inizio_pieno = data_da if data_da.day == 1 else (data_da.replace(day=1) + timedelta(days=32)).replace(day=1)
+        fine_pieno = data_a if (data_a + timedelta(days=1)).day == 1 else data_a.replace(day=1) - timedelta(days=1)
+        if inizio_pieno > fine_pieno:
+            parti = [_aggrega_righe(filtri, per)]
+        else:
+            parti = [_aggrega_cubo(filtri, inizio_pieno.strftime("%Y-%m"), fine_pieno.strftime("%Y-%m"), per)]
+            if data_da < inizio_pieno:
+                parti.append(_aggrega_righe({**filtri, "data_a": inizio_pieno - timedelta(days=1)}, per))
+            if fine_pieno < data_a:
+                parti.append(_aggrega_righe({**filtri, "data_da": fine_pieno + timedelta(days=1)}, per))
+
+    df = pd.concat([p for p in parti if not p.empty] or parti[:1], ignore_index=True)
+    if per:
+        df = df.groupby(per, as_index=False)[["n", "fatturato", "aperti", "chiusi"]].sum()
+        return df[df["n"] > 0].sort_values(per).reset_index(drop=True)
+    return df[["n", "fatturato", "aperti", "chiusi"]].sum()
+
+
+def sql_analisi_ticket(filtri, limit=None):
+    """(sql, params) delle righe di dettaglio, dalla più recente."""
+    where, params = where_analisi_ticket(filtri)
+    sql = f"""
+        SELECT {", ".join(COLONNE_ANALISI)}
+        FROM ticket
+        WHERE {where}
+        ORDER BY data_intervento DESC, id DESC
+    """
+    if limit is not None:
+        sql += " LIMIT ?"
+        params = params + [limit]
+    return sql, params
+
+
+def righe_analisi_ticket(filtri, limit=None):
+    sql, params = sql_analisi_ticket(filtri, limit)
+    conn = get_connessione(sola_lettura=True)
+    df = pd.read_sql_query(sql, conn, params=params)
     df["data_intervento"] = pd.to_datetime(df["data_intervento"], errors="coerce")
     df["fattura"] = pd.to_numeric(df["fattura"], errors="coerce").fillna(0)
-    
-    # Conversione sicura della data
-    ## df["data_intervento"] = pd.to_datetime(df["data_intervento"], errors="coerce")
+    return df
 
-    # Sostituisco eventuali NaT con oggi (per non avere min/max rotti)
-    if df["data_intervento"].isnull().all():
-        data_min = pd.to_datetime("today")
-        data_max = pd.to_datetime("today")
-    else:
-        data_min = df["data_intervento"].min()
-        data_max = df["data_intervento"].max()
 
-    
+def periodo_interventi():
+    """(prima, ultima) data_intervento presenti, lette dagli estremi dell'indice."""
+    conn = get_connessione(sola_lettura=True)
+    prima = conn.execute("SELECT MIN(data_intervento) FROM ticket WHERE data_intervento > ''").fetchone()[0]
+    ultima = conn.execute("SELECT MAX(data_intervento) FROM ticket WHERE data_intervento > ''").fetchone()[0]
+    oggi = pd.to_datetime("today")
+    prima = pd.to_datetime(prima, errors="coerce")
+    ultima = pd.to_datetime(ultima, errors="coerce")
+    return (oggi if pd.isna(prima) else prima), (oggi if pd.isna(ultima) else ultima)
 
-    # ------------------------------
-    # FILTRI
-    # ------------------------------
-    st.subheader("🔍 Filtri di ricerca")
-    col1, col2, col3 = st.columns(3)
-    col4, col5, col6 = st.columns(3)
 
-    # Matricola (sempre manuale)
-    matricola = col1.text_input("🏷 MATRICOLA")
-
-    # Azienda
-    azienda = None
-    if "azienda" in df.columns:
-        aziende_uniche = sorted([a for a in df["azienda"].fillna("").unique().tolist() if a != ""])
-        azienda = col2.selectbox("🏠 AZIENDA", ["Tutte"] + aziende_uniche)
-
-    # Provincia
-    provincia = None
-    if "provincia_cliente" in df.columns:
-        province_uniche = sorted([p for p in df["provincia_cliente"].fillna("").unique().tolist() if p != ""])
-        provincia = col3.selectbox("🏞 PROVINCIA", ["Tutte"] + province_uniche)
-
-    # Regione
-    regione = None
-    if "regione" in df.columns:
-        regioni_uniche = sorted([r for r in df["regione"].fillna("").unique().tolist() if r != ""])
-        regione = col4.selectbox("🏜 REGIONE", ["Tutte"] + regioni_uniche)
-
-    # Tecnico
-    tecnico = None
-    if "tecnico_nome" in df.columns:
-        tecnici_unici = sorted([t for t in df["tecnico_nome"].fillna("").unique().tolist() if t != ""])
-        tecnico = col5.selectbox("👷‍♂️ TECNICO", ["Tutti"] + tecnici_unici)
-
-    # Guasto
-    guasto = None
-    if "guasto" in df.columns:
-        guasti_unici = sorted([g for g in df["guasto"].fillna("").unique().tolist() if g != ""])
-        guasto = col6.selectbox("⚠️ GUASTO", ["Tutti"] + guasti_unici)
+def _euro(x):
+    return f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
 
-   # Filtri periodo
-    col7, col8 = st.columns(2)
-    data_da = col7.date_input("Da data ⏱", data_min)
-    data_a = col8.date_input("A data ⏱", data_max)
-    # ------------------------------
-    # APPLICA FILTRI
-    # ------------------------------
-    df_filtrato = df.copy()
 
-    if matricola:
-        df_filtrato = df_filtrato[df_filtrato["matricola"].astype(str).str.contains(matricola, case=False, na=False)]
+def pagina_analisi_ticket():
+    st.title("📊 Analisi Ticket")
 
-    if azienda and azienda != "Tutte":
-        df_filtrato = df_filtrato[df_filtrato["azienda"] == azienda]
+    conn = get_connessione(sola_lettura=True)
+    if conn.execute("SELECT 1 FROM ticket LIMIT 1").fetchone() is None:
+        st.warning("⚠️ Nessun ticket disponibile.")
+        return
 
-    if provincia and provincia != "Tutte":
-        df_filtrato = df_filtrato[df_filtrato["provincia_cliente"] == provincia]
+    # Estremi del periodo (per i default dei date_input)
+    data_min, data_max = periodo_interventi()
 
-    if regione and regione != "Tutte":
-        df_filtrato = df_filtrato[df_filtrato["regione"] == regione]
+    # ------------------------------
+    # FILTRI
+    # ------------------------------
+    st.subheader("🔍 Filtri di ricerca")
+    col1, col2, col3 = st.columns(3)
+    col4, col5, col6 = st.columns(3)
 
-    if tecnico and tecnico != "Tutti":
-        df_filtrato = df_filtrato[df_filtrato["tecnico_nome"] == tecnico]
+    filtri = {}
 
-    if guasto and guasto != "Tutti":
-        df_filtrato = df_filtrato[df_filtrato["guasto"] == guasto]
+    # Matricola (sempre manuale)
+    filtri["matricola"] = col1.text_input("🏷 MATRICOLA")
+
+    # Tendine: valori e conteggi dalla tabella faccette
+    tendine = [
+        ("azienda", col2, "🏠 AZIENDA", "Tutte"),
+        ("provincia", col3, "🏞 PROVINCIA", "Tutte"),
+        ("regione", col4, "🏜 REGIONE", "Tutte"),
+        ("tecnico", col5, "👷‍♂️ TECNICO", "Tutti"),
+        ("guasto", col6, "⚠️ GUASTO", "Tutti"),
+    ]
+    for chiave, colonna_ui, etichetta, tutti in tendine:
+        opzioni, formato = opzioni_faccetta("ticket", FILTRI_ANALISI[chiave], tutti)
+        scelta = colonna_ui.selectbox(etichetta, opzioni, format_func=formato)
+        filtri[chiave] = None if scelta == tutti else scelta
 
-    # Filtro per date
-    if "data_intervento" in df_filtrato.columns:
-        df_filtrato["data_intervento"] = pd.to_datetime(df_filtrato["data_intervento"], errors="coerce")
-        df_filtrato = df_filtrato[
-            (df_filtrato["data_intervento"] >= pd.to_datetime(data_da)) &
-            (df_filtrato["data_intervento"] <= pd.to_datetime(data_a))
-        ]
+   # Filtri periodo
+    col7, col8 = st.columns(2)
+    filtri["data_da"] = col7.date_input("Da data ⏱", data_min)
+    filtri["data_a"] = col8.date_input("A data ⏱", data_max)
+
+    # Campo extra (colonne Excel importate in extra_json)
+    chiavi = chiavi_extra("ticket")["chiave"].tolist()
+    if chiavi:
+        col9, col10 = st.columns(2)
+        chiave_extra = col9.selectbox("🧩 CAMPO EXTRA", ["Nessuno"] + chiavi)
+        valore_extra = col10.text_input("Valore campo extra", disabled=chiave_extra == "Nessuno").strip()
+        if chiave_extra != "Nessuno" and valore_extra:
+            filtri["extra"] = {chiave_extra: valore_extra}
+            # conta un utilizzo per ogni nuovo filtro, non a ogni rerun
+            if st.session_state.get("analisi_filtro_extra") != (chiave_extra, valore_extra):
+                st.session_state["analisi_filtro_extra"] = (chiave_extra, valore_extra)
+                registra_uso_extra("ticket", chiave_extra)
 
     # ------------------------------
-    # RIEPILOGO
+    # RIEPILOGO (aggregati SQL)
     # ------------------------------
     st.subheader("📌 Riepilogo selezione")
 
-    nr_interventi = len(df_filtrato)
-    fatturato = df_filtrato["fattura"].sum() if "fattura" in df_filtrato.columns else 0
+    kpi = aggrega_ticket(filtri)
+    nr_interventi = int(kpi["n"])
+    fatturato = float(kpi["fatturato"])
 
-    col_r1, col_r2 = st.columns(2)
+    col_r1, col_r2, col_r3, col_r4 = st.columns(4)
     col_r1.metric("📑 Numero Interventi", nr_interventi)
-    col_r2.metric("💰 Totale Costo fatturato", f"{fatturato:,.2f}€".replace(",", "X").replace(".", ",").replace("X", "."))
-    ## col_r2.metric("💰 Totale Costo fatturato ", f"{fatturato:,.2f} €")
+    col_r2.metric("💰 Totale Costo fatturato", f"{_euro(fatturato)}€")
+    col_r3.metric("➗ Costo medio", f"{_euro(fatturato / nr_interventi if nr_interventi else 0)}€")
+    col_r4.metric("🟢 Aperti / 🔒 Chiusi", f"{int(kpi['aperti'])} / {int(kpi['chiusi'])}")
+
+    # ------------------------------
+    # ANDAMENTO (dal cubo)
+    # ------------------------------
+    if nr_interventi:
+        st.subheader("📈 Andamento")
+        trend = aggrega_ticket(filtri, per="mese")
+        trend = trend[trend["mese"] != ""].set_index("mese")
+        col_t1, col_t2 = st.columns(2)
+        with col_t1:
+            st.caption("Interventi per mese")
+            st.bar_chart(trend[["n"]].rename(columns={"n": "Interventi"}))
+        with col_t2:
+            st.caption("Fatturato per mese (€)")
+            st.line_chart(trend[["fatturato"]].rename(columns={"fatturato": "Fatturato"}))
+
+        col_t3, col_t4 = st.columns(2)
+        with col_t3:
+            st.caption("Interventi per guasto")
+            per_guasto = aggrega_ticket(filtri, per="guasto")
+            st.bar_chart(per_guasto[per_guasto["guasto"] != ""].set_index("guasto")[["n"]])
+        with col_t4:
+            st.caption("Interventi per tecnico (primi 15)")
+            per_tecnico = aggrega_ticket(filtri, per="tecnico_nome")
+            per_tecnico = per_tecnico[per_tecnico["tecnico_nome"] != ""].nlargest(15, "n")
+            st.bar_chart(per_tecnico.set_index("tecnico_nome")[["n"]])
 
     # ------------------------------
     # TABELLA RISULTATI
     # ------------------------------
-      # --- Tabella ---
     st.subheader("📑 Risultati")
+    df_filtrato = righe_analisi_ticket(filtri, limit=ANALISI_MAX_RIGHE)
+    if nr_interventi > len(df_filtrato):
+        st.caption(f"Mostrati i {len(df_filtrato)} interventi più recenti su {nr_interventi}: l'esportazione li contiene tutti.")
     st.dataframe(
         df_filtrato.style.format({
-            "fattura": lambda x: f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."),
+            "fattura": _euro,
             "data_intervento": lambda x: x.strftime("%d/%m/%Y") if pd.notnull(x) else ""
         }),
         use_container_width=True
     )
-    
-    ### st.subheader("📋 Risultati")
-    ## st.dataframe(df_filtrato, use_container_width=True)
 
     # ------------------------------
     # DOWNLOAD EXCEL
     # ------------------------------
     st.subheader("⬇️ Esporta")
-    buffer = BytesIO()
-    
-    if not df_filtrato.empty:
-        csv = df_filtrato.to_csv(index=False).encode("utf-8")
+
+    # la selezione completa si legge solo quando serve davvero
+    if nr_interventi and st.button("📦 Prepara file CSV / Excel"):
+        sql, params = sql_analisi_ticket(filtri)
+
         st.download_button(
             label="⬇️📥 Scarica dati CSV",
-            data=csv,
+            data=esporta_csv(sql, params),
             file_name="ticket_filtrati.csv",
             mime="text/csv",
         )
-     ## Creiamo una copia con valori formattati in europeo
-    df_export = df_filtrato.copy()
-    df_export["fattura"] = df_export["fattura"].apply(lambda x: f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
-    df_export["data_intervento"] = df_export["data_intervento"].dt.strftime("%d/%m/%Y")
-    
-    # Creiamo una copia con valori formattati in europeo
-    
-    df_export = df_filtrato.copy()
-    df_export["fattura"] = df_export["fattura"].apply(lambda x: f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
-    df_export["data_intervento"] = df_export["data_intervento"].dt.strftime("%d/%m/%Y")
-
-    df_export.to_excel(buffer, index=False, engine="openpyxl")
-    buffer.seek(0)
-
-    st.download_button(
-        label="⬇️📥 Scarica dati Excel",
-        data=buffer,
-        file_name="analisi_ticket.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+
+        # euro e date restano numeri/date veri, formattati dalla cella Excel
+        st.download_button(
+            label="⬇️📥 Scarica dati Excel",
+            data=esporta_excel(sql, params, formati=FORMATI_TICKET, foglio="Analisi"),
+            file_name="analisi_ticket.xlsx",
+            mime=MIME_XLSX
+        )
 
 # ==========================
 # FUNZIONI DATABASE
 # ==========================
 
+# --------------------------------
+# Salvataggio modifiche da st.data_editor
+# --------------------------------
+def tipi_colonne(conn, tabella):
+    """{colonna: tipo} da PRAGMA table_info, in cache finché lo schema non cambia."""
+    versione = conn.execute("PRAGMA schema_version").fetchone()[0]
+
+    def costruisci():
+        return {r[1]: (r[2] or "TEXT").upper() for r in conn.execute(f'PRAGMA table_info("{tabella}")')}
+
+    return get_cache_riferimenti().get_or_build(
+        ("tipi_colonne", tabella), (("schema", versione),), costruisci
+    )
+
+
+def _valore_sql(val, tipo):
+    """Conversione base dei tipi secondo l'affinità della colonna."""
+    if val is None or (not isinstance(val, str) and pd.isna(val)):
+        return None
+    if "INT" in tipo:
+        return int(val)
+    if "REAL" in tipo or "FLOA" in tipo or "DOUB" in tipo:
+        return float(val)
+    return str(val)
+
+
+def _valore_extra(val):
+    """Valore per extra_json: i numeri restano numeri, il resto diventa testo."""
+    if isinstance(val, (int, float, np.number)) and not isinstance(val, (bool, np.bool_)):
+        return _valore_sql(val, "INTEGER" if float(val).is_integer() else "REAL")
+    return _valore_sql(val, "TEXT")
+
+
+def gruppi_modifiche(originale, modificato, chiave="id"):
+    """
+    Celle cambiate tra il DataFrame mostrato e quello restituito da
+    st.data_editor (num_rows="fixed", stesso indice), raggruppate per
+    insieme di colonne: {(col, ...): [[valore, ..., id], ...]}.
+    Vuoti (None/NaN/NaT) sono uguali tra loro, a prescindere dal dtype.
+    """
+    colonne = [c for c in modificato.columns if c != chiave and c in originale.columns]
+    prima = originale[colonne].reindex(modificato.index)
+    dopo = modificato[colonne]
+
+    vuoti_prima = prima.isna().to_numpy()
+    vuoti_dopo = dopo.isna().to_numpy()
+    valori_prima = prima.to_numpy(dtype=object)
+    valori_dopo = dopo.to_numpy(dtype=object)
+    diversi = (vuoti_prima != vuoti_dopo) | (
+        ~vuoti_prima & ~vuoti_dopo & (valori_prima != valori_dopo)
+    )
+
+    nomi = np.asarray(colonne, dtype=object)
+    chiavi = modificato[chiave].to_numpy()
+    gruppi = {}
+    for r in np.flatnonzero(diversi.any(axis=1)):
+        j = np.flatnonzero(diversi[r])
+        gruppi.setdefault(tuple(nomi[j]), []).append(list(valori_dopo[r, j]) + [chiavi[r]])
+    return gruppi
+
+
+def salva_modifiche_celle(tabella, gruppi, chiave="id"):
+    """
+    Scrive le sole celle cambiate in un'unica transazione: un executemany
+    UPDATE per ogni insieme di colonne. Le colonne 'extra.<chiave>' finiscono
+    in extra_json con un solo json_set. Ritorna (righe, celle) scritte.
+    """
+    righe = celle = 0
+    with transazione() as conn:
+        tipi = tipi_colonne(conn, tabella)
+        for colonne, valori in gruppi.items():
+            vere = [i for i, c in enumerate(colonne) if not c.startswith(PREFISSO_EXTRA)]
+            extra = [i for i, c in enumerate(colonne) if c.startswith(PREFISSO_EXTRA)]
+            assegnazioni = [f'"{colonne[i]}" = ?' for i in vere]
+            if extra:
+                percorsi = ", ".join(
+                    f"{_sql_testo(percorso_json(colonne[i][len(PREFISSO_EXTRA):]))}, ?" for i in extra
+                )
+                assegnazioni.append(
+                    "extra_json = json_set(CASE WHEN json_valid(extra_json) "
+                    f"THEN extra_json ELSE '{{}}' END, {percorsi})"
+                )
+            set_clause = ", ".join(assegnazioni)
+            params = [
+                [_valore_sql(riga[i], tipi.get(colonne[i], "TEXT")) for i in vere]
+                + [_valore_extra(riga[i]) for i in extra]
+                + [int(riga[-1])]
+                for riga in valori
+            ]
+            conn.executemany(f'UPDATE "{tabella}" SET {set_clause} WHERE "{chiave}" = ?', params)
+            righe += len(params)
+            celle += len(params) * len(colonne)
+        if righe:
+            incrementa_versione(conn, tabella)
+    return righe, celle
+
+
 def get_clienti():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql("SELECT * FROM clienti", conn)
-    conn.close()
-    return df
+    return carica_riferimento("clienti", "SELECT * FROM clienti", ("clienti",))
 
 def get_colonne_clienti():
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_connessione(sola_lettura=True)
     cur = conn.cursor()
     cur.execute("PRAGMA table_info(clienti)")
     columns = [row[1] for row in cur.fetchall()]
-    conn.close()
     return [c for c in columns if c != "id"]
 
-def aggiorna_cliente(row):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
 
-    # Recuperiamo i tipi delle colonne
-    cur.execute("PRAGMA table_info(clienti)")
-    col_info = {c[1]: c[2].upper() for c in cur.fetchall()}  # {colonna: tipo}
-
-    valori = []
-    for col in ["id", "matricola", "matint", "modello", "proprieta","codice", "azienda", "ubicazione", "indirizzo", "citta", "provincia", "contatto", "vestizione", "note", "ddt", "regione"]:
-        val = row[col]
-        tipo = col_info.get(col, "TEXT")
-
-        # Conversione base dei tipi
-        if pd.isna(val):
-            val = None
-        elif "INT" in tipo:
-            val = int(val)
-        elif "REAL" in tipo or "FLOA" in tipo or "DOUB" in tipo:
-            val = float(val)
-        else:
-            val = str(val)
+CLIENTI_DIMENSIONI_PAGINA = [25, 50, 100, 200]
 
-        valori.append(val)
 
-    cur.execute("""
-        INSERT INTO clienti (id, matricola, matint, modello, proprieta, codice, azienda, ubicazione, indirizzo, citta, provincia, contatto, vestizione, note, ddt, regione)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?)
-        ON CONFLICT(id) DO UPDATE SET
-            matricola=excluded.matricola,
-            matint=excluded.matint,
-            modello=excluded.modello,
-            proprieta=excluded.proprieta,
-            codice=excluded.codice,
-            azienda=excluded.azienda,
-            ubicazione=excluded.ubicazione,
-            indirizzo=excluded.indirizzo,
-            citta=excluded.citta,
-            provincia=excluded.provincia,
-            contatto=excluded.contatto,
-            vestizione=excluded.vestizione,
-            note=excluded.note,
-            ddt=excluded.ddt,
-            regione=excluded.regione
-    """, valori)
-
-    conn.commit()
-    conn.close()
+def _where_clienti(testo=None, filtri=None):
+    """
+    WHERE per l'anagrafica clienti: 'filtri' {colonna: valore} in uguaglianza
+    (colonne indicizzate/faccette), 'testo' contenuto in una delle
+    COLONNE_FTS_CLIENTI. Da 3 caratteri passa dall'indice trigram clienti_fts.
+    """
+    condizioni, params = [], []
+    for colonna, valore in (filtri or {}).items():
+        if valore is not None:
+            condizioni.append(f'"{colonna}" = ?')
+            params.append(valore)
+    testo = (testo or "").strip()
+    if len(testo) >= 3:
+        colonne = " ".join(COLONNE_FTS_CLIENTI)
+        condizioni.append("id IN (SELECT rowid FROM clienti_fts WHERE clienti_fts MATCH ?)")
+        params.append("{" + colonne + "} : \"" + testo.replace('"', '""') + "\"")
+    elif testo:
+        # sotto i 3 caratteri il trigram non indicizza: LIKE sulle stesse colonne
+        condizioni.append("(" + " OR ".join(
+            f"{c} LIKE ? ESCAPE '\\'" for c in COLONNE_FTS_CLIENTI
+        ) + ")")
+        params += [_like_contiene(testo)] * len(COLONNE_FTS_CLIENTI)
+    return (" AND ".join(condizioni) or "1"), params
+
+
+def conta_clienti(testo=None, filtri=None):
+    where, params = _where_clienti(testo, filtri)
+    conn = get_connessione(sola_lettura=True)
+    return conn.execute(f"SELECT COUNT(*) FROM clienti WHERE {where}", params).fetchone()[0]
+
+
+def pagina_lista_clienti(testo=None, filtri=None, ordina="id", crescente=True, pagina=0, n=50, extra=()):
+    """
+    Una pagina dell'anagrafica clienti con filtri e ordinamento fatti in SQL.
+    'ordina' deve essere una colonna di clienti; a parità vale l'id.
+    Le chiavi 'extra' di extra_json sono aggiunte come colonne 'extra.<chiave>'.
+    """
+    if ordina not in tipi_colonne(get_connessione(sola_lettura=True), "clienti"):
+        raise ValueError(f"Colonna di ordinamento non valida: {ordina}")
+    verso = "ASC" if crescente else "DESC"
+    where, params = _where_clienti(testo, filtri)
+    conn = get_connessione(sola_lettura=True)
+    voci = [f'"{c}"' for c in colonne_editor("clienti")] + colonne_extra_sql("clienti", extra)
+    return pd.read_sql_query(f"""
+        SELECT {", ".join(voci)}
+        FROM clienti
+        WHERE {where}
+        ORDER BY "{ordina}" {verso}, id {verso}
+        LIMIT ? OFFSET ?
+    """, conn, params=params + [n, pagina * n])
 
 def aggiungi_cliente(nuovi_valori):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
     colonne = ", ".join(nuovi_valori.keys())
     placeholders = ", ".join(["?"] * len(nuovi_valori))
     valori = list(nuovi_valori.values())
-    cur.execute(f"INSERT INTO clienti ({colonne}) VALUES ({placeholders})", valori)
-    conn.commit()
-    conn.close()
+    with transazione() as conn:
+        conn.execute(f"INSERT INTO clienti ({colonne}) VALUES ({placeholders})", valori)
+        incrementa_versione(conn, "clienti")
 
 def elimina_cliente_by_id(cliente_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM clienti WHERE id=?", (cliente_id,))
-    conn.commit()
-    conn.close()
+    with transazione() as conn:
+        conn.execute("DELETE FROM clienti WHERE id=?", (cliente_id,))
+        incrementa_versione(conn, "clienti")
     
 def reset_clienti():
     """Elimina tutti i clienti e resetta l'ID autoincrement"""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM clienti")  # Elimina tutti i dati
-    cur.execute("DELETE FROM sqlite_sequence WHERE name='clienti'")  # Reset contatore ID
-    conn.commit()
-    conn.close()
+    with transazione() as conn:
+        conn.execute("DELETE FROM clienti")  # Elimina tutti i dati
+        conn.execute("DELETE FROM sqlite_sequence WHERE name='clienti'")  # Reset contatore ID
+        incrementa_versione(conn, "clienti")
     
 def reset_ticket():
     """Elimina tutti i ticket e resetta l'ID autoincrement"""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM ticket")  # Elimina tutti i dati
-    cur.execute("DELETE FROM sqlite_sequence WHERE name='ticket'")  # Reset contatore ID
-    conn.commit()
-    conn.close()
+    with transazione() as conn:
+        conn.execute("DELETE FROM ticket")  # Elimina tutti i dati
+        conn.execute("DELETE FROM sqlite_sequence WHERE name='ticket'")  # Reset contatore ID
+        incrementa_versione(conn, "ticket")
 def aggiorna_regioni_clienti(db_path=DB_PATH):
     """Aggiorna la colonna regione in clienti in base alla tabella province"""
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
+    # la colonna regione è garantita dalle migrazioni (COLONNE_CLIENTI)
+    # aggiorna usando join
+    with transazione(db_path) as conn:
+        conn.execute("""
+            UPDATE clienti
+            SET regione = (
+                SELECT p.regione FROM province p WHERE p.provincia = clienti.provincia
+            )
+            WHERE provincia IS NOT NULL
+        """)
+        incrementa_versione(conn, "clienti")
+    print("✅ Clienti aggiornati con la regione")
 
-    # assicurati che esista la colonna regione nella tabella clienti
-    cur.execute("PRAGMA table_info(clienti)")
-    colonne = [c[1] for c in cur.fetchall()]
-    if "regione" not in colonne:
-        cur.execute("ALTER TABLE clienti ADD COLUMN regione TEXT")
 
-    # aggiorna usando join
-    cur.execute("""
-        UPDATE clienti
-        SET regione = (
-            SELECT p.regione FROM province p WHERE p.provincia = clienti.provincia
-        )
-        WHERE provincia IS NOT NULL
-    """)
+# --------------------------------
+# Copertura tecnica per distanza
+# --------------------------------
+RAGGIO_COPERTURA_KM = 50
+COPERTURA_BLOCCO_CLIENTI = 4096   # righe della matrice clienti × tecnici per passata
+RAGGIO_TERRA_KM = 6371.0088
+
+# Clienti con il flag "ha ticket" per matricola (EXISTS sull'indice matricola)
+SQL_CLIENTI_COPERTURA = """
+    SELECT
+        c.id, c.regione, c.provincia, c.citta, c.matricola, c.proprieta,
+        c.modello, c.azienda, c.indirizzo, c.lat, c.lon,
+        EXISTS (SELECT 1 FROM ticket t WHERE t.matricola = c.matricola) AS con_ticket
+    FROM clienti c
+    ORDER BY c.id
+"""
+
+
+def _coordinate(df):
+    """(lat, lon, validi) come array float; vuoti, testo e 0/0 non sono validi."""
+    lat = pd.to_numeric(df["lat"], errors="coerce").to_numpy(dtype=float)
+    lon = pd.to_numeric(df["lon"], errors="coerce").to_numpy(dtype=float)
+    validi = np.isfinite(lat) & np.isfinite(lon) & ~((lat == 0) & (lon == 0))
+    return lat, lon, validi
+
+
+def _versori(lat, lon):
+    """Punti sulla sfera unitaria (n × 3) da lat/lon in gradi."""
+    phi, lam = np.radians(lat), np.radians(lon)
+    cos_phi = np.cos(phi)
+    return np.column_stack((cos_phi * np.cos(lam), cos_phi * np.sin(lam), np.sin(phi)))
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = (np.sin((phi2 - phi1) / 2) ** 2
+         + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * RAGGIO_TERRA_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def tecnico_piu_vicino(lat_c, lon_c, lat_t, lon_t, blocco=COPERTURA_BLOCCO_CLIENTI):
+    """
+    Per ogni cliente (distanza km, indice) del tecnico più vicino.
+    Il più vicino è quello col prodotto scalare massimo tra versori (un
+    prodotto matrice a blocchi di clienti, memoria blocco × tecnici); la
+    distanza è poi calcolata con haversine sulla sola coppia scelta.
+    Senza tecnici la distanza è inf e l'indice -1.
+    """
+    n = len(lat_c)
+    distanze = np.full(n, np.inf)
+    indici = np.full(n, -1, dtype=np.int64)
+    if n == 0 or len(lat_t) == 0:
+        return distanze, indici
+
+    versori_t = _versori(lat_t, lon_t).T
+    versori_c = _versori(lat_c, lon_c)
+    for inizio in range(0, n, blocco):
+        fine = min(inizio + blocco, n)
+        indici[inizio:fine] = (versori_c[inizio:fine] @ versori_t).argmax(axis=1)
+    distanze[:] = _haversine_km(lat_c, lon_c, lat_t[indici], lon_t[indici])
+    return distanze, indici
+
+
+def distanze_copertura():
+    """
+    Clienti con distanza (km) e nome del tecnico più vicino, in cache finché
+    clienti, tecnici e ticket non cambiano. distanza_km è NaN se il cliente
+    non ha coordinate.
+    """
+    def costruisci():
+        conn = get_connessione(sola_lettura=True)
+        clienti = pd.read_sql_query(SQL_CLIENTI_COPERTURA, conn)
+        tecnici = pd.read_sql_query("SELECT nome, lat, lon FROM tecnici", conn)
+
+        lat_c, lon_c, ok_c = _coordinate(clienti)
+        lat_t, lon_t, ok_t = _coordinate(tecnici)
+        nomi = tecnici["nome"].to_numpy(dtype=object)[ok_t]
+        d, j = tecnico_piu_vicino(lat_c[ok_c], lon_c[ok_c], lat_t[ok_t], lon_t[ok_t])
+
+        distanza = np.full(len(clienti), np.nan)
+        distanza[ok_c] = d
+        vicino = np.full(len(clienti), None, dtype=object)
+        if len(nomi):
+            vicino[ok_c] = nomi[j]
+        clienti["distanza_km"] = distanza
+        clienti["tecnico_vicino"] = vicino
+        return clienti.drop(columns=["lat", "lon"])
+
+    return get_cache_riferimenti().get_or_build(
+        ("distanze_copertura", ()), versioni_tabelle("clienti", "tecnici", "ticket"), costruisci
+    )
+
+
+def copertura_clienti(raggio_km=RAGGIO_COPERTURA_KM):
+    """
+    (riepilogo, dettaglio, senza_coordinate) dei clienti più lontani di
+    'raggio_km' dal tecnico più vicino. Il riepilogo è per regione/provincia.
+    """
+    df = distanze_copertura()
+    senza_coordinate = int(df["distanza_km"].isna().sum())
+    fuori = df[df["distanza_km"] > raggio_km]
+
+    totali = df.groupby(["regione", "provincia"], dropna=False).size().rename("Clienti totali")
+    riepilogo = (
+        fuori.groupby(["regione", "provincia"], dropna=False)
+        .agg(**{
+            "Fuori raggio": ("id", "size"),
+            "N. Località": ("citta", "nunique"),
+            "Distanza max (km)": ("distanza_km", "max"),
+            "con_ticket": ("con_ticket", "max"),
+        })
+        .join(totali)
+        .reset_index()
+        .rename(columns={"regione": "Regione", "provincia": "Provincia"})
+        .sort_values(["Fuori raggio", "Distanza max (km)"], ascending=False)
+    )
+    n = riepilogo["Fuori raggio"]
+    # pallini criticità
+    riepilogo["Copertura"] = np.select([n == 1, n <= 3], ["🟡", "🟠"], default="🔴")
+    riepilogo["Warning Ticket"] = np.where(riepilogo.pop("con_ticket") > 0, "⚠️", "")
+    riepilogo["Distanza max (km)"] = riepilogo["Distanza max (km)"].round(1)
+    riepilogo = riepilogo[[
+        "Regione", "Provincia", "Fuori raggio", "Clienti totali", "N. Località",
+        "Distanza max (km)", "Copertura", "Warning Ticket",
+    ]]
+
+    dettaglio = pd.DataFrame({
+        "Regione": fuori["regione"],
+        "Provincia": fuori["provincia"],
+        "Matricola": fuori["matricola"],
+        "Proprietà": fuori["proprieta"],
+        "Modello": fuori["modello"],
+        "Azienda": fuori["azienda"],
+        "Indirizzo": fuori["indirizzo"],
+        "Città": fuori["citta"],
+        "Tecnico più vicino": fuori["tecnico_vicino"],
+        "Distanza (km)": fuori["distanza_km"].round(1),
+        "Warning Ticket": np.where(fuori["con_ticket"] > 0, "⚠️", ""),
+    }).sort_values("Distanza (km)", ascending=False)
+    return riepilogo, dettaglio, senza_coordinate
 
-    conn.commit()
-    conn.close()
-    print("✅ Clienti aggiornati con la regione")
-    
 
 
 # ==========================
@@ -1473,118 +3279,144 @@ def pagina_clienti():
 # -------------------------
 # ANALISI COPERTURA TECNICI
 # -------------------------
-    st.subheader("⚠️👷 Province clienti senza copertura tecnica")
-
-    conn = sqlite3.connect(DB_PATH)
-    df_clienti = pd.read_sql_query("SELECT * FROM clienti", conn)
-    df_tecnici = pd.read_sql_query("SELECT * FROM tecnici", conn)
-    df_ticket = pd.read_sql_query("SELECT * FROM ticket", conn)
-    conn.close()
-
-    if not df_clienti.empty:
-        province_coperte = set(df_tecnici["provincia"].dropna().unique())
-        province_clienti = set(df_clienti["provincia"].dropna().unique())
-        province_scoperte = province_clienti - province_coperte
-
-        if province_scoperte:
-            rows_summary = []
-            dettagli = []
-
-            for prov in province_scoperte:
-                clienti_prov = df_clienti[df_clienti["provincia"] == prov]
-                num_clienti = len(clienti_prov)
-                num_citta = clienti_prov["citta"].nunique()
-
-             # pallini criticità
-                if num_clienti == 1:
-                    copertura = "🟡"
-                elif 2 <= num_clienti <= 3:
-                    copertura = "🟠"
-                else:
-                    copertura = "🔴"
-
-            # 👇 controllo warning a livello provincia
-                clienti_con_ticket = clienti_prov["matricola"].isin(df_ticket["matricola"]).any()
-                warning = "⚠️" if clienti_con_ticket else ""
-
-                rows_summary.append({
-                    "Provincia": prov,
-                    "N. Clienti": num_clienti,
-                    "N. Località": num_citta,
-                    "Copertura": copertura,
-                    "Warning Ticket": warning   # nuova colonna
-                })
-
-            # dettaglio clienti provincia
-                for _, cli in clienti_prov.iterrows():
-                    has_ticket = df_ticket[df_ticket["matricola"] == cli.get("matricola", "")]
-                    warning_cli = "⚠️" if not has_ticket.empty else ""
-
-                    dettagli.append({
-                        "Provincia": prov,
-                        "Matricola": cli.get("matricola", ""),
-                        "Proprietà": cli.get("proprieta", ""),
-                        "Modello": cli.get("modello", ""),
-                        "Azienda": cli.get("azienda", ""),
-                        "Indirizzo": cli.get("indirizzo", ""),
-                        "Città": cli.get("citta", ""),
-                        "Warning Ticket": warning_cli
-                    })
-
-
-            # Tabella riepilogo per provincia
-            df_summary = pd.DataFrame(rows_summary)
-            st.dataframe(df_summary, use_container_width=True, height=240)
-
-            # Tabella dettaglio TUTTE le province (espandibile)
-            with st.expander("🔍 Mostra dettaglio clienti di tutte le province scoperte"):
-                df_dettagli = pd.DataFrame(dettagli)
-                st.dataframe(df_dettagli, use_container_width=True)
-
-                # Download Excel unico
-                file_path = "dettaglio_clienti_scoperti.xlsx"
-                df_dettagli.to_excel(file_path, index=False)
-
-                with open(file_path, "rb") as f:
-                    st.download_button(
-                        label="📥 Scarica Excel con dettagli",
-                        data=f,
-                        file_name=file_path,
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
+    st.subheader("⚠️👷 Clienti senza copertura tecnica")
+
+    raggio_km = st.number_input(
+        "📏 Raggio di copertura (km)", min_value=5, max_value=500,
+        value=RAGGIO_COPERTURA_KM, step=5,
+    )
+    df_summary, df_dettagli, senza_coordinate = copertura_clienti(raggio_km)
+    if senza_coordinate:
+        st.caption(f"📍 {senza_coordinate} clienti senza coordinate esclusi dal calcolo")
+
+    if df_summary.empty:
+        st.success(f"✅ Tutti i clienti hanno un tecnico entro {raggio_km} km")
+    else:
+        # Tabella riepilogo per regione/provincia
+        st.dataframe(df_summary, use_container_width=True, height=240, hide_index=True)
+
+        # Tabella dettaglio clienti fuori raggio (espandibile)
+        with st.expander("🔍 Mostra dettaglio clienti fuori raggio"):
+            st.dataframe(df_dettagli, use_container_width=True, hide_index=True)
+
+            # Download Excel unico (in memoria)
+            st.download_button(
+                label="📥 Scarica Excel con dettagli",
+                data=excel_da_righe(
+                    list(df_dettagli.columns),
+                    df_dettagli.itertuples(index=False, name=None),
+                    foglio="Clienti fuori raggio",
+                ),
+                file_name="dettaglio_clienti_fuori_raggio.xlsx",
+                mime=MIME_XLSX
+            )
 
 
     # -------------------------
     # TABELLA CLIENTI
     # -------------------------
-    df = get_clienti()
-
-    if df.empty:
+    # una pagina alla volta: filtri, ordinamento e paginazione in SQL
+    if conta_clienti() == 0:
         st.warning("⚠️ Nessun cliente trovato nel database")
     else:
         st.subheader("✏️ Modifica Clienti Esistenti")
 
+        f1, f2, f3 = st.columns([2, 1, 1])
+        with f1:
+            testo_clienti = st.text_input(
+                "🔍 Filtra (matricola, proprieta, codice, azienda o indirizzo)", key="clienti_filtro_testo"
+            )
+        with f2:
+            lista_regioni, formato_regioni = opzioni_faccetta("clienti", "regione", "Tutte")
+            regione_clienti = st.selectbox(
+                "📌 Regione", lista_regioni, format_func=formato_regioni, key="clienti_filtro_regione"
+            )
+        with f3:
+            lista_proprieta, formato_proprieta = opzioni_faccetta("clienti", "proprieta", "Tutte")
+            proprieta_clienti = st.selectbox(
+                "👤 Proprietà", lista_proprieta, format_func=formato_proprieta, key="clienti_filtro_proprieta"
+            )
+
+        o1, o2, o3 = st.columns([2, 1, 1])
+        with o1:
+            ordina_clienti = st.selectbox(
+                "↕️ Ordina per", colonne_editor("clienti"), key="clienti_ordina"
+            )
+        with o2:
+            crescente_clienti = st.radio(
+                "Verso", ["Crescente", "Decrescente"], horizontal=True, key="clienti_verso"
+            ) == "Crescente"
+        with o3:
+            dim_pagina_clienti = st.selectbox(
+                "Righe per pagina", CLIENTI_DIMENSIONI_PAGINA, index=1, key="clienti_dim_pagina"
+            )
+
+        # attributi importati da Excel (extra_json) da mostrare e modificare come colonne
+        extra_clienti = tuple(st.multiselect(
+            "🧩 Campi extra", chiavi_extra("clienti")["chiave"].tolist(), key="clienti_extra"
+        ))
+
+        filtri_clienti = {
+            "regione": regione_clienti if regione_clienti != "Tutte" else None,
+            "proprieta": proprieta_clienti if proprieta_clienti != "Tutte" else None,
+        }
+
+        # si torna alla prima pagina se cambiano filtri o ordinamento
+        chiave_filtri = (testo_clienti, regione_clienti, proprieta_clienti,
+                         ordina_clienti, crescente_clienti, dim_pagina_clienti, extra_clienti)
+        if st.session_state.get("clienti_lista_filtri") != chiave_filtri:
+            st.session_state["clienti_lista_filtri"] = chiave_filtri
+            st.session_state["clienti_lista_pagina"] = 0
+        n_pagina = st.session_state["clienti_lista_pagina"]
+
+        totale_clienti = conta_clienti(testo_clienti, filtri_clienti)
+        n_pagine = max(1, -(-totale_clienti // dim_pagina_clienti))
+        df = pagina_lista_clienti(
+            testo_clienti, filtri_clienti, ordina_clienti, crescente_clienti,
+            n_pagina, dim_pagina_clienti, extra_clienti
+        )
+
+        # le modifiche valgono per la pagina mostrata: ogni pagina ha il suo editor
         edited_df = st.data_editor(
             df,
             num_rows="fixed",
             use_container_width=True,
-            hide_index=True
+            hide_index=True,
+            key=f"clienti_editor_{hash(chiave_filtri)}_{n_pagina}"
         )
 
-        # 🔎 Confronto forzando i valori a stringa (per non perdere modifiche)
-        changed_rows = edited_df.astype(str).compare(df.astype(str))
+        c_prec, c_info, c_succ = st.columns([1, 2, 1])
+        with c_prec:
+            if st.button("◀️ Precedente", disabled=n_pagina == 0, key="clienti_pag_prec"):
+                st.session_state["clienti_lista_pagina"] -= 1
+                st.rerun()
+        with c_info:
+            st.caption(f"Pagina {n_pagina + 1} di {n_pagine} · {totale_clienti} clienti · salva prima di cambiare pagina")
+        with c_succ:
+            if st.button("Successiva ▶️", disabled=n_pagina + 1 >= n_pagine, key="clienti_pag_succ"):
+                st.session_state["clienti_lista_pagina"] += 1
+                st.rerun()
+
+        esito = st.session_state.pop("clienti_esito_salvataggio", None)
+        if esito:
+            st.success(esito)
 
-        if not changed_rows.empty:
-            st.info("🔄 Sono state rilevate modifiche, clicca Salva per aggiornare il database.")
+        # 🔎 Solo le celle davvero cambiate, raggruppate per colonne
+        gruppi = gruppi_modifiche(df, edited_df)
+
+        if gruppi:
+            n_righe = sum(len(v) for v in gruppi.values())
+            st.info(f"🔄 {n_righe} clienti modificati, clicca Salva per aggiornare il database.")
             if st.button("💾 Salva modifiche"):
-                for i in edited_df.index:
-                    if not edited_df.loc[i].equals(df.loc[i]):
-                        try:
-                            aggiorna_cliente(edited_df.loc[i])
-                        except Exception as e:
-                            st.error(f"❌ Errore nell'aggiornamento cliente ID {edited_df.loc[i]['id']}: {e}")
-                st.success("✅ Database aggiornato con successo")
-                st.rerun()
+                try:
+                    righe, celle = salva_modifiche_celle("clienti", gruppi)
+                except Exception as e:
+                    st.error(f"❌ Errore nel salvataggio, nessuna modifica applicata: {e}")
+                else:
+                    st.session_state["clienti_esito_salvataggio"] = (
+                        f"✅ Database aggiornato: {righe} clienti, {celle} celle"
+                    )
+                    st.rerun()
 
     # 👉 Da inserire alla fine di pagina_clienti()
     st.markdown("---")
@@ -1603,35 +3435,23 @@ def pagina_clienti():
 
     st.subheader("➕ Aggiungi Nuovo Cliente")
 
-    # Connessione al DB
-    conn = sqlite3.connect(DB_PATH)
-  
-    # Carichiamo tabella codici_clienti
-    df_codici = pd.read_sql_query("SELECT * FROM codici_clienti", conn)
-    conn.close()
-
-    # Ricerca codice per indirizzo o città
+    # Ricerca codice per indirizzo o città (indice trigram, solo i primi risultati)
     search_codice = st.text_input("🔍 CERCA PUNTO VENDITA ( x indirizzo o città)")
     codice_sel = None
     precompilati = {}
 
     if search_codice and len(search_codice) >= 3:
-        risultati = df_codici[
-            df_codici["indirizzo"].str.contains(search_codice, case=False, na=False) |
-            df_codici["citta"].str.contains(search_codice, case=False, na=False)
-        ]
+        risultati = cerca_codici(search_codice, limit=50)
 
-        if not risultati.empty:
-            risultati["label"] = risultati.apply(
-                lambda x: f"{x.get('codice','')} | {x.get('indirizzo','')} | {x.get('citta','')} "
-                f"({x.get('provincia','')}) | {x.get('insegna','')} | {x.get('sub_insegna','')} "
-                f"| {x.get('gruppo_commerciale','')}",
-                axis=1
+        if risultati:
+            codice_sel = st.selectbox(
+                "Seleziona punto vendita trovato",
+                range(len(risultati)),
+                format_func=lambda i: risultati[i]["label"],
             )
-            codice_sel = st.selectbox("Seleziona punto vendita trovato", risultati["label"])
 
-            if codice_sel:
-                riga = risultati[risultati["label"] == codice_sel].iloc[0]
+            if codice_sel is not None:
+                riga = risultati[codice_sel]
                 precompilati = {
                     "codice": riga["codice"],
                     "indirizzo": riga["indirizzo"],
@@ -1658,7 +3478,7 @@ def pagina_clienti():
                 matricola = nuovi_valori.get("matricola", "").strip()
 
                 try:
-                    conn = sqlite3.connect(DB_PATH)
+                    conn = get_connessione(sola_lettura=True)
                     cur = conn.cursor()
 
                 # Se matricola è valorizzata → deve essere unica
@@ -1666,12 +3486,10 @@ def pagina_clienti():
                         cur.execute("SELECT 1 FROM clienti WHERE matricola = ?", (matricola,))
                         if cur.fetchone():
                             st.error("❌ Errore: la matricola inserita esiste già.")
-                            conn.close()
                             st.stop()
 
                 # Inserimento cliente
                     aggiungi_cliente(nuovi_valori)
-                    conn.close()
 
                     st.success("✅ Nuovo cliente aggiunto con successo")
                     st.rerun()
@@ -1692,17 +3510,8 @@ def pagina_clienti():
     search_term = st.text_input("🔍 Cerca cliente (matricola, azienda, codice, proprieta o indirizzo)")
 
     if search_term:
-        # Filtriamo su più colonne
-        risultati = df[
-            df.apply(
-                lambda x: search_term.lower() in str(x["matricola"]).lower()
-                or search_term.lower() in str(x["proprieta"]).lower()
-                or search_term.lower() in str(x["codice"]).lower()
-                or search_term.lower() in str(x["azienda"]).lower()
-                or search_term.lower() in str(x["indirizzo"]).lower(),
-                axis=1
-            )
-        ]
+        # stessa query dell'editor (indice trigram), solo i primi risultati
+        risultati = pagina_lista_clienti(search_term, n=PICKER_MAX_RISULTATI)
     else:
         risultati = pd.DataFrame()
 
@@ -1780,58 +3589,41 @@ def pagina_clienti():
 TABLE = "tecnici"
 
 def get_tecnici():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql(f"SELECT * FROM {TABLE}", conn)
-    conn.close()
-    return df
+    return carica_riferimento("tecnici", f"SELECT * FROM {TABLE}", (TABLE,))
 
 def get_column_names():
-    conn = sqlite3.connect(DB_FILE)
-    cols = [row[1] for row in conn.execute(f"PRAGMA table_info({TABLE})")]
-    conn.close()
-    return [c for c in cols if c != "id"]
-
-def update_tecnico(row):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    # costruisco update dinamico
-    cols = [c for c in row.index if c != "id"]
-    set_clause = ", ".join([f"{c}=?" for c in cols])
-    values = [row[c] for c in cols] + [int(row["id"])]
-    cur.execute(f"UPDATE {TABLE} SET {set_clause} WHERE id=?", values)
-    conn.commit()
-    conn.close()
+    """Colonne del form e delle etichette: quelle dell'editor (senza extra_json) tranne id."""
+    return [c for c in colonne_editor(TABLE) if c != "id"]
 
 def add_tecnico(vals: dict):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
     cols = ", ".join(vals.keys())
     ph = ", ".join(["?"] * len(vals))
-    cur.execute(f"INSERT INTO {TABLE} ({cols}) VALUES ({ph})", list(vals.values()))
-    conn.commit()
-    conn.close()
+    with transazione() as conn:
+        conn.execute(f"INSERT INTO {TABLE} ({cols}) VALUES ({ph})", list(vals.values()))
+        incrementa_versione(conn, TABLE)
 
 def delete_tecnico_by_id(tid: int):
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute(f"DELETE FROM {TABLE} WHERE id=?", (tid,))
-    conn.commit()
-    conn.close()
+    with transazione() as conn:
+        conn.execute(f"DELETE FROM {TABLE} WHERE id=?", (tid,))
+        incrementa_versione(conn, TABLE)
 
 def reset_tecnici():
     """Elimina tutti i tecnici e resetta l'ID autoincrement"""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM tecnici")  # Elimina tutti i dati
-    cur.execute("DELETE FROM sqlite_sequence WHERE name='tecnici'")  # Reset contatore ID
-    conn.commit()
-    conn.close()
+    with transazione() as conn:
+        conn.execute("DELETE FROM tecnici")  # Elimina tutti i dati
+        conn.execute("DELETE FROM sqlite_sequence WHERE name='tecnici'")  # Reset contatore ID
+        incrementa_versione(conn, "tecnici")
 
 
 # --- Pagina Gestione Tecnici ---
 def pagina_tecnici():
     st.header("👷 GESTIONE TECNICI")
 
-    df = get_tecnici()
+    # attributi importati da Excel (extra_json) da mostrare e modificare come colonne
+    extra_tecnici = tuple(st.multiselect(
+        "🧩 Campi extra", chiavi_extra(TABLE)["chiave"].tolist(), key="tecnici_extra"
+    ))
+    df = carica_tabella_editor(TABLE, extra_tecnici)
 
     if df.empty:
         st.warning("⚠️ Nessun tecnico trovato nel database")
@@ -1842,19 +3634,30 @@ def pagina_tecnici():
             df,
             num_rows="fixed",
             use_container_width=True,
-            hide_index=True
+            hide_index=True,
+            key=f"tecnici_editor_{','.join(extra_tecnici)}"
         )
 
-        # Confrontiamo i dati originali con quelli modificati
-        changes = edited.compare(df)
-        if not changes.empty:
-            st.info("🔄 Modifiche rilevate! Clicca 'Salva modifiche' per aggiornare il database.")
+        esito = st.session_state.pop("tecnici_esito_salvataggio", None)
+        if esito:
+            st.success(esito)
+
+        # Confrontiamo i dati originali con quelli modificati, cella per cella
+        gruppi = gruppi_modifiche(df, edited)
+        if gruppi:
+            n_righe = sum(len(v) for v in gruppi.values())
+            n_celle = sum(len(v) * len(c) for c, v in gruppi.items())
+            st.info(f"🔄 Modifiche rilevate su {n_righe} tecnici ({n_celle} celle)! Clicca 'Salva modifiche' per aggiornare il database.")
             if st.button("💾 Salva modifiche"):
-                for i in edited.index:
-                    if not edited.loc[i].equals(df.loc[i]):
-                        update_tecnico(edited.loc[i])
-                st.success("✅ Tecnici aggiornati")
-                st.rerun()
+                try:
+                    righe, celle = salva_modifiche_celle(TABLE, gruppi)
+                except Exception as e:
+                    st.error(f"❌ Errore nel salvataggio, nessuna modifica applicata: {e}")
+                else:
+                    st.session_state["tecnici_esito_salvataggio"] = (
+                        f"✅ Tecnici aggiornati: {righe} righe, {celle} celle"
+                    )
+                    st.rerun()
         
         # Aggiungi un messaggio per aggiornare le coordinate
         st.info("🔄 Per aggiornare le coordinate dei tecnici, vai alla pagina 'Mappa Tecnici' e clicca su 'Aggiorna coordinate tecnici'")
@@ -1885,8 +3688,9 @@ def pagina_tecnici():
         st.write("Risultati:")
         st.dataframe(results, use_container_width=True)
 
+        colonne_label = [c for c in df.columns if c != "id"]
         results["label"] = results.apply(
-            lambda x: " | ".join([str(x[c]) for c in get_column_names()]) + f" (ID:{x['id']})",
+            lambda x: " | ".join([str(x[c]) for c in colonne_label]) + f" (ID:{x['id']})",
             axis=1
         )
 
@@ -1916,29 +3720,19 @@ def pagina_import_export():
     col1, col2, col3 = st.columns(3)
     with col1:
         if st.button("📥 Esporta Clienti (Excel)"):
-            rows = get_all("clienti")
-            df = df_from_rows(rows)
-            # Niente: extra_json resta come colonna; chi lo importa può gestirlo
-            out = "export_clienti.xlsx"
-            df.to_excel(out, index=False)
-            with open(out, "rb") as f:
-                st.download_button("Scarica export_clienti.xlsx", f, file_name="clienti.xlsx")
-            if os.path.exists(out):
-                os.remove(out)
+            # i campi extra diventano colonne: reimportando il file tornano in extra_json
+            dati = esporta_excel(sql_export_tabella("clienti"), foglio="Clienti")
+            st.download_button("Scarica export_clienti.xlsx", dati, file_name="clienti.xlsx", mime=MIME_XLSX)
     with col2:
         if st.button("📥 Esporta Tecnici (Excel)"):
-            rows = get_all("tecnici")
-            df = df_from_rows(rows)
-            out = "export_tecnici.xlsx"
-            df.to_excel(out, index=False)
-            with open(out, "rb") as f:
-                st.download_button("Scarica export_tecnici.xlsx", f, file_name="tecnici.xlsx")
-            if os.path.exists(out):
-                os.remove(out)
+            dati = esporta_excel(sql_export_tabella("tecnici"), foglio="Tecnici")
+            st.download_button("Scarica export_tecnici.xlsx", dati, file_name="tecnici.xlsx", mime=MIME_XLSX)
     with col3:
         if st.button("📥 Esporta Ticket (Excel)"):
-            con = connetti_db()
-            df = pd.read_sql_query("""
+            # campi extra come colonne in coda
+            extra_ticket = [k for k in chiavi_extra("ticket")["chiave"] if k not in COLONNE_TICKET]
+            voci_extra = "".join(f",\n                    {v}" for v in colonne_extra_sql("ticket", extra_ticket, prefisso=""))
+            dati = esporta_excel(f"""
                 SELECT
                     t.id,
                     t.numero_ticket,
@@ -1966,51 +3760,16 @@ def pagina_import_export():
                     t.contatto,
                     t.tecnico_nome,
                     t.citta_tecnico,
-                    t.provincia_tecnico
+                    t.provincia_tecnico{voci_extra}
                 FROM ticket t
                 ORDER BY datetime(t.data_creazione) ASC, t.id ASC
-            """, con)
-            con.close()
-
-            out = "export_ticket.xlsx"
-            df.to_excel(out, index=False)
-            with open(out, "rb") as f:
-                st.download_button("Scarica export_ticket.xlsx", f, file_name="ticket.xlsx")
-            if os.path.exists(out):
-                os.remove(out)
+            """, formati=FORMATI_TICKET, foglio="Ticket")
+            st.download_button("Scarica export_ticket.xlsx", dati, file_name="ticket.xlsx", mime=MIME_XLSX)
 
 
                 
     ### UPLOAD TICKET (adattivo) ###
-    # --- Funzione robusta per gestire le date da Excel ---
-    def to_safe_date_str(val):
-        """
-        Converte un valore proveniente da Excel in stringa data 'YYYY-MM-DD',
-        oppure ritorna None se non valido/vuoto.
-        """
-        if pd.isna(val) or val in ("", None):
-            return None
-
-        # Se è già datetime
-        if isinstance(val, (pd.Timestamp, datetime)):
-            return val.strftime("%Y-%m-%d")
-
-        # Se è numerico (Excel serial date)
-        if isinstance(val, (int, float)):
-            try:
-                return pd.to_datetime(val, origin="1899-12-30", unit="D").strftime("%Y-%m-%d")
-            except Exception:
-                return None
-
-        # Se è stringa
-        try:
-            d = pd.to_datetime(str(val), dayfirst=False, errors="coerce")
-            return d.strftime("%Y-%m-%d") if d is not pd.NaT else None
-        except Exception:
-            return None
-
-
-    # --- Upload Ticket (Excel) con colmap/freeze_cols in-scope e usati ---
+    # --- Upload Ticket (Excel): normalizzazione per colonne, duplicati con un solo lookup ---
     st.subheader("⬆️ Upload Ticket (Excel)")
     up = st.file_uploader("Carica un Excel con ticket da inserire", type=["xlsx"], key="up_ticket_excel")
 
@@ -2032,78 +3791,44 @@ def pagina_import_export():
 
             if not st.session_state.upload_done:
                 if st.button("✅ Conferma upload ticket"):
-                    con = connetti_db()
-                    cur = con.cursor()
-                    ins, skip, dup = 0, 0, 0
-
-                    for _, r in df.iterrows():
-                        matricola = str(r.get("matricola") or "").strip()
-                        descrizione = str(r.get("descrizione") or "").strip()
-                        if not matricola or not descrizione:
-                            skip += 1
-                            continue
-
-                        # Campi opzionali dal file Excel (se non ci sono, default vuoto/0)
-                        fattura = r.get("fattura") or 0
-                        note = str(r.get("note") or "")
-                        data_interv = to_safe_date_str(r.get("data_intervento"))
-                        intervento = str(r.get("intervento_svolto") or "")
-                        stato = str(r.get("stato") or "Aperto")
-                        allegato = str(r.get("allegato") or "")
-                        guasto = str(r.get("guasto") or "")
-                        tecnico_nome = str(r.get("tecnico_nome") or "")
-                        citta_tecnico = str(r.get("citta_tecnico") or "")
-                        provincia_tecnico = str(r.get("provincia_tecnico") or "")
-                        numero_ticket = str(r.get("numero_ticket") or "")
-                        cliente_id= str(r.get("cliente_id") or "")
-
-                        # Campi cliente presi DIRETTAMENTE dal file Excel
-                        azienda = str(r.get("azienda") or "")
-                        indirizzo_cliente = str(r.get("indirizzo_cliente") or "")
-                        citta_cliente = str(r.get("citta_cliente") or "")
-                        provincia_cliente = str(r.get("provincia_cliente") or "")
-                        regione = str(r.get("regione") or "")
-                        contatto = str(r.get("contatto") or "")
-                        modello = str(r.get("modello") or "")
-
-                        # Data creazione: se presente nel file la usiamo, altrimenti ora
-                        data_creazione = to_safe_date_str(r.get("data_creazione")) or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                        # Controllo duplicati
-                        exists = cur.execute("""
-                            SELECT 1 FROM ticket 
-                            WHERE numero_ticket=?
-                        """, (numero_ticket,)).fetchone()
-                        if exists:
-                            dup += 1
-                            continue
-
-                        # Inserimento ticket con i dati presi dal file
-                        cur.execute("""
-                            INSERT INTO ticket (
-                                matricola, modello, cliente_id, descrizione, fattura, note, data_intervento,
-                                intervento_svolto, stato, allegato, contatto, regione, guasto,
-                                tecnico_nome, citta_tecnico, provincia_tecnico, numero_ticket,
-                                azienda, indirizzo_cliente, citta_cliente, provincia_cliente,
-                                data_creazione
-                            ) VALUES ( ?,?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """, (
-                            matricola, modello, cliente_id, descrizione, fattura, note, data_interv,
-                            intervento, stato, allegato, contatto, regione, guasto,
-                            tecnico_nome, citta_tecnico, provincia_tecnico, numero_ticket,
-                            azienda, indirizzo_cliente, citta_cliente, provincia_cliente,
-                            data_creazione
-                        ))
-                        ins += 1
-
-                    con.commit()
-                    con.close()
-
-                    st.success(f"✅ Upload completato. Inseriti: {ins}, Saltati: {skip}, Duplicati trovati: {dup}.")
+                    barra = st.progress(0.0, text="Inserimento ticket…")
+                    with transazione() as con:
+                        # numeri già presenti: un solo passaggio sull'indice UNIQUE
+                        numeri_esistenti = {
+                            n for (n,) in con.execute("SELECT numero_ticket FROM ticket WHERE numero_ticket IS NOT NULL")
+                        }
+                        righe, scarti = prepara_ticket_excel(df, numeri_esistenti)
+                        ins = inserisci_ticket_excel(
+                            con, righe, avanzamento=lambda f: barra.progress(f, text=f"Inserimento ticket… {f:.0%}")
+                        )
+
+                        # i numeri importati non devono essere riassegnati ai nuovi ticket
+                        allinea_sequenza_ticket(con)
+                        incrementa_versione(con, "ticket")
+
+                    skip = int((scarti["motivo"] == "matricola o descrizione mancante").sum())
+                    st.session_state.upload_esito = (
+                        f"✅ Upload completato. Inseriti: {ins}, Saltati: {skip}, Duplicati trovati: {len(scarti) - skip}."
+                    )
+                    st.session_state.upload_scarti = scarti
                     st.session_state.upload_done = True
                     st.rerun()
 
             else:
+                st.success(st.session_state.get("upload_esito", "✔️ Upload già eseguito."))
+                scarti = st.session_state.get("upload_scarti")
+                if scarti is not None and not scarti.empty:
+                    st.dataframe(scarti, use_container_width=True)
+                    st.download_button(
+                        "📥 Scarica righe scartate",
+                        data=excel_da_righe(
+                            list(scarti.columns),
+                            scarti.astype(object).where(scarti.notna(), None).itertuples(index=False, name=None),
+                            foglio="Scarti",
+                        ),
+                        file_name="ticket_scartati.xlsx",
+                        mime=MIME_XLSX,
+                    )
                 st.info("✔️ Upload già eseguito. Ricarica la pagina per ripetere.")
 
         except Exception as e:
@@ -2117,20 +3842,11 @@ def pagina_import_export():
 
     if uploaded_file is not None:
         try:
-            # Legge l'Excel come stringhe
-            df = pd.read_excel(uploaded_file, dtype=str)
-
-            # Normalizza la colonna codice
-            if "codice" in df.columns:
-                df["codice"] = df["codice"].astype(str).str.strip()
-                df["codice"] = df["codice"].apply(
-                    lambda x: x.zfill(8) if x.isdigit() else x
-                )
+            # Legge l'Excel come stringhe e normalizza la colonna codice
+            df = normalizza_codici(pd.read_excel(uploaded_file, dtype=str))
 
-            # Scrive nel DB
-            conn = sqlite3.connect(DB_PATH)
-            df.to_sql("codici_clienti", conn, if_exists="replace", index=False)
-            conn.close()
+            # Scrive nel DB (tabella ombra + scambio atomico)
+            sostituisci_tabella_riferimento("codici_clienti", df)
 
             st.success(f"✅ Importati {len(df)} codici in tabella 'codici_clienti'")
 
@@ -2151,10 +3867,8 @@ def pagina_import_export():
             # Legge l'Excel come stringhe
             df = pd.read_excel(uploaded_file, dtype=str)
 
-            # Scrive nel DB
-            conn = sqlite3.connect(DB_PATH)
-            df.to_sql("province", conn, if_exists="replace", index=False)
-            conn.close()
+            # Scrive nel DB (tabella ombra + scambio atomico)
+            sostituisci_tabella_riferimento("province", df)
 
             st.success(f"✅ Importati {len(df)} codici in tabella 'Province'")
 
@@ -2171,12 +3885,8 @@ DB_FILE = "assistenza.db" # 🔹 Usa lo stesso path che usi nel resto del proget
 def pagina_tools():
     st.header("🛠️ Tools - Gestione Guasti (critical)")
 
-    # --- Connessione DB ---
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row  # per avere i risultati come dict-like
-    
     # --- Leggo la tabella direttamente in dataframe ---
-    critical_df = pd.read_sql_query("SELECT id, codice_guasto, guasto FROM critical ORDER BY codice_guasto ASC", conn)
+    critical_df = carica_guasti()
 
     st.subheader("📋 Elenco guasti registrati")
     if not critical_df.empty:
@@ -2193,13 +3903,13 @@ def pagina_tools():
 
     if add_submitted:
         if codice_guasto and descrizione_guasto:
-            conn.execute(
-                "INSERT INTO critical (codice_guasto, guasto) VALUES (?, ?)",
-                (codice_guasto, descrizione_guasto)
-            )
-            conn.commit()
+            with transazione() as conn:
+                conn.execute(
+                    "INSERT INTO critical (codice_guasto, guasto) VALUES (?, ?)",
+                    (codice_guasto, descrizione_guasto)
+                )
+                incrementa_versione(conn, "critical")
             st.success(f"✅ Guasto '{codice_guasto} - {descrizione_guasto}' aggiunto con successo!")
-            conn.close()
             st.rerun()
         else:
             st.warning("⚠️ Inserisci sia codice che descrizione.")
@@ -2210,12 +3920,75 @@ def pagina_tools():
         guasto_map = {f"{row['codice_guasto']} - {row['guasto']}": row['id'] for _, row in critical_df.iterrows()}
         guasto_da_eliminare = st.selectbox("Seleziona guasto da eliminare", list(guasto_map.keys()))
         if st.button("❌ Elimina Guasto"):
-            conn.execute("DELETE FROM critical WHERE id = ?", (guasto_map[guasto_da_eliminare],))
-            conn.commit()
+            with transazione() as conn:
+                conn.execute("DELETE FROM critical WHERE id = ?", (guasto_map[guasto_da_eliminare],))
+                incrementa_versione(conn, "critical")
             st.success(f"Guasto '{guasto_da_eliminare}' eliminato con successo!")
-            conn.close()
             st.rerun()
-    conn.close()
+
+    # --- Verifica indici DB ---
+    st.subheader("🩺 Verifica indici DB")
+    c1, c2 = st.columns(2)
+    with c1:
+        if st.button("🔎 Controlla piani delle query principali"):
+            regressioni = verifica_piani_query()
+            if regressioni:
+                for nome, dettaglio in regressioni:
+                    st.error(f"❌ {nome}: {dettaglio}")
+            else:
+                st.success("✅ Tutte le query principali usano un indice.")
+    with c2:
+        if st.button("🧱 Ricrea indici mancanti"):
+            with transazione() as con:
+                assicura_indici(con)
+            st.success("✅ Indici verificati.")
+
+    # --- Campi extra (extra_json) ---
+    st.subheader("🧩 Campi extra")
+    st.caption(
+        f"Le chiavi filtrate almeno {SOGLIA_PROMOZIONE_EXTRA} volte diventano colonne generate con indice."
+    )
+    con = get_connessione(sola_lettura=True)
+    registro = pd.read_sql_query(
+        "SELECT tabella, chiave, utilizzi, colonna FROM chiavi_extra", con
+    )
+    for tabella in TABELLE_EXTRA:
+        chiavi = chiavi_extra(tabella)
+        if chiavi.empty:
+            continue
+        chiavi = chiavi.merge(registro[registro["tabella"] == tabella], on="chiave", how="left")
+        with st.expander(f"{tabella}: {len(chiavi)} chiavi"):
+            st.dataframe(
+                chiavi[["chiave", "righe", "utilizzi", "colonna"]].fillna({"utilizzi": 0}),
+                use_container_width=True, hide_index=True
+            )
+            da_promuovere = chiavi.loc[chiavi["colonna"].isna(), "chiave"].tolist()
+            if da_promuovere:
+                scelta = st.selectbox("Chiave da indicizzare", da_promuovere, key=f"promuovi_{tabella}")
+                if st.button("📌 Crea colonna indicizzata", key=f"promuovi_btn_{tabella}"):
+                    with transazione() as conn:
+                        colonna = promuovi_chiave_extra(conn, tabella, scelta)
+                    st.success(f"✅ {tabella}.{scelta} → colonna {colonna}")
+
+    # --- Cache dati di riferimento ---
+    st.subheader("🗃️ Cache dati di riferimento")
+    stats = get_cache_riferimenti().statistiche()
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Voci", stats["voci"])
+    m2.metric("Memoria", f"{stats['bytes'] / 1024 / 1024:.1f} / {stats['max_bytes'] / 1024 / 1024:.0f} MB")
+    m3.metric("Hit ratio", f"{stats['hit_ratio']:.0%}", help=f"hit {stats['hit']} · miss {stats['miss']}")
+    m4.metric("Evizioni", stats["evizioni"])
+    if stats["dettaglio"]:
+        with st.expander("🔍 Dettaglio voci in cache"):
+            st.dataframe(pd.DataFrame([
+                {"Dato": nome[0], "Parametri": str(nome[1]) if len(nome) > 1 and nome[1] else "",
+                 "Versioni": ", ".join(f"{t}={v}" for t, v in versioni.items()),
+                 "KB": round(b / 1024, 1)}
+                for nome, versioni, b in stats["dettaglio"]
+            ]), use_container_width=True, hide_index=True)
+    if st.button("🧽 Svuota cache"):
+        get_cache_riferimenti().svuota()
+        st.rerun()
     
 
 
@@ -2353,9 +4126,6 @@ def genera_pdf_ticket_fattura(ticket_data, campi):
 def pagina_stampa_ticket():
     st.header("🖨️ Stampa Ticket")
 
-    conn = sqlite3.connect("assistenza.db")
-    cursor = conn.cursor()
-
     # funzione utility locale
     def safe_str(val, default="-"):
         if val is None:
@@ -2365,32 +4135,15 @@ def pagina_stampa_ticket():
     # ricerca ticket
     search_ticket = st.text_input("🔍 Cerca ticket per cliente, tecnico o descrizione...")
 
-    query = """
-        SELECT t.*
-        FROM ticket t
-        WHERE t.matricola LIKE ? 
-           OR t.azienda LIKE ? 
-           OR t.tecnico_nome LIKE ? 
-           OR t.descrizione LIKE ? 
-           OR t.guasto LIKE ?
-        ORDER BY t.data_creazione DESC
-        LIMIT 50
-    """
-    cursor.execute(query, (
-        f"%{search_ticket}%", 
-        f"%{search_ticket}%", 
-        f"%{search_ticket}%", 
-        f"%{search_ticket}%", 
-        f"%{search_ticket}%"
-    ))
-    rows = cursor.fetchall()
-    cols = [d[0] for d in cursor.description]
+    risultati = cerca_ticket(search_ticket, colonne=[
+        "matricola", "azienda", "tecnico_nome", "descrizione", "guasto",
+    ])
 
     # convertiamo subito i valori
     tickets = []
-    for row in rows:
+    for riga in risultati:
         rec = {}
-        for col, val in zip(cols, row):
+        for col, val in riga.items():
             if col == "fattura":  # mantieni numerico
                 rec[col] = val if val is not None else 0.0
             else:
@@ -2443,109 +4196,128 @@ def pagina_stampa_ticket():
 
 DB_PATH = "assistenza.db"
 
+# --------------------------------
+# Geocodifica con cache (geocode_cache)
+# --------------------------------
+# Condizione "coordinate mancanti o non valide" per clienti e tecnici
+SQL_SENZA_COORDINATE = "lat IS NULL OR lon IS NULL OR lat = '' OR lon = '' OR lat = '0' OR lon = '0'"
+
+# Un luogo "non trovato" si ritenta dopo questi giorni (le coordinate trovate non scadono)
+GEOCODE_RIPROVA_GIORNI = 30
+SQL_GEOCODE_VALIDA = "(lat IS NOT NULL OR aggiornato >= datetime('now', ?))"
+
+
+@st.cache_resource
+def get_geocoder():
+    """
+    Nominatim con un solo RateLimiter (1 richiesta/s) condiviso da tutte le sessioni.
+    Gli errori di rete non vengono trasformati in None: finirebbero in cache come "non trovato".
+    """
+    geolocator = Nominatim(user_agent="gestione_assistenza")
+    return RateLimiter(geolocator.geocode, min_delay_seconds=1, swallow_exceptions=False)
+
+
 # Funzione per geocodificare città/provincia
 def geocodifica(citta, provincia=None):
-    geolocator = Nominatim(user_agent="assistenza_app")
-    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1)
+    """
+    (lat, lon) del luogo, (None, None) se non trovato. Si interroga Nominatim
+    solo per luoghi mai visti o dati per non trovati da più di GEOCODE_RIPROVA_GIORNI;
+    se il servizio solleva un errore non si scrive nulla in cache.
+    """
+    luogo = chiave_luogo(citta, provincia)
+    conn = get_connessione(sola_lettura=True)
+    trovato = conn.execute(
+        f"SELECT lat, lon FROM geocode_cache WHERE luogo = ? AND {SQL_GEOCODE_VALIDA}",
+        (luogo, f"-{GEOCODE_RIPROVA_GIORNI} days")
+    ).fetchone()
+    if trovato:
+        return trovato[0], trovato[1]
+
     if provincia:
         query = f"{citta}, {provincia}, Italia"
     else:
         query = f"{citta}, Italia"
-    location = geocode(query)
-    if location:
-        return location.latitude, location.longitude
-    return None, None
-
-def aggiorna_coordinate_tecnici():
-    print("DEBUG: Inizio aggiornamento coordinate tecnici")
-    conn = sqlite3.connect(DB_PATH)
-    
+    location = get_geocoder()(query)
+    lat, lon = (location.latitude, location.longitude) if location else (None, None)
+    with transazione() as conn:
+        conn.execute("""
+            INSERT INTO geocode_cache (luogo, lat, lon, fonte) VALUES (?, ?, ?, 'nominatim')
+            ON CONFLICT (luogo) DO UPDATE SET
+                lat = excluded.lat, lon = excluded.lon,
+                fonte = excluded.fonte, aggiornato = datetime('now')
+        """, (luogo, lat, lon))
+    return lat, lon
+
+
+def _aggiorna_coordinate(tabella, colonna_nome):
+    """
+    Coordinate delle righe di 'tabella' che non le hanno, un luogo distinto
+    alla volta: ogni (città, provincia) si geocodifica una volta sola e le
+    sue righe si aggiornano con un unico executemany.
+    """
+    print(f"DEBUG: Inizio aggiornamento coordinate {tabella}")
     try:
-        # Verifica prima quanti tecnici hanno bisogno di aggiornamento
-        cursor = conn.cursor()
-        # Modifica la query per includere anche valori vuoti o non validi
-        cursor.execute("SELECT COUNT(*) FROM tecnici WHERE lat IS NULL OR lon IS NULL OR lat = '' OR lon = '' OR lat = '0' OR lon = '0'")
-        da_aggiornare = cursor.fetchone()[0]
-        print(f"DEBUG: Tecnici da aggiornare: {da_aggiornare}")
-        
-        if da_aggiornare == 0:
-            print("DEBUG: Nessun tecnico da aggiornare")
-            return ["ℹ️ Tutti i tecnici hanno già le coordinate"]
-        
-        # Modifica anche questa query per includere valori vuoti o non validi
-        df = pd.read_sql_query("SELECT id, nome, citta, provincia, regione, lat, lon FROM tecnici WHERE lat IS NULL OR lon IS NULL OR lat = '' OR lon = '' OR lat = '0' OR lon = '0'", conn)
-        print(f"DEBUG: Caricati {len(df)} tecnici da aggiornare")
-        
-        geolocator = Nominatim(user_agent="gestione_assistenza")
-        geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1)
-        
+        conn = get_connessione(sola_lettura=True)
+        df = pd.read_sql_query(
+            f"SELECT id, {colonna_nome} AS nome, citta, provincia FROM {tabella} WHERE {SQL_SENZA_COORDINATE}",
+            conn
+        )
+        print(f"DEBUG: {tabella} da aggiornare: {len(df)}")
+        if df.empty:
+            return [f"ℹ️ Tutti i {tabella} hanno già le coordinate"]
+
         risultati = []
-        
-        for index, row in df.iterrows():
-            print(f"DEBUG: Elaborazione tecnico {index+1}/{len(df)}: {row['nome']} (ID: {row['id']})")
-            print(f"DEBUG: Coordinate attuali: lat={row['lat']}, lon={row['lon']}")
-            
-            # Salta tecnici senza città o provincia
-            if not row['citta'] or not row['provincia'] or pd.isna(row['citta']) or pd.isna(row['provincia']):
-                msg = f"⚠️ Saltato {row['nome']}: città o provincia mancanti"
-                print(f"DEBUG: {msg}")
-                risultati.append(msg)
-                continue
-                
-            location_str = f"{row['citta']}, {row['provincia']}, Italia"
-            print(f"DEBUG: Geocodifica di '{location_str}'")
-            
+        mancanti = (
+            df["citta"].fillna("").astype(str).str.strip().eq("")
+            | df["provincia"].fillna("").astype(str).str.strip().eq("")
+        )
+        risultati += [f"⚠️ Saltato {nome}: città o provincia mancanti" for nome in df.loc[mancanti, "nome"]]
+        df = df[~mancanti].copy()
+        df["luogo"] = [chiave_luogo(c, p) for c, p in zip(df["citta"], df["provincia"])]
+
+        luoghi = df["luogo"].unique().tolist()
+        in_cache = conn.execute(
+            f"SELECT COUNT(*) FROM geocode_cache WHERE luogo IN (SELECT value FROM json_each(?)) AND {SQL_GEOCODE_VALIDA}",
+            (json.dumps(luoghi), f"-{GEOCODE_RIPROVA_GIORNI} days")
+        ).fetchone()[0]
+        print(f"DEBUG: {len(luoghi)} luoghi distinti, {in_cache} già in cache")
+
+        for _, gruppo in df.groupby("luogo", sort=False):
+            citta, provincia = gruppo["citta"].iloc[0], gruppo["provincia"].iloc[0]
             try:
-                location = geocode(location_str)
-                if location:
-                    lat = location.latitude
-                    lon = location.longitude
-                    print(f"DEBUG: Coordinate trovate: {lat}, {lon}")
-                    
-                    # Aggiorna il database
-                    cursor.execute(
-                        "UPDATE tecnici SET lat=?, lon=? WHERE id=?",
-                        (lat, lon, row["id"])
-                    )
-                    conn.commit()
-                    
-                    # Verifica che l'aggiornamento sia stato eseguito
-                    cursor.execute("SELECT lat, lon FROM tecnici WHERE id=?", (row["id"],))
-                    result = cursor.fetchone()
-                    
-                    if result and result[0] is not None and result[1] is not None:
-                        msg = f"✔️ Aggiornato {row['nome']} → {result[0]}, {result[1]}"
-                        print(f"DEBUG: {msg}")
-                        risultati.append(msg)
-                    else:
-                        msg = f"❌ Errore verifica aggiornamento per {row['nome']}"
-                        print(f"DEBUG: {msg}")
-                        risultati.append(msg)
-                else:
-                    msg = f"⚠️ Non trovato: {location_str}"
-                    print(f"DEBUG: {msg}")
-                    risultati.append(msg)
+                lat, lon = geocodifica(citta, provincia)
             except Exception as e:
-                msg = f"❌ Errore {row['nome']}: {str(e)}"
-                print(f"DEBUG: {msg}")
-                risultati.append(msg)
-            
-            # Pausa per non sovraccaricare il servizio di geocodifica
-            time.sleep(1)
-        
-        print("DEBUG: Fine aggiornamento coordinate tecnici")
+                risultati += [f"❌ Errore {nome}: {str(e)}" for nome in gruppo["nome"]]
+                continue
+            if lat is None or lon is None:
+                risultati += [f"⚠️ Non trovato: {citta}, {provincia}, Italia" for _ in gruppo["nome"]]
+                continue
+            with transazione() as conn_rw:
+                conn_rw.executemany(
+                    f"UPDATE {tabella} SET lat=?, lon=? WHERE id=?",
+                    [(lat, lon, int(i)) for i in gruppo["id"]]
+                )
+                incrementa_versione(conn_rw, tabella)
+            risultati += [f"✔️ Aggiornato {nome} → {lat}, {lon}" for nome in gruppo["nome"]]
+
+        risultati.append(
+            f"ℹ️ {len(luoghi)} luoghi distinti: {in_cache} dalla cache, "
+            f"{len(luoghi) - in_cache} dal servizio di geocodifica"
+        )
+        print(f"DEBUG: Fine aggiornamento coordinate {tabella}")
         return risultati
-        
+
     except Exception as e:
         print(f"DEBUG: Errore generale: {str(e)}")
         return [f"❌ Errore generale: {str(e)}"]
-    finally:
-        conn.close()
-        print("DEBUG: Connessione chiusa")
+
+
+def aggiorna_coordinate_tecnici():
+    return _aggiorna_coordinate("tecnici", "nome")
 
 # Funzione per verificare lo stato delle coordinate
 def verifica_coordinate_tecnici():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connessione(sola_lettura=True)
     
     try:
         # Ottieni tutti i tecnici
@@ -2582,8 +4354,6 @@ def verifica_coordinate_tecnici():
             
     except Exception as e:
         st.error(f"Errore durante la verifica: {str(e)}")
-    finally:
-        conn.close()
 
 
 # Funzione per calcolare la distanza tra due punti (in km)
@@ -2598,11 +4368,10 @@ def calcola_distanza(lat1, lon1, lat2, lon2):
 
 # --- Funzione: mostra mappa ---
 def mostra_mappa_tecnici(regioni_sel, citta_sel=None, raggio_km=None, num_punti=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connessione(sola_lettura=True)
     df_tecnici = pd.read_sql_query(
         "SELECT id, esperienza, nome, citta, provincia, regione, referente, telefono, cellulare, email, lat, lon FROM tecnici", conn
     )
-    conn.close()
 
     if df_tecnici.empty:
         st.warning("⚠️ Nessun tecnico presente in archivio.")
@@ -2769,13 +4538,10 @@ def pagina_mappa_tecnici():
                     st.rerun()
 
 
-    conn = sqlite3.connect(DB_PATH)
-    regioni = pd.read_sql_query("SELECT DISTINCT regione FROM tecnici WHERE regione IS NOT NULL", conn)
-    citta_disponibili = pd.read_sql_query("SELECT DISTINCT citta FROM tecnici WHERE citta IS NOT NULL", conn)
-    conn.close()
-
-    lista_regioni = ["Tutte"] + sorted(regioni["regione"].dropna().tolist())
-    regioni_sel = st.multiselect("📌 Seleziona regioni da visualizzare:", lista_regioni, default=["Tutte"])
+    lista_regioni, formato_regioni = opzioni_faccetta("tecnici", "regione", "Tutte")
+    regioni_sel = st.multiselect(
+        "📌 Seleziona regioni da visualizzare:", lista_regioni, default=["Tutte"], format_func=formato_regioni
+    )
 
     # Input per la città con suggerimenti
     st.subheader("🔍 Cerca una città")
@@ -2784,10 +4550,12 @@ def pagina_mappa_tecnici():
     use_suggested = st.checkbox("Usa città dove sono presenti i tecnici", value=False)
     
     if use_suggested:
+        lista_citta, formato_citta = opzioni_faccetta("tecnici", "citta")
         citta_sel = st.selectbox(
             "Seleziona una città:", 
-            options=[""] + sorted(citta_disponibili["citta"].dropna().tolist()),
-            index=0
+            options=[""] + lista_citta,
+            index=0,
+            format_func=formato_citta
         )
     else:
         citta_sel = st.text_input(
@@ -2814,19 +4582,6 @@ def pagina_mappa_tecnici():
 
 DB_PATH = "assistenza.db"
 
-# Funzione per geocodificare città/provincia
-def geocodifica(citta, provincia=None):
-    geolocator = Nominatim(user_agent="assistenza_app")
-    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1)
-    if provincia:
-        query = f"{citta}, {provincia}, Italia"
-    else:
-        query = f"{citta}, Italia"
-    location = geocode(query)
-    if location:
-        return location.latitude, location.longitude
-    return None, None
-
 # Funzione per calcolare la distanza tra due punti (in km)
 def calcola_distanza(lat1, lon1, lat2, lon2):
     try:
@@ -2838,7 +4593,7 @@ def calcola_distanza(lat1, lon1, lat2, lon2):
 
 # Funzione per verificare lo stato delle coordinate dei clienti
 def verifica_coordinate_clienti():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connessione(sola_lettura=True)
     
     try:
         # Ottieni tutti i clienti
@@ -2875,97 +4630,17 @@ def verifica_coordinate_clienti():
             
     except Exception as e:
         st.error(f"Errore durante la verifica: {str(e)}")
-    finally:
-        conn.close()
 
 # Funzione per aggiornare le coordinate dei clienti
 def aggiorna_coordinate_clienti():
-    print("DEBUG: Inizio aggiornamento coordinate clienti")
-    conn = sqlite3.connect(DB_PATH)
-    
-    try:
-        # Verifica prima quanti clienti hanno bisogno di aggiornamento
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM clienti WHERE lat IS NULL OR lon IS NULL OR lat = '' OR lon = '' OR lat = '0' OR lon = '0'")
-        da_aggiornare = cursor.fetchone()[0]
-        print(f"DEBUG: Clienti da aggiornare: {da_aggiornare}")
-        
-        if da_aggiornare == 0:
-            print("DEBUG: Nessun cliente da aggiornare")
-            return ["ℹ️ Tutti i clienti hanno già le coordinate"]
-        
-        df = pd.read_sql_query("SELECT id, azienda, citta, provincia, codice, matricola, lat, lon, proprieta FROM clienti WHERE lat IS NULL OR lon IS NULL OR lat = '' OR lon = '' OR lat = '0' OR lon = '0'", conn)
-        print(f"DEBUG: Caricati {len(df)} clienti da aggiornare")
-        
-        geolocator = Nominatim(user_agent="gestione_assistenza")
-        geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1)
-        
-        risultati = []
-        
-        for index, row in df.iterrows():
-            print(f"DEBUG: Elaborazione cliente {index+1}/{len(df)}: {row['azienda']} (ID: {row['id']})")
-            
-            if not row['citta'] or not row['provincia'] or pd.isna(row['citta']) or pd.isna(row['provincia']):
-                msg = f"⚠️ Saltato {row['azienda']}: città o provincia mancanti"
-                print(f"DEBUG: {msg}")
-                risultati.append(msg)
-                continue
-                
-            location_str = f"{row['citta']}, {row['provincia']}, Italia"
-            print(f"DEBUG: Geocodifica di '{location_str}'")
-            
-            try:
-                location = geocode(location_str)
-                if location:
-                    lat = location.latitude
-                    lon = location.longitude
-                    print(f"DEBUG: Coordinate trovate: {lat}, {lon}")
-                    
-                    cursor.execute(
-                        "UPDATE clienti SET lat=?, lon=? WHERE id=?",
-                        (lat, lon, row["id"])
-                    )
-                    conn.commit()
-                    
-                    cursor.execute("SELECT lat, lon FROM clienti WHERE id=?", (row["id"],))
-                    result = cursor.fetchone()
-                    
-                    if result and result[0] is not None and result[1] is not None:
-                        msg = f"✔️ Aggiornato {row['azienda']} → {result[0]}, {result[1]}"
-                        print(f"DEBUG: {msg}")
-                        risultati.append(msg)
-                    else:
-                        msg = f"❌ Errore verifica aggiornamento per {row['azienda']}"
-                        print(f"DEBUG: {msg}")
-                        risultati.append(msg)
-                else:
-                    msg = f"⚠️ Non trovato: {location_str}"
-                    print(f"DEBUG: {msg}")
-                    risultati.append(msg)
-            except Exception as e:
-                msg = f"❌ Errore {row['azienda']}: {str(e)}"
-                print(f"DEBUG: {msg}")
-                risultati.append(msg)
-            
-            time.sleep(1)
-        
-        print("DEBUG: Fine aggiornamento coordinate clienti")
-        return risultati
-        
-    except Exception as e:
-        print(f"DEBUG: Errore generale: {str(e)}")
-        return [f"❌ Errore generale: {str(e)}"]
-    finally:
-        conn.close()
-        print("DEBUG: Connessione chiusa")
+    return _aggiorna_coordinate("clienti", "azienda")
 
 # --- Funzione: mostra mappa clienti ---
 def mostra_mappa_clienti(regioni_sel, citta_sel=None, raggio_km=None, num_punti=None, proprieta_sel=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connessione(sola_lettura=True)
     df_clienti = pd.read_sql_query(
         "SELECT id, azienda, citta, indirizzo, provincia, codice, matricola, matint, lat, lon, proprieta FROM clienti", conn
     )
-    conn.close()
 
     if df_clienti.empty:
         st.warning("⚠️ Nessun cliente presente in archivio.")
@@ -3205,18 +4880,14 @@ def pagina_mappa_clienti():
                 if st.button("🔄 Ricarica pagina per vedere le modifiche"):
                     st.rerun()
 
-    conn = sqlite3.connect(DB_PATH)
-    regioni = pd.read_sql_query("SELECT DISTINCT regione FROM clienti WHERE regione IS NOT NULL", conn)
-    citta_disponibili = pd.read_sql_query("SELECT DISTINCT citta FROM clienti WHERE citta IS NOT NULL", conn)
-    proprieta_disponibili = pd.read_sql_query("SELECT DISTINCT proprieta FROM clienti WHERE proprieta IS NOT NULL", conn)
-    conn.close()
-
-    lista_regioni = ["Tutte"] + sorted(regioni["regione"].dropna().tolist())
-    regioni_sel = st.multiselect("📌 Seleziona regioni da visualizzare:", lista_regioni, default=["Tutte"])
+    lista_regioni, formato_regioni = opzioni_faccetta("clienti", "regione", "Tutte")
+    regioni_sel = st.multiselect(
+        "📌 Seleziona regioni da visualizzare:", lista_regioni, default=["Tutte"], format_func=formato_regioni
+    )
 
     # Selezione della proprietà
-    lista_proprieta = ["Tutti"] + sorted(proprieta_disponibili["proprieta"].dropna().tolist())
-    proprieta_sel = st.selectbox("👤 Seleziona proprietà:", lista_proprieta, index=0)
+    lista_proprieta, formato_proprieta = opzioni_faccetta("clienti", "proprieta", "Tutti")
+    proprieta_sel = st.selectbox("👤 Seleziona proprietà:", lista_proprieta, index=0, format_func=formato_proprieta)
 
     # Input per la città con suggerimenti
     st.subheader("🔍 Cerca una città")
@@ -3225,10 +4896,12 @@ def pagina_mappa_clienti():
     
     citta_sel = None
     if use_suggested:
+        lista_citta, formato_citta = opzioni_faccetta("clienti", "citta")
         citta_sel = st.selectbox(
             "Seleziona una città:", 
-            options=[""] + sorted(citta_disponibili["citta"].dropna().tolist()),
-            index=0
+            options=[""] + lista_citta,
+            index=0,
+            format_func=formato_citta
         )
     else:
         citta_sel = st.text_input(
@@ -3291,11 +4964,10 @@ def mostra_tecnici_vicini_citta(citta, raggio_km=50, num_tecnici=5):
         st.info("💡 Suggerimento: Prova a specificare anche la provincia (es: 'Roma, RM')")
         return
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connessione(sola_lettura=True)
     df_tecnici = pd.read_sql_query(
         "SELECT id, esperienza, nome, citta, provincia, regione, telefono, cellulare, referente, email, lat, lon FROM tecnici", conn
     )
-    conn.close()
     
     if df_tecnici.empty:
         st.warning("⚠️ Nessun tecnico presente in archivio.")